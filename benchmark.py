@@ -0,0 +1,448 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark suite for Dataset Builder
+Генерация синтетического архива ежедневных файлов и замер времени каждого этапа обработки
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+from typing import Any, Dict, Iterator, List, Optional
+
+import pandas as pd
+import pyarrow as pa
+from openpyxl import Workbook
+
+from dataset_builder_advanced import AdvancedDatasetBuilder
+from parsers import TEMPERATURE_PATTERN, _temperature, parse_filename_date, parse_temperature, parse_temperatures
+from workbook_reader import ENGINES
+
+# Этапы обработки в порядке выполнения
+STAGES = ('discovery', 'parse', 'pallet_order', 'collection_plan', 'merge', 'save')
+
+# История запусков: одна строка на запуск, чтобы сравнивать версии между собой
+HISTORY_PATH = "benchmark_history.csv"
+PARSER_HISTORY_PATH = "parser_benchmark_history.csv"
+
+# Пароль защищенных файлов архива (проверяется сборщиком по умолчанию)
+DEFAULT_PASSWORD = 'Test'
+
+# В листе 'Pallet Order' читаются колонки B-Z
+MAX_DESTINATIONS = 25
+
+CLIENT_NAMES = ['Natures Way', 'Green Valley', 'Fresh Fields', 'Riverside Farm', 'Oakwood Foods',
+                'Hillside Produce', 'Meadow Dairy', 'Sunrise Bakery']
+DESTINATION_NAMES = ['Dublin', 'Cork', 'Galway', 'Limerick', 'Waterford', 'Belfast', 'Athlone',
+                     'Sligo', 'Kilkenny', 'Drogheda']
+TEMPERATURES = ['', '', ' (+5°C)', ' (+10°C)', ' (+15C)']
+PALLET_TYPES = ['Std', 'Euro', 'Half']
+TRAILER_TYPES = ['Straight', 'Twin', 'DD']
+COLLECTION_PLAN_HEADER = ['Load Number', 'Collection Site', 'Delivery Destination', 'Pallets Ordered',
+                          'Pallet Type', 'Trailer Type', 'Trailer Fill %', 'Driver', 'Vehicle', 'Route']
+
+
+def _write_daily_workbook(file_path: str, day: date, clients: int, destinations: int,
+                          header_offset: int, rng: random.Random):
+    """Пишет книгу одного дня: матрица заказов 'Pallet Order' и доставки 'Collection Plan'"""
+    client_names = [f"{CLIENT_NAMES[i % len(CLIENT_NAMES)]} {i // len(CLIENT_NAMES) + 1}{rng.choice(TEMPERATURES)}"
+                    for i in range(clients)]
+    destination_names = [f"DC {DESTINATION_NAMES[i % len(DESTINATION_NAMES)]} {i // len(DESTINATION_NAMES) + 1}"
+                         for i in range(destinations)]
+
+    workbook = Workbook(write_only=True)
+
+    # Заголовок листа, пустые строки, шапка с доставками и по строке на клиента
+    pallet_order = workbook.create_sheet('Pallet Order')
+    pallet_order.append([f"Pallet Order {day:%d/%m/%Y}"])
+    for _ in range(header_offset):
+        pallet_order.append([])
+    pallet_order.append(['Client'] + destination_names)
+
+    orders = []
+    for client_name in client_names:
+        # Большинство клиентов заказывают в несколько мест доставки, остальные ячейки пустые или нули
+        row = []
+        for destination_name in destination_names:
+            roll = rng.random()
+            if roll < 0.5:
+                row.append(None)
+            elif roll < 0.6:
+                row.append(0)
+            else:
+                pallets = rng.randint(1, 26)
+                row.append(pallets)
+                orders.append((destination_name, pallets))
+        pallet_order.append([client_name] + row)
+
+    # Доставки по заказам дня и несколько доставок без заказа
+    collection_plan = workbook.create_sheet('Collection Plan')
+    if header_offset:
+        collection_plan.append([f"Collection Plan {day:%d/%m/%Y}"])
+        for _ in range(header_offset - 1):
+            collection_plan.append([])
+    collection_plan.append(COLLECTION_PLAN_HEADER)
+
+    extra_loads = [(rng.choice(destination_names), rng.randint(1, 26)) for _ in range(max(1, len(orders) // 10))]
+    for number, (destination_name, pallets) in enumerate(orders + extra_loads, start=1):
+        collection_plan.append([
+            f"L{day:%m%d}{number:04d}",
+            f"Site {rng.randint(1, 5)}" if rng.random() < 0.3 else None,
+            destination_name,
+            pallets,
+            rng.choice(PALLET_TYPES),
+            rng.choice(TRAILER_TYPES),
+            rng.randint(40, 100),
+            f"Driver {rng.randint(1, 40)}",
+            f"{rng.randint(151, 242)}-D-{rng.randint(1000, 9999)}",
+            f"R{rng.randint(1, 12)}",
+        ])
+
+    workbook.save(file_path)
+
+
+def _encrypt_workbook(file_path: str, password: str):
+    """Шифрует книгу паролем на месте"""
+    try:
+        from msoffcrypto.format.ooxml import OOXMLFile
+    except ImportError:
+        raise RuntimeError("для защищенных файлов архива нужен пакет msoffcrypto-tool")
+
+    plain_path = f"{file_path}.plain"
+    os.replace(file_path, plain_path)
+    with open(plain_path, 'rb') as source, open(file_path, 'wb') as target:
+        OOXMLFile(source).encrypt(password, target)
+    os.remove(plain_path)
+
+
+def generate_archive(root: str, days: int = 30, clients: int = 40, destinations: int = 20,
+                     protected_ratio: float = 0.0, header_offset: int = 0,
+                     start_date: date = date(2024, 1, 1), password: str = DEFAULT_PASSWORD,
+                     seed: int = 0) -> List[str]:
+    """Создает архив ежедневных файлов по папкам месяцев, как в папке года
+
+    header_offset - число пустых строк над шапкой таблиц; protected_ratio - доля файлов с паролем.
+    Одинаковые параметры и seed дают одинаковый архив.
+    """
+    if not 1 <= destinations <= MAX_DESTINATIONS:
+        raise ValueError(f"Число мест доставки должно быть от 1 до {MAX_DESTINATIONS}")
+
+    rng = random.Random(seed)
+    files = []
+    for offset in range(days):
+        day = start_date + timedelta(days=offset)
+        month_folder = os.path.join(root, f"{day:%m} {day:%B}")
+        os.makedirs(month_folder, exist_ok=True)
+
+        file_path = os.path.join(month_folder, f"Lyons collections {day:%d%m%Y}.xlsx")
+        _write_daily_workbook(file_path, day, clients, destinations, header_offset, rng)
+        if rng.random() < protected_ratio:
+            _encrypt_workbook(file_path, password)
+        files.append(file_path)
+
+    return files
+
+
+class StageTimer:
+    """Суммирует время и число вызовов каждого этапа"""
+
+    def __init__(self):
+        self.seconds: Dict[str, float] = {stage: 0.0 for stage in STAGES}
+        self.calls: Dict[str, int] = {stage: 0 for stage in STAGES}
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """Замеряет один вызов этапа"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[name] += time.perf_counter() - started
+            self.calls[name] += 1
+
+    @property
+    def total_seconds(self) -> float:
+        return sum(self.seconds.values())
+
+
+def _git_commit() -> Optional[str]:
+    """Текущий коммит репозитория, если он доступен"""
+    try:
+        result = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)), timeout=10)
+    except (OSError, subprocess.SubprocessError):
+        return None
+    if result.returncode != 0:
+        return None
+    return result.stdout.strip() or None
+
+
+def _environment() -> Dict[str, Any]:
+    """Версия кода и окружения, в котором выполнен замер"""
+    return {
+        'started_at': datetime.now().isoformat(timespec='seconds'),
+        'git_commit': _git_commit(),
+        'parser_version': AdvancedDatasetBuilder.PARSER_VERSION,
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'pyarrow': pa.__version__,
+        'platform': platform.platform(),
+    }
+
+
+def run_pipeline(input_root: str, output_dir: str, engine: str = 'auto',
+                 passwords: Optional[List[str]] = None) -> Dict[str, Any]:
+    """Один полный прогон по архиву с замером этапов; датасет пишется в output_dir"""
+    builder = AdvancedDatasetBuilder(load_existing=False, engine=engine, passwords=passwords,
+                                     output_dir=output_dir, incremental=False)
+    timer = StageTimer()
+
+    with timer.stage('discovery'):
+        excel_files = builder.find_excel_files(input_root)
+
+    for file_path in excel_files:
+        filename = os.path.basename(file_path)
+        file_date = builder.extract_date_from_filename(filename)
+        if not file_date:
+            builder.stats['errors'] += 1
+            continue
+
+        with timer.stage('parse'):
+            sheets = builder.read_excel_sheets(file_path, ['Pallet Order', 'Collection Plan'])
+        with timer.stage('pallet_order'):
+            orders = builder.process_pallet_order_sheet(sheets['Pallet Order'], file_date, filename)
+        with timer.stage('collection_plan'):
+            deliveries = builder.process_collection_plan_sheet(sheets['Collection Plan'], file_date, filename)
+        with timer.stage('merge'):
+            merged_data = builder.merge_orders_and_deliveries(orders, deliveries)
+
+        builder.combined_data.extend(merged_data)
+        builder.stats['orders_extracted'] += len(orders)
+        builder.stats['deliveries_extracted'] += len(deliveries)
+        builder.stats['files_processed'] += 1
+
+    with timer.stage('save'):
+        builder.save_dataset()
+
+    return {
+        'files': len(excel_files),
+        'bytes': sum(os.path.getsize(file_path) for file_path in excel_files),
+        'records': len(builder.combined_data),
+        'orders': builder.stats['orders_extracted'],
+        'deliveries': builder.stats['deliveries_extracted'],
+        'errors': builder.stats['errors'],
+        'engine': builder.engine,
+        'stages': dict(timer.seconds),
+        'total_seconds': timer.total_seconds,
+    }
+
+
+def run_benchmark(input_root: str, results_dir: str = '.', repeat: int = 1, engine: str = 'auto',
+                  passwords: Optional[List[str]] = None, params: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Прогоняет обработку архива repeat раз и сохраняет результат в JSON и строку истории CSV
+
+    Для каждого этапа берется лучшее время из повторов: оно меньше всего зависит от фоновой нагрузки.
+    """
+    runs = []
+    for _ in range(repeat):
+        output_dir = tempfile.mkdtemp(prefix='benchmark_output_')
+        try:
+            runs.append(run_pipeline(input_root, output_dir, engine, passwords))
+        finally:
+            shutil.rmtree(output_dir, ignore_errors=True)
+
+    stages = {stage: min(run['stages'][stage] for run in runs) for stage in STAGES}
+    total_seconds = min(run['total_seconds'] for run in runs)
+    last_run = runs[-1]
+    result = {
+        **_environment(),
+        'engine': last_run['engine'],
+        'input': os.path.abspath(input_root),
+        'params': params or {},
+        'repeat': repeat,
+        'files': last_run['files'],
+        'bytes': last_run['bytes'],
+        'records': last_run['records'],
+        'orders': last_run['orders'],
+        'deliveries': last_run['deliveries'],
+        'errors': last_run['errors'],
+        'stages': stages,
+        'total_seconds': total_seconds,
+        'files_per_second': last_run['files'] / total_seconds if total_seconds else None,
+        'records_per_second': last_run['records'] / total_seconds if total_seconds else None,
+        'runs': [run['stages'] for run in runs],
+    }
+    save_results(result, results_dir)
+    return result
+
+
+def save_results(result: Dict[str, Any], results_dir: str = '.', history_name: str = HISTORY_PATH,
+                 prefix: str = 'benchmark') -> str:
+    """Сохраняет результат запуска в JSON и дописывает его строкой в историю запусков"""
+    os.makedirs(results_dir, exist_ok=True)
+    result_path = os.path.join(results_dir, f"{prefix}_{datetime.now():%Y%m%d_%H%M%S_%f}.json")
+    with open(result_path, 'w', encoding='utf-8') as f:
+        json.dump(result, f, ensure_ascii=False, indent=1)
+
+    row = {key: value for key, value in result.items() if key not in ('params', 'stages', 'runs')}
+    row.update({f"param_{key}": value for key, value in result['params'].items()})
+    row.update({f"{stage}_seconds": seconds for stage, seconds in result['stages'].items()})
+
+    # Новые колонки (например, новый этап) добавляются к истории, старые строки остаются пустыми
+    history_path = os.path.join(results_dir, history_name)
+    history = pd.DataFrame([row])
+    if os.path.exists(history_path):
+        history = pd.concat([pd.read_csv(history_path), history], ignore_index=True)
+    history.to_csv(history_path, index=False)
+
+    return result_path
+
+
+def _reference_temperature(client_name: Any) -> str:
+    """Прежний разбор температуры: четыре шаблона-строки по очереди для каждой строки"""
+    if client_name and isinstance(client_name, str):
+        for pattern in [r'\(\+(\d+)°C\)', r'\+(\d+)°C', r'(\d+)°C', r'(\d+)C']:
+            match = re.search(pattern, client_name, re.IGNORECASE)
+            if match:
+                return f"+{match.group(1)}°C"
+    return "+3°C"
+
+
+def _extract_temperatures(client_names: pd.Series) -> pd.Series:
+    """Прежний векторный разбор: регулярное выражение для каждой строки колонки"""
+    matches = client_names.astype(object).str.extract(TEMPERATURE_PATTERN)
+    return ('+' + matches.bfill(axis=1).iloc[:, 0] + '°C').fillna("+3°C")
+
+
+def _best_time(func, repeat: int) -> float:
+    """Лучшее время выполнения func из repeat повторов"""
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def run_parser_benchmarks(results_dir: str = '.', rows: int = 100000, clients: int = 300,
+                          repeat: int = 5) -> Dict[str, Any]:
+    """Микро-замеры разбора температуры (колонка из rows строк с clients названиями) и дат имен файлов
+
+    Кеш разбора очищается перед каждым повтором, кроме замеров с пометкой warm.
+    """
+    rng = random.Random(0)
+    names = [f"{CLIENT_NAMES[i % len(CLIENT_NAMES)]} {i // len(CLIENT_NAMES) + 1}{rng.choice(TEMPERATURES)}"
+             for i in range(clients)]
+    column = pd.Series([rng.choice(names) for _ in range(rows)] + [None, '', 12.5], dtype=object)
+    filenames = [f"Lyons collections {date(2024, 1, 1) + timedelta(days=offset):%d%m%Y}.xlsx" for offset in range(366)]
+
+    def cold(func):
+        def run():
+            _temperature.cache_clear()
+            parse_filename_date.cache_clear()
+            func()
+        return run
+
+    timings = {
+        'temperature_regex_per_row': _best_time(lambda: [_reference_temperature(name) for name in column], repeat),
+        'temperature_str_extract': _best_time(lambda: _extract_temperatures(column), repeat),
+        'temperature_series': _best_time(cold(lambda: parse_temperatures(column)), repeat),
+        'temperature_scalar_warm': _best_time(lambda: [parse_temperature(name) for name in column], repeat),
+        'date_uncached': _best_time(lambda: [parse_filename_date.__wrapped__(name) for name in filenames], repeat),
+        'date_cached_warm': _best_time(lambda: [parse_filename_date(name) for name in filenames], repeat),
+    }
+
+    expected = [_reference_temperature(name) for name in column]
+    result = {
+        **_environment(),
+        'params': {'rows': len(column), 'clients': clients, 'filenames': len(filenames), 'repeat': repeat},
+        'matches_reference': parse_temperatures(column).tolist() == expected,
+        'stages': timings,
+    }
+    save_results(result, results_dir, PARSER_HISTORY_PATH, prefix='parsers')
+    return result
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    """Разбирает аргументы командной строки"""
+    parser = argparse.ArgumentParser(
+        description="Замер скорости обработки на синтетическом архиве или на существующей папке.")
+    parser.add_argument('-i', '--input', metavar='FOLDER',
+                        help="существующая папка с файлами вместо синтетического архива")
+    parser.add_argument('-o', '--results-dir', default='benchmarks',
+                        help="папка для результатов и истории запусков (по умолчанию benchmarks)")
+    parser.add_argument('--archive-dir', metavar='FOLDER',
+                        help="сохранить синтетический архив в эту папку (по умолчанию удаляется)")
+    parser.add_argument('--days', type=int, default=30, help="число дней (файлов) в архиве (по умолчанию 30)")
+    parser.add_argument('--clients', type=int, default=40, help="число клиентов в файле (по умолчанию 40)")
+    parser.add_argument('--destinations', type=int, default=20,
+                        help=f"число мест доставки в файле, до {MAX_DESTINATIONS} (по умолчанию 20)")
+    parser.add_argument('--protected', type=float, default=0.0,
+                        help="доля файлов, защищенных паролем, от 0 до 1 (по умолчанию 0)")
+    parser.add_argument('--header-offset', type=int, default=0,
+                        help="число пустых строк над шапкой таблиц (по умолчанию 0)")
+    parser.add_argument('--seed', type=int, default=0, help="зерно генератора архива (по умолчанию 0)")
+    parser.add_argument('--repeat', type=int, default=3, help="число повторов замера (по умолчанию 3)")
+    parser.add_argument('--engine', choices=ENGINES, default='auto', help="движок чтения Excel (по умолчанию auto)")
+    parser.add_argument('--password', action='append', dest='passwords', metavar='PASSWORD',
+                        help="пароль для защищенных книг, можно указать несколько раз")
+    parser.add_argument('--parsers', action='store_true',
+                        help="только микро-замеры разбора температуры и дат")
+    args = parser.parse_args(argv)
+    if args.repeat < 1:
+        parser.error("--repeat должен быть не меньше 1")
+    return args
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """Точка входа: генерирует архив (если папка не указана), замеряет этапы и печатает сводку"""
+    args = parse_args(argv)
+
+    if args.parsers:
+        result = run_parser_benchmarks(args.results_dir, repeat=args.repeat)
+        print(f"Строк: {result['params']['rows']}, совпадает с прежним разбором: {result['matches_reference']}")
+        for name, seconds in result['stages'].items():
+            print(f"{name:>26}: {seconds * 1000:9.2f} мс")
+        print(f"\nРезультаты сохранены в {args.results_dir}")
+        return 0
+
+    params: Dict[str, Any] = {}
+    archive_dir = args.input
+    generated_dir = None
+    if archive_dir is None:
+        params = {'days': args.days, 'clients': args.clients, 'destinations': args.destinations,
+                  'protected': args.protected, 'header_offset': args.header_offset, 'seed': args.seed}
+        archive_dir = args.archive_dir or tempfile.mkdtemp(prefix='benchmark_archive_')
+        generated_dir = None if args.archive_dir else archive_dir
+        print(f"Генерация архива: {archive_dir}")
+        generate_archive(archive_dir, days=args.days, clients=args.clients, destinations=args.destinations,
+                         protected_ratio=args.protected, header_offset=args.header_offset, seed=args.seed)
+
+    try:
+        result = run_benchmark(archive_dir, args.results_dir, repeat=args.repeat, engine=args.engine,
+                               passwords=args.passwords, params=params)
+    finally:
+        if generated_dir:
+            shutil.rmtree(generated_dir, ignore_errors=True)
+
+    print(f"\nФайлов: {result['files']}, записей: {result['records']}, движок: {result['engine']}")
+    for stage in STAGES:
+        print(f"{stage:>16}: {result['stages'][stage]:8.3f} с")
+    print(f"{'total':>16}: {result['total_seconds']:8.3f} с ({result['files_per_second']:.2f} файлов/с)")
+    print(f"\nРезультаты сохранены в {args.results_dir}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -61,6 +61,8 @@ def build_exe():
         f"--add-data=requirements.txt{data_separator}.",  # Включаем requirements.txt
         "--hidden-import=pandas",
         "--hidden-import=openpyxl",
+        "--hidden-import=python_calamine",
+        "--hidden-import=msoffcrypto",
         "--hidden-import=pyarrow",
         "--hidden-import=fastparquet",
         "--hidden-import=xlrd",
@@ -28,6 +28,8 @@ def build_exe():
         "--add-data=requirements.txt;.",  # Включаем requirements.txt
         "--hidden-import=pandas",
         "--hidden-import=openpyxl",
+        "--hidden-import=python_calamine",
+        "--hidden-import=msoffcrypto",
         "--hidden-import=pyarrow",
         "--hidden-import=fastparquet",
         "--hidden-import=xlrd",
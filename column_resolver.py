@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Column mapping resolver for Dataset Builder
+Сопоставление заголовков листа с каноническими полями один раз на шаблон листа
+"""
+
+from functools import lru_cache
+from typing import Dict, Hashable, List, NamedTuple, Sequence, Tuple
+
+import pandas as pd
+
+# Правило: (каноническое поле, подстроки, которые все должны входить в заголовок)
+ColumnRule = Tuple[str, Tuple[str, ...]]
+
+
+class ColumnMapping(NamedTuple):
+    """Результат сопоставления заголовка: позиции канонических полей и дополнительных колонок"""
+    fields: Dict[str, int]
+    extras: Tuple[int, ...]
+
+
+class ColumnMappingResolver:
+    """Сопоставляет заголовок с каноническими полями с кешированием по кортежу заголовков"""
+
+    def __init__(self, rules: Sequence[ColumnRule], cache_size: int = 256):
+        self.rules = tuple(rules)
+        self.resolve = lru_cache(maxsize=cache_size)(self._resolve)
+
+    def _resolve(self, header: Tuple[Hashable, ...]) -> ColumnMapping:
+        """Первое подходящее правило для каждой колонки; при повторе поля побеждает последняя колонка"""
+        fields: Dict[str, int] = {}
+        for position, column in enumerate(header):
+            column_str = str(column).lower()
+            for field, keywords in self.rules:
+                if all(keyword in column_str for keyword in keywords):
+                    fields[field] = position
+                    break
+
+        # Дополнительные колонки сравниваются по названию, как и раньше
+        mapped_columns = [header[position] for position in fields.values()]
+        extras = tuple(position for position, column in enumerate(header) if column not in mapped_columns)
+        return ColumnMapping(fields, extras)
+
+    def apply(self, df: pd.DataFrame) -> pd.DataFrame:
+        """Переименовывает и отбирает колонки листа: сначала канонические поля, затем extra_*"""
+        mapping = self.resolve(tuple(df.columns))
+        positions: List[int] = list(mapping.fields.values()) + list(mapping.extras)
+        names = list(mapping.fields) + [f'extra_{df.columns[position]}' for position in mapping.extras]
+        return df.iloc[:, positions].set_axis(names, axis=1)
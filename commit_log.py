@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Commit log for Dataset Builder
+Фиксация результатов запуска: временные файлы сбрасываются на диск и заменяют итоговые по журналу фиксаций
+"""
+
+import json
+import os
+import shutil
+import time
+import uuid
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+COMMIT_LOG_PATH = "dataset_commits.jsonl"
+
+# При запуске в журнале остаются только последние записи
+COMMIT_LOG_KEEP_ENTRIES = 200
+
+
+def fsync_file(path: str):
+    """Сбрасывает содержимое файла на диск"""
+    with open(path, 'rb+') as f:
+        os.fsync(f.fileno())
+
+
+def fsync_dir(path: str):
+    """Сбрасывает на диск каталог (переименования в нем); в Windows каталог открыть нельзя, там это не нужно"""
+    try:
+        fd = os.open(path or '.', os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def write_synced(path: str, text: str):
+    """Записывает текстовый файл и сбрасывает его на диск"""
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def install(tmp_path: str, path: str):
+    """Заменяет итоговый файл (каталог) временным; прежний каталог сначала переносится в сторону"""
+    if os.path.isdir(tmp_path) and os.path.isdir(path):
+        old_path = f"{path}.old"
+        if os.path.isdir(old_path):
+            shutil.rmtree(old_path)
+        os.replace(path, old_path)
+    os.replace(tmp_path, path)
+    fsync_dir(os.path.dirname(path))
+    if os.path.isdir(f"{path}.old"):
+        shutil.rmtree(f"{path}.old")
+
+
+def atomic_write_text(path: str, text: str):
+    """Записывает текстовый файл целиком или не меняет его: через временный файл и замену"""
+    tmp_path = f"{path}.tmp"
+    write_synced(tmp_path, text)
+    install(tmp_path, path)
+
+
+class OutputTransaction:
+    """Набор временных файлов, которые заменяют итоговые одной фиксацией
+
+    Перед заменой в журнал записывается, какие файлы заменяются: если замена прервется,
+    CommitLog.recover при следующем запуске доведет ее до конца.
+    """
+
+    def __init__(self, log: 'CommitLog', **info):
+        self.log = log
+        self.info = info
+        self.staged: List[Tuple[str, str]] = []
+        self.prepared = False
+        self.committed = False
+
+    def stage(self, tmp_path: str, path: str):
+        """Добавляет в фиксацию временный файл (каталог), уже сброшенный на диск"""
+        self.staged.append((tmp_path, path))
+
+    def stage_text(self, path: str, text: str):
+        """Записывает временный текстовый файл и добавляет его в фиксацию"""
+        tmp_path = f"{path}.tmp"
+        write_synced(tmp_path, text)
+        self.stage(tmp_path, path)
+
+    def commit(self):
+        """Заменяет итоговые файлы временными и отмечает фиксацию в журнале"""
+        if self.committed or not self.staged:
+            self.committed = True
+            return
+
+        commit_id = uuid.uuid4().hex[:12]
+        files = {}
+        for tmp_path, path in self.staged:
+            size = None if os.path.isdir(tmp_path) else os.path.getsize(tmp_path)
+            files[self.log.relative(path)] = {'tmp': self.log.relative(tmp_path), 'bytes': size}
+        self.log.append({'event': 'prepare', 'commit_id': commit_id, 'files': files, **self.info})
+        self.prepared = True
+
+        for tmp_path, path in self.staged:
+            install(tmp_path, path)
+        self.log.append({'event': 'commit', 'commit_id': commit_id})
+        self.committed = True
+
+    def abort(self):
+        """Удаляет временные файлы, итоговые файлы не меняются"""
+        # Замена уже началась: ее завершит CommitLog.recover при следующем запуске
+        if self.prepared:
+            return
+        for tmp_path, _ in self.staged:
+            if os.path.isdir(tmp_path):
+                shutil.rmtree(tmp_path)
+            elif os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        self.staged = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.abort()
+
+
+class CommitLog:
+    """Журнал фиксаций JSONL: для каждой фиксации - заменяемые файлы и их размер
+
+    Пути в журнале хранятся относительно его каталога, поэтому папку результатов можно переносить.
+    """
+
+    def __init__(self, path: str = COMMIT_LOG_PATH):
+        self.path = path
+        self.base_dir = os.path.dirname(os.path.abspath(path))
+
+    def relative(self, path: str) -> str:
+        return os.path.relpath(os.path.abspath(path), self.base_dir)
+
+    def absolute(self, path: str) -> str:
+        return os.path.normpath(os.path.join(self.base_dir, path))
+
+    def transaction(self, **info) -> OutputTransaction:
+        """Новая фиксация; info (например, идентификатор запуска) записывается в журнал"""
+        return OutputTransaction(self, **info)
+
+    def append(self, entry: Dict[str, Any]):
+        """Дописывает запись и сбрасывает журнал на диск до продолжения фиксации"""
+        os.makedirs(self.base_dir, exist_ok=True)
+        line = json.dumps({'time': datetime.now().isoformat(timespec='seconds'), **entry}, ensure_ascii=False)
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(line + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def entries(self) -> List[Dict[str, Any]]:
+        """Записи журнала; недописанная при сбое последняя строка пропускается"""
+        if not os.path.exists(self.path):
+            return []
+
+        entries = []
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    continue
+        return entries
+
+    def pending(self) -> Optional[Dict[str, Any]]:
+        """Последняя фиксация, замена файлов которой не была завершена"""
+        finished = set()
+        for entry in reversed(self.entries()):
+            if entry.get('event') in ('commit', 'recover'):
+                finished.add(entry.get('commit_id'))
+            elif entry.get('event') == 'prepare':
+                return None if entry.get('commit_id') in finished else entry
+        return None
+
+    def recover(self) -> Optional[Dict[str, Any]]:
+        """Доводит до конца прерванную фиксацию и возвращает ее запись (None, если все фиксации завершены)
+
+        Временные файлы фиксации уже сброшены на диск до записи в журнал, поэтому оставшиеся
+        из них просто заменяют итоговые файлы.
+        """
+        entry = self.pending()
+        if entry is None:
+            self.compact()
+            return None
+
+        for path, file_info in entry['files'].items():
+            tmp_path = self.absolute(file_info['tmp'])
+            if os.path.exists(tmp_path):
+                install(tmp_path, self.absolute(path))
+            elif os.path.isdir(f"{self.absolute(path)}.old"):
+                shutil.rmtree(f"{self.absolute(path)}.old")
+        self.append({'event': 'recover', 'commit_id': entry['commit_id']})
+        return entry
+
+    def committed_files(self) -> Dict[str, Optional[int]]:
+        """Итоговые файлы и их размер по последним завершенным фиксациям"""
+        finished = {entry.get('commit_id') for entry in self.entries() if entry.get('event') in ('commit', 'recover')}
+        files = {}
+        for entry in self.entries():
+            if entry.get('event') == 'prepare' and entry.get('commit_id') in finished:
+                files.update({self.absolute(path): info.get('bytes') for path, info in entry['files'].items()})
+        return files
+
+    def verify(self) -> List[str]:
+        """Итоговые файлы, размер которых не совпадает с зафиксированным (поврежденные или измененные вне сборщика)"""
+        return [path for path, size in self.committed_files().items()
+                if size is not None and os.path.isfile(path) and os.path.getsize(path) != size]
+
+    def compact(self, keep: int = COMMIT_LOG_KEEP_ENTRIES):
+        """Оставляет в журнале только последние keep записей"""
+        entries = self.entries()
+        if len(entries) <= keep:
+            return
+        text = ''.join(json.dumps(entry, ensure_ascii=False) + '\n' for entry in entries[-keep:])
+        atomic_write_text(self.path, text)
+
+
+class CheckpointSchedule:
+    """Определяет, пора ли зафиксировать промежуточные результаты: каждые every_files файлов или every_seconds секунд
+
+    Без обоих порогов контрольные точки не создаются.
+    """
+
+    def __init__(self, every_files: Optional[int] = None, every_seconds: Optional[float] = None,
+                 clock: Callable[[], float] = time.monotonic):
+        self.every_files = every_files or None
+        self.every_seconds = every_seconds or None
+        self.clock = clock
+        self.reset()
+
+    @property
+    def enabled(self) -> bool:
+        """Создаются ли контрольные точки"""
+        return self.every_files is not None or self.every_seconds is not None
+
+    def reset(self):
+        """Начинает отсчет заново (после контрольной точки)"""
+        self.files = 0
+        self.started = self.clock()
+
+    def file_done(self) -> bool:
+        """Учитывает обработанный файл; True - пора создать контрольную точку"""
+        self.files += 1
+        if self.every_files is not None and self.files >= self.every_files:
+            return True
+        return self.every_seconds is not None and self.clock() - self.started >= self.every_seconds
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Credential resolver for Dataset Builder
+Определение зашифрованных книг по заголовку файла и подбор пароля один раз на файл
+"""
+
+import io
+import os
+from typing import Dict, Iterable, List, Optional, Union
+
+# Книга .xlsx/.xlsm - это zip-архив; зашифрованная книга хранится в контейнере OLE
+OLE_SIGNATURE = b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1'
+ZIP_SIGNATURE = b'PK\x03\x04'
+
+# Пароли, которые пробуются по умолчанию
+DEFAULT_PASSWORDS = ['Test']
+
+
+def is_encrypted(file_path: str) -> bool:
+    """Проверяет по первым байтам файла, зашифрована ли книга (контейнер OLE вместо zip)"""
+    with open(file_path, 'rb') as f:
+        return f.read(len(OLE_SIGNATURE)) == OLE_SIGNATURE
+
+
+def decrypt_workbook(file_path: str, password: str) -> io.BytesIO:
+    """Расшифровывает книгу в буфер в памяти; при неверном пароле вызывает исключение"""
+    try:
+        import msoffcrypto
+    except ImportError:
+        raise RuntimeError("для открытия файлов с паролем нужен пакет msoffcrypto-tool")
+
+    decrypted = io.BytesIO()
+    with open(file_path, 'rb') as f:
+        office_file = msoffcrypto.OfficeFile(f)
+        office_file.load_key(password=password, verify_password=True)
+        office_file.decrypt(decrypted)
+    decrypted.seek(0)
+    return decrypted
+
+
+class CredentialResolver:
+    """Подбирает пароль к зашифрованным книгам и запоминает подошедший пароль для папки
+
+    Незашифрованная книга открывается по пути без попыток расшифровки. Для зашифрованной
+    сначала пробуется пароль, подошедший к другим файлам этой папки, затем остальные по порядку.
+    """
+
+    def __init__(self, passwords: Optional[Iterable[str]] = None):
+        self.passwords: List[str] = list(passwords) if passwords is not None else list(DEFAULT_PASSWORDS)
+        # Папка -> пароль, подошедший к файлам этой папки
+        self.known_passwords: Dict[str, str] = {}
+
+    def candidates(self, file_path: str) -> List[str]:
+        """Пароли в порядке проверки для файла"""
+        known = self.known_passwords.get(os.path.dirname(os.path.abspath(file_path)))
+        if known is None:
+            return list(self.passwords)
+        return [known] + [password for password in self.passwords if password != known]
+
+    def decrypt(self, file_path: str) -> io.BytesIO:
+        """Расшифровывает книгу первым подходящим паролем и запоминает его для папки"""
+        for password in self.candidates(file_path):
+            try:
+                decrypted = decrypt_workbook(file_path, password)
+            except RuntimeError:
+                raise
+            except Exception:
+                continue
+            self.known_passwords[os.path.dirname(os.path.abspath(file_path))] = password
+            return decrypted
+
+        raise ValueError(f"ни один из паролей ({len(self.passwords)}) не подошел к файлу {os.path.basename(file_path)}")
+
+    def open_source(self, file_path: str) -> Union[str, io.BytesIO]:
+        """Источник для чтения книги: путь к файлу или расшифрованный буфер"""
+        if not is_encrypted(file_path):
+            return file_path
+        return self.decrypt(file_path)
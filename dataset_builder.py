@@ -6,180 +6,221 @@ Dataset Builder for Logistics Routes
 """
 
 import os
-import re
+import sys
+import argparse
+import numpy as np
 import pandas as pd
-import glob
-from datetime import datetime
+import pyarrow.parquet as pq
 from pathlib import Path
 import warnings
+from credential_resolver import CredentialResolver
+from workbook_reader import ENGINES, WorkbookHandle, resolve_engine
+from parsers import DDMMYYYY_PATTERN, parse_filename_date, parse_temperature, parse_temperatures
+from column_resolver import ColumnMappingResolver
+from commit_log import COMMIT_LOG_PATH, CheckpointSchedule, CommitLog
+from dataset_schema import DATASET_SCHEMA, frame_to_table
+from dataset_writer import StreamingDatasetWriter, iter_dataset_tables
+from file_scanner import EXCEL_FILE_PATTERNS, SCAN_CACHE_PATH, DirectoryScanCache, scan_excel_files
+from join_index import join_key, first_match_index, append_unmatched
+from processing_manifest import MANIFEST_PATH, ProcessingManifest, STATUS_CHANGED, STATUS_UNCHANGED, content_signature
 warnings.filterwarnings('ignore')
 
+# Число читаемых колонок листа: в 'Pallet Order' используются только колонки A-Z
+SHEET_MAX_COLUMNS = {'Pallet Order': 26}
+
+# Колонки заказов из листа 'Pallet Order'
+PALLET_ORDER_COLUMNS = ['Date', 'Client_Name', 'Delivery_Name', 'Pallets_Ordered', 'Temperature', 'Source_Sheet']
+
+# Канонические поля листа 'Collection Plan' и ключевые слова их заголовков
+COLLECTION_PLAN_COLUMNS = ColumnMappingResolver([
+    ('load_number', ('load', 'number')),
+    ('collection_site', ('collection', 'site')),
+    ('delivery_destination', ('delivery', 'destination')),
+    ('pallets_ordered', ('pallets', 'ordered')),
+    ('pallet_type', ('pallet', 'type')),
+    ('trailer_type', ('trailer', 'type')),
+    ('trailer_fill', ('trailer', 'fill')),
+])
+
+# Коды завершения для запуска из планировщика
+EXIT_OK = 0
+EXIT_FAILURE = 1        # критическая ошибка
+EXIT_USAGE = 2          # неверные аргументы или папка не найдена (как у argparse)
+EXIT_FILE_ERRORS = 3    # обработка завершена, но часть файлов не обработана
+EXIT_INTERRUPTED = 130  # прервано пользователем (Ctrl+C)
+
 class DatasetBuilder:
-    def __init__(self):
+    # Версия логики разбора: при ее изменении все файлы будут обработаны заново
+    PARSER_VERSION = 'dataset_builder/1'
+    
+    def __init__(self, engine='auto', passwords=None, output_dir='.', incremental=True, write_csv=True, reprocess=None,
+                 checkpoint_files=None, checkpoint_seconds=None):
+        # Движок чтения Excel ('auto' - calamine, если установлен, иначе openpyxl)
+        self.engine = resolve_engine(engine)
+        # Пароли для защищенных книг (по умолчанию 'Test'); подошедший пароль запоминается для папки
+        self.credentials = CredentialResolver(passwords)
+        # Только новые записи текущего запуска; существующий датасет читается при сохранении
         self.combined_data = []
         self.existing_files = set()
-        self.load_existing_dataset()
+        self.changed_files = set()
+        # Имена файлов и даты (YYYY-MM-DD), файлы которых нужно обработать заново, даже если они не менялись
+        self.reprocess = set(reprocess or ())
+        # Выходные файлы в папке output_dir
+        self.output_dir = output_dir
+        self.write_csv = write_csv
+        self.csv_path = os.path.normpath(os.path.join(output_dir, "combined_dataset.csv"))
+        self.parquet_path = os.path.normpath(os.path.join(output_dir, "combined_dataset.parquet"))
+        self.manifest = ProcessingManifest(os.path.normpath(os.path.join(output_dir, MANIFEST_PATH)))
+        self.scan_cache = DirectoryScanCache(os.path.normpath(os.path.join(output_dir, SCAN_CACHE_PATH)))
+        # Журнал фиксаций: датасет и манифест заменяются вместе после сброса на диск
+        self.commit_log = CommitLog(os.path.normpath(os.path.join(output_dir, COMMIT_LOG_PATH)))
+        # Контрольные точки длинного запуска: обработанные файлы фиксируются каждые N файлов или T секунд
+        self.checkpoints = CheckpointSchedule(checkpoint_files, checkpoint_seconds)
+        self.recover_outputs()
+        # Инкрементальный запуск дополняет датасет; полный - пересобирает его из всех файлов
+        self.incremental = incremental
+        if incremental:
+            self.load_scan_cache()
+            self.load_manifest()
+            self.load_existing_dataset()
+    
+    def recover_outputs(self):
+        """Завершает фиксацию, прерванную сбоем прошлого запуска, и проверяет зафиксированные файлы"""
+        try:
+            entry = self.commit_log.recover()
+            if entry is not None:
+                print(f"Завершена прерванная фиксация {entry['commit_id']}: {', '.join(entry['files'])}")
+            for path in self.commit_log.verify():
+                print(f"Размер файла {path} не совпадает с зафиксированным: файл поврежден или изменен вне сборщика")
+        except Exception as e:
+            print(f"Ошибка проверки журнала фиксаций: {e}")
+    
+    def load_scan_cache(self):
+        """Загружает кеш сканирования папок"""
+        try:
+            self.scan_cache.load()
+        except Exception as e:
+            print(f"Кеш сканирования папок не загружен: {e}")
+    
+    def load_manifest(self):
+        """Загружает манифест обработанных файлов"""
+        try:
+            if self.manifest.load():
+                print(f"Загружен манифест: {len(self.manifest)} обработанных файлов")
+        except Exception as e:
+            print(f"Ошибка загрузки манифеста: {e}")
     
     def load_existing_dataset(self):
-        """Загружает существующий датасет для добавления новых данных"""
-        csv_path = "combined_dataset.csv"
-        parquet_path = "combined_dataset.parquet"
-        
-        if os.path.exists(csv_path):
+        """Проверяет существующий датасет, не читая его записи"""
+        if os.path.exists(self.parquet_path):
             try:
-                existing_df = pd.read_csv(csv_path)
-                self.combined_data = existing_df.to_dict('records')
-                print(f"Загружен существующий датасет: {len(self.combined_data)} записей")
-            except Exception as e:
-                print(f"Ошибка загрузки существующего датасета: {e}")
-        elif os.path.exists(parquet_path):
-            try:
-                existing_df = pd.read_parquet(parquet_path)
-                self.combined_data = existing_df.to_dict('records')
-                print(f"Загружен существующий датасет: {len(self.combined_data)} записей")
+                # Число записей берется из метаданных Parquet
+                print(f"Найден существующий датасет: {pq.read_metadata(self.parquet_path).num_rows} записей")
             except Exception as e:
                 print(f"Ошибка загрузки существующего датасета: {e}")
+        elif os.path.exists(self.csv_path):
+            print(f"Найден существующий датасет: {self.csv_path}")
+        elif len(self.manifest):
+            # Датасет удален - все файлы нужно обработать заново
+            print("Датасет не найден, манифест сброшен")
+            self.manifest.reset()
+    
+    def reprocess_requested(self, filename):
+        """Проверяет, указан ли файл для повторной обработки по имени или по дате"""
+        if not self.reprocess:
+            return False
+        return filename in self.reprocess or self.extract_date_from_filename(filename) in self.reprocess
     
     def extract_date_from_filename(self, filename):
         """Извлекает дату из имени файла"""
         # Ищем паттерн DDMMYYYY в имени файла
-        pattern = r'(\d{2})(\d{2})(\d{4})'
-        match = re.search(pattern, filename)
-        
-        if match:
-            day, month, year = match.groups()
-            try:
-                date_obj = datetime(int(year), int(month), int(day))
-                return date_obj.strftime('%Y-%m-%d')
-            except ValueError:
-                return None
-        return None
+        return parse_filename_date(filename, (DDMMYYYY_PATTERN,))
     
     def extract_temperature(self, client_name):
         """Извлекает температуру из названия клиента"""
-        if client_name and isinstance(client_name, str):
-            # Паттерны для поиска температуры
-            temp_patterns = [
-                r'\(\+(\d+)°C\)',
-                r'\+(\d+)°C',
-                r'(\d+)°C',
-                r'(\d+)C',
-            ]
-            
-            for pattern in temp_patterns:
-                temp_match = re.search(pattern, client_name, re.IGNORECASE)
-                if temp_match:
-                    return f"+{temp_match.group(1)}°C"
-        return "+3°C"  # По умолчанию
+        return parse_temperature(client_name)
     
-    def read_excel_sheet(self, file_path, sheet_name, password=None):
-        """Читает лист Excel с возможностью ввода пароля"""
+    def open_workbook(self, file_path, password=None):
+        """Открывает книгу Excel один раз (зашифрованная книга расшифровывается подобранным паролем)"""
+        filename = os.path.basename(file_path)
         try:
-            if password:
-                return pd.read_excel(file_path, sheet_name=sheet_name, password=password)
-            else:
-                return pd.read_excel(file_path, sheet_name=sheet_name)
+            workbook = WorkbookHandle(file_path, password=password, engine=self.engine, credentials=self.credentials)
+            if workbook.encrypted:
+                print(f"Файл {filename} защищен паролем и расшифрован")
+            return workbook
         except Exception as e:
-            if "password" in str(e).lower():
-                print(f"Лист {sheet_name} защищен паролем. Пробуем с паролем 'Test'...")
+            print(f"Ошибка открытия файла {filename}: {e}")
+            # Файл, который не удалось открыть, не отмечается обработанным
+            raise
+    
+    def read_excel_sheets(self, file_path, sheet_names, password=None):
+        """Читает несколько листов Excel из одной загрузки книги"""
+        sheets = {sheet_name: None for sheet_name in sheet_names}
+        
+        workbook = self.open_workbook(file_path, password)
+        
+        with workbook:
+            for sheet_name in sheet_names:
+                if not workbook.has_sheet(sheet_name):
+                    print(f"Лист {sheet_name} не найден в файле {os.path.basename(file_path)}")
+                    continue
                 try:
-                    return pd.read_excel(file_path, sheet_name=sheet_name, password="Test")
-                except Exception as e2:
-                    print(f"Не удалось открыть лист {sheet_name} даже с паролем: {e2}")
-                    return None
-            else:
-                print(f"Ошибка чтения листа {sheet_name}: {e}")
-                return None
+                    sheets[sheet_name] = workbook.read_sheet(sheet_name, SHEET_MAX_COLUMNS.get(sheet_name))
+                except Exception as e:
+                    # Лист, который не удалось прочитать, - ошибка всего файла: файл будет обработан повторно
+                    print(f"Ошибка чтения листа {sheet_name}: {e}")
+                    raise
+        
+        return sheets
+    
+    def read_excel_sheet(self, file_path, sheet_name, password=None):
+        """Читает лист Excel с возможностью ввода пароля"""
+        return self.read_excel_sheets(file_path, [sheet_name], password)[sheet_name]
+    
+    def extract_temperatures(self, client_names):
+        """Извлекает температуру для колонки названий клиентов: каждое уникальное название разбирается один раз"""
+        return parse_temperatures(client_names)
     
     def process_pallet_order_sheet(self, df, file_date):
         """Обрабатывает лист 'Pallet Order'"""
-        orders = []
-        
         if df is None or df.empty:
-            return orders
+            return pd.DataFrame(columns=PALLET_ORDER_COLUMNS)
         
         # Ищем строки с заказами (клиенты в колонке A)
-        for idx, row in df.iterrows():
-            client_name = row.iloc[0] if len(row) > 0 else None
-            
-            # Пропускаем пустые строки и заголовки
-            if pd.isna(client_name) or not isinstance(client_name, str) or client_name.strip() == "":
-                continue
-            
-            # Извлекаем температуру
-            temperature = self.extract_temperature(client_name)
-            
-            # Обрабатываем колонки B-Z для заказов
-            for col_idx in range(1, min(26, len(row))):  # B-Z (колонки 1-25)
-                delivery_name = df.iloc[0, col_idx] if len(df) > 0 else None  # Заголовок колонки
-                pallet_count = row.iloc[col_idx] if col_idx < len(row) else None
-                
-                # Пропускаем пустые заказы
-                if pd.isna(pallet_count) or pallet_count == 0:
-                    continue
-                
-                order = {
-                    'Date': file_date,
-                    'Client_Name': client_name,
-                    'Delivery_Name': delivery_name,
-                    'Pallets_Ordered': pallet_count,
-                    'Temperature': temperature,
-                    'Source_Sheet': 'Pallet Order'
-                }
-                orders.append(order)
-        
-        return orders
+        client_names = df.iloc[:, 0].astype(object)
+        stripped_names = client_names.map(lambda v: v.strip() if isinstance(v, str) else None)
+        valid_clients = (stripped_names.notna() & stripped_names.ne('')).to_numpy()
+        
+        # Обрабатываем колонки B-Z для заказов, пропуская пустые заказы
+        pallet_counts = df.iloc[:, 1:26]
+        mask = (pallet_counts.notna() & pallet_counts.ne(0)).to_numpy() & valid_clients[:, None]
+        rows, columns = np.nonzero(mask)
+        
+        # Заголовок колонки берется из первой строки листа
+        delivery_names = pallet_counts.iloc[0].to_numpy(dtype=object)
+        temperatures = self.extract_temperatures(client_names).to_numpy(dtype=object)
+        
+        return pd.DataFrame({
+            'Date': file_date,
+            'Client_Name': client_names.to_numpy(dtype=object)[rows],
+            'Delivery_Name': delivery_names[columns],
+            'Pallets_Ordered': pallet_counts.to_numpy(dtype=object)[rows, columns],
+            'Temperature': temperatures[rows],
+            'Source_Sheet': 'Pallet Order'
+        }, columns=PALLET_ORDER_COLUMNS)
     
     def process_collection_plan_sheet(self, df, file_date):
         """Обрабатывает лист 'Collection Plan'"""
-        deliveries = []
-        
         if df is None or df.empty:
-            return deliveries
-        
-        # Ищем колонки по названиям
-        columns = df.columns.tolist()
-        column_mapping = {}
-        
-        for col in columns:
-            col_str = str(col).lower()
-            if 'load' in col_str and 'number' in col_str:
-                column_mapping['load_number'] = col
-            elif 'collection' in col_str and 'site' in col_str:
-                column_mapping['collection_site'] = col
-            elif 'delivery' in col_str and 'destination' in col_str:
-                column_mapping['delivery_destination'] = col
-            elif 'pallets' in col_str and 'ordered' in col_str:
-                column_mapping['pallets_ordered'] = col
-            elif 'pallet' in col_str and 'type' in col_str:
-                column_mapping['pallet_type'] = col
-            elif 'trailer' in col_str and 'type' in col_str:
-                column_mapping['trailer_type'] = col
-            elif 'trailer' in col_str and 'fill' in col_str:
-                column_mapping['trailer_fill'] = col
-        
-        # Обрабатываем каждую строку как отдельную доставку
-        for idx, row in df.iterrows():
-            # Пропускаем пустые строки
-            if row.isna().all():
-                continue
-            
-            delivery = {
-                'Date': file_date,
-                'Source_Sheet': 'Collection Plan'
-            }
-            
-            # Заполняем данные из найденных колонок
-            for field, col in column_mapping.items():
-                if col in df.columns and idx < len(df):
-                    delivery[field] = row[col]
-            
-            # Добавляем все остальные колонки
-            for col in df.columns:
-                if col not in column_mapping.values() and idx < len(df):
-                    delivery[f'extra_{col}'] = row[col]
-            
-            deliveries.append(delivery)
+            return pd.DataFrame(columns=['Date', 'Source_Sheet'])
+        
+        # Пропускаем пустые строки
+        df = df[~df.isna().all(axis=1).to_numpy()]
+        
+        # Ищем колонки по названиям (один раз на шаблон листа), остальные колонки добавляем как extra_*
+        deliveries = COLLECTION_PLAN_COLUMNS.apply(df).reset_index(drop=True)
+        deliveries.insert(0, 'Date', file_date)
+        deliveries.insert(1, 'Source_Sheet', 'Collection Plan')
         
         return deliveries
     
@@ -187,23 +228,19 @@ class DatasetBuilder:
         """Объединяет данные из 'Pallet Order' и 'Collection Plan'"""
         merged_data = []
         
-        # Создаем словарь доставок по Load Number
-        delivery_dict = {}
-        for delivery in deliveries:
-            load_number = delivery.get('load_number')
-            if load_number:
-                delivery_dict[load_number] = delivery
+        if isinstance(orders, pd.DataFrame):
+            orders = orders.to_dict('records')
+        if isinstance(deliveries, pd.DataFrame):
+            deliveries = deliveries.to_dict('records')
+        
+        # Индекс доставок по (месту доставки, количеству паллет): первая подходящая доставка
+        delivery_index = first_match_index(deliveries, ['delivery_destination', 'pallets_ordered'])
         
         # Объединяем заказы с доставками
         for order in orders:
-            # Ищем подходящую доставку (можно улучшить логику сопоставления)
-            best_match = None
-            for delivery in deliveries:
-                # Простая логика сопоставления по количеству паллет
-                if (order.get('Pallets_Ordered') == delivery.get('pallets_ordered') and
-                    order.get('Delivery_Name') == delivery.get('delivery_destination')):
-                    best_match = delivery
-                    break
+            # Простая логика сопоставления по месту доставки и количеству паллет
+            key = join_key(order.get('Delivery_Name'), order.get('Pallets_Ordered'))
+            best_match = delivery_index.get(key) if key is not None else None
             
             if best_match:
                 # Объединяем данные
@@ -214,9 +251,7 @@ class DatasetBuilder:
                 merged_data.append(order)
         
         # Добавляем доставки без сопоставленных заказов
-        for delivery in deliveries:
-            if not any(d.get('load_number') == delivery.get('load_number') for d in merged_data):
-                merged_data.append(delivery)
+        append_unmatched(merged_data, deliveries, 'load_number')
         
         return merged_data
     
@@ -232,112 +267,213 @@ class DatasetBuilder:
             print(f"Не удалось извлечь дату из имени файла: {filename}")
             return []
         
-        # Читаем лист 'Pallet Order'
-        pallet_order_df = self.read_excel_sheet(file_path, 'Pallet Order')
-        orders = self.process_pallet_order_sheet(pallet_order_df, file_date)
+        # Читаем оба листа из одной загрузки книги
+        sheets = self.read_excel_sheets(file_path, ['Pallet Order', 'Collection Plan'])
+        
+        # Обрабатываем лист 'Pallet Order'
+        orders = self.process_pallet_order_sheet(sheets['Pallet Order'], file_date)
         
-        # Читаем лист 'Collection Plan'
-        collection_plan_df = self.read_excel_sheet(file_path, 'Collection Plan')
-        deliveries = self.process_collection_plan_sheet(collection_plan_df, file_date)
+        # Обрабатываем лист 'Collection Plan'
+        deliveries = self.process_collection_plan_sheet(sheets['Collection Plan'], file_date)
         
         # Объединяем данные
         merged_data = self.merge_orders_and_deliveries(orders, deliveries)
         
+        # Запоминаем исходный файл, чтобы при его изменении заменить именно эти записи
+        for record in merged_data:
+            record['Source_File'] = filename
+        
         print(f"Извлечено {len(orders)} заказов, {len(deliveries)} доставок, {len(merged_data)} объединенных записей")
         return merged_data
     
     def find_excel_files(self, year_folder):
         """Находит все Excel файлы с маршрутами в указанной папке"""
-        patterns = [
-            os.path.join(year_folder, "**", "Lyons collections*.xlsx"),
-            os.path.join(year_folder, "**", "Lyons collections*.xlsm")
-        ]
-        
-        excel_files = []
-        for pattern in patterns:
-            files = glob.glob(pattern, recursive=True)
-            excel_files.extend(files)
-        
-        # Убираем дубликаты и сортируем
-        excel_files = list(set(excel_files))
-        excel_files.sort()
+        # Один проход по дереву папок; неизмененные папки берутся из кеша сканирования
+        excel_files = scan_excel_files(year_folder, EXCEL_FILE_PATTERNS, self.scan_cache)
+        self.scan_cache.save()
         
         return excel_files
     
-    def save_dataset(self):
-        """Сохраняет датасет в CSV и Parquet форматах"""
-        if not self.combined_data:
-            print("Нет данных для сохранения")
+    def save_dataset(self, transaction=None):
+        """Сохраняет датасет в CSV и Parquet форматах (при фиксации transaction, если она указана)"""
+        if not self.combined_data and not self.changed_files:
+            print("Нет новых данных для сохранения")
             return
         
-        df = pd.DataFrame(self.combined_data)
+        # Приводим новые записи к схеме датасета: постоянные колонки и компактные типы
+        table = frame_to_table(pd.DataFrame(self.combined_data))
         
-        # Сохраняем в CSV
-        csv_path = "combined_dataset.csv"
-        df.to_csv(csv_path, index=False, encoding='utf-8')
-        print(f"Датасет сохранен в CSV: {csv_path}")
+        # Существующие записи переписываются пакетами, без записей измененных файлов;
+        # итоговые файлы заменяются только после успешной записи
+        csv_path = self.csv_path if self.write_csv else None
+        with StreamingDatasetWriter(self.parquet_path, csv_path, transaction) as writer:
+            if self.incremental:
+                for existing_table in iter_dataset_tables(self.parquet_path, self.csv_path, self.changed_files):
+                    writer.write_table(existing_table)
+            writer.write_table(table)
         
-        # Сохраняем в Parquet
-        parquet_path = "combined_dataset.parquet"
-        df.to_parquet(parquet_path, index=False)
-        print(f"Датасет сохранен в Parquet: {parquet_path}")
+        if self.write_csv:
+            print(f"Датасет сохранен в CSV: {self.csv_path}")
+        print(f"Датасет сохранен в Parquet: {self.parquet_path}")
         
-        print(f"Всего записей в датасете: {len(df)}")
-        print(f"Колонки: {list(df.columns)}")
+        print(f"Всего записей в датасете: {writer.rows_written}")
+        print(f"Колонки: {DATASET_SCHEMA.names}")
     
-    def run(self):
-        """Основной метод запуска"""
-        print("=== Dataset Builder for Logistics Routes ===")
-        print("Сбор данных из Excel-файлов с ежедневными маршрутами")
-        print()
+    def checkpoint(self):
+        """Контрольная точка: фиксирует датасет с записями обработанных файлов и манифест"""
+        with self.commit_log.transaction() as transaction:
+            self.save_dataset(transaction)
+            self.manifest.save(transaction)
         
-        # Запрашиваем путь к папке с годом
+        # Зафиксированные записи дальше читаются из датасета, даже при полной пересборке
+        self.combined_data = []
+        self.changed_files = set()
+        self.incremental = True
+        self.checkpoints.reset()
+        print(f"Контрольная точка: зафиксировано обработанных файлов - {len(self.manifest)}")
+    
+    def prompt_year_path(self):
+        """Запрашивает у пользователя путь к папке с годом"""
         while True:
             year_path = input("Введите путь к папке с годом (например, W:\\Customers\\Natures Way reports\\Archive\\2024): ").strip()
             
             if os.path.exists(year_path):
-                break
+                return year_path
             else:
                 print(f"Папка не найдена: {year_path}")
                 print("Попробуйте еще раз или нажмите Ctrl+C для выхода")
+    
+    def run(self, input_roots=None):
+        """Основной метод запуска; возвращает код завершения"""
+        print("=== Dataset Builder for Logistics Routes ===")
+        print("Сбор данных из Excel-файлов с ежедневными маршрутами")
+        print()
+        
+        # Без указанных папок запрашиваем путь к папке с годом
+        if input_roots is None:
+            input_roots = [self.prompt_year_path()]
+        
+        missing_roots = [root for root in input_roots if not os.path.isdir(root)]
+        if missing_roots:
+            print(f"Папки не найдены: {', '.join(missing_roots)}")
+            return EXIT_USAGE
         
         # Находим Excel файлы
-        excel_files = self.find_excel_files(year_path)
+        excel_files = sorted(set(file_path for root in input_roots for file_path in self.find_excel_files(root)))
         
         if not excel_files:
-            print(f"Excel файлы не найдены в папке: {year_path}")
-            return
+            print(f"Excel файлы не найдены в папках: {', '.join(input_roots)}")
+            return EXIT_OK
         
+        os.makedirs(self.output_dir, exist_ok=True)
         print(f"Найдено {len(excel_files)} Excel файлов")
+        print(f"Движок чтения Excel: {self.engine}")
         
-        # Обрабатываем каждый файл
+        # Обрабатываем только новые и измененные файлы
         new_records = 0
+        skipped_files = 0
+        failed_files = 0
+        self.checkpoints.reset()
         for file_path in excel_files:
+            filename = os.path.basename(file_path)
             try:
+                status = self.manifest.file_status(file_path, self.PARSER_VERSION)
+                if status == STATUS_UNCHANGED:
+                    if not self.reprocess_requested(filename):
+                        skipped_files += 1
+                        continue
+                    print(f"Файл {filename} указан для повторной обработки, заменяем его записи")
+                    status = STATUS_CHANGED
+                elif status == STATUS_CHANGED:
+                    print(f"Файл {filename} изменился, заменяем его записи")
+                
+                # Подпись для манифеста снимается до разбора: файл, перезаписанный во время разбора, обработается заново
+                signature = self.manifest.checked_signature(file_path) or content_signature(file_path)
                 file_records = self.process_excel_file(file_path)
+                
+                # Измененный файл: старые записи заменяются новыми при сохранении
+                if status == STATUS_CHANGED:
+                    self.changed_files.add(filename)
+                
                 self.combined_data.extend(file_records)
+                self.manifest.record(file_path, len(file_records), self.PARSER_VERSION, signature)
                 new_records += len(file_records)
             except Exception as e:
                 print(f"Ошибка обработки файла {file_path}: {e}")
+                failed_files += 1
+            
+            if self.checkpoints.file_done():
+                self.checkpoint()
         
-        print(f"\nОбработано файлов: {len(excel_files)}")
+        print(f"\nОбработано файлов: {len(excel_files) - skipped_files}")
+        print(f"Пропущено уже обработанных файлов: {skipped_files}")
         print(f"Добавлено новых записей: {new_records}")
         
-        # Сохраняем датасет
-        self.save_dataset()
+        # Сохраняем датасет и манифест одной фиксацией: прерванный запуск не портит существующие файлы
+        with self.commit_log.transaction() as transaction:
+            self.save_dataset(transaction)
+            self.manifest.save(transaction)
         
         print("\nОбработка завершена!")
+        
+        if failed_files:
+            print(f"Файлов с ошибками: {failed_files}")
+            return EXIT_FILE_ERRORS
+        return EXIT_OK
 
-def main():
-    """Точка входа в программу"""
+def parse_args(argv=None):
+    """Разбирает аргументы командной строки"""
+    parser = argparse.ArgumentParser(
+        description="Сбор данных из Excel-файлов с ежедневными маршрутами. "
+                    "Без указанных папок путь запрашивается интерактивно.")
+    parser.add_argument('inputs', nargs='*', metavar='FOLDER',
+                        help="папки с Excel-файлами (например, папка с годом)")
+    parser.add_argument('-o', '--output-dir', default='.',
+                        help="папка для датасета и манифеста (по умолчанию текущая)")
+    parser.add_argument('--full', action='store_true',
+                        help="пересобрать датасет из всех файлов вместо инкрементального дополнения")
+    parser.add_argument('--reprocess', action='append', metavar='FILE_OR_DATE',
+                        help="обработать заново файл (имя файла или дата YYYY-MM-DD) и заменить его записи, "
+                             "можно указать несколько раз")
+    parser.add_argument('--checkpoint-files', type=int, default=0, metavar='N',
+                        help="фиксировать датасет и манифест каждые N обработанных файлов (по умолчанию 0 - нет)")
+    parser.add_argument('--checkpoint-seconds', type=float, default=600.0, metavar='SECONDS',
+                        help="фиксировать датасет и манифест не реже чем раз в SECONDS секунд обработки, "
+                             "0 - только в конце запуска (по умолчанию 600)")
+    parser.add_argument('--format', choices=('parquet', 'csv+parquet'), default='csv+parquet',
+                        help="форматы выходных файлов (по умолчанию csv+parquet)")
+    parser.add_argument('--engine', choices=ENGINES, default='auto',
+                        help="движок чтения Excel (по умолчанию auto)")
+    parser.add_argument('--password', action='append', dest='passwords', metavar='PASSWORD',
+                        help="пароль для защищенных книг, можно указать несколько раз")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    """Точка входа в программу; возвращает код завершения"""
+    args = parse_args(argv)
+    # Без указанных папок - интерактивный режим с запросом пути и паузой после ошибки
+    interactive = not args.inputs
+    
     try:
-        builder = DatasetBuilder()
-        builder.run()
+        builder = DatasetBuilder(
+            engine=args.engine,
+            passwords=args.passwords,
+            output_dir=args.output_dir,
+            incremental=not args.full,
+            write_csv=args.format == 'csv+parquet',
+            reprocess=args.reprocess,
+            checkpoint_files=args.checkpoint_files,
+            checkpoint_seconds=args.checkpoint_seconds,
+        )
+        return builder.run(args.inputs or None)
     except KeyboardInterrupt:
         print("\nПрограмма прервана пользователем")
+        return EXIT_INTERRUPTED
     except Exception as e:
         print(f"Критическая ошибка: {e}")
-        input("Нажмите Enter для выхода...")
+        if interactive:
+            input("Нажмите Enter для выхода...")
+        return EXIT_FAILURE
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
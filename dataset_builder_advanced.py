@@ -6,14 +6,40 @@ Advanced Dataset Builder for Logistics Routes
 """
 
 import os
-import re
+import numpy as np
 import pandas as pd
-import glob
-from datetime import datetime
+import pyarrow as pa
+import pyarrow.parquet as pq
+import shutil
+import sys
+import time
+import argparse
 from pathlib import Path
 import warnings
 import logging
-from typing import List, Dict, Any, Optional
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from itertools import islice
+from types import SimpleNamespace
+from typing import List, Dict, Any, Optional, Iterable, Iterator, Tuple, Union
+from credential_resolver import CredentialResolver
+from workbook_reader import ENGINES, WorkbookHandle, resolve_engine
+from parsers import parse_filename_date, parse_temperature, parse_temperatures
+from column_resolver import ColumnMappingResolver
+from commit_log import COMMIT_LOG_PATH, CheckpointSchedule, CommitLog, OutputTransaction, install
+from header_detector import HeaderDetector, HeaderMatch
+from dataset_schema import DATASET_SCHEMA, frame_to_table, records_to_table
+from dataset_store import STORE_PATH, DatasetStore
+from dataset_writer import (StreamingDatasetWriter, PartitionedDatasetWriter, checkpoint_parts, iter_dataset_tables,
+                            iter_source_tables, split_sources, write_checkpoint_part)
+from folder_watcher import FolderWatcher
+from file_scanner import EXCEL_FILE_PATTERNS, SCAN_CACHE_PATH, DirectoryScanCache, scan_excel_files
+from join_index import join_key, first_match_index, append_unmatched
+from pipeline_profiler import PROFILE_DIR, PROFILE_SCOPES, PipelineProfiler
+from run_metrics import RUN_LOG_PATH, FileMetrics, RunLog
+from processing_manifest import MANIFEST_PATH, ProcessingManifest, STATUS_NEW, STATUS_CHANGED, STATUS_UNCHANGED, content_signature
 warnings.filterwarnings('ignore')
 
 # Настройка логирования
@@ -26,206 +52,317 @@ logging.basicConfig(
     ]
 )
 
+# Число читаемых колонок листа: в 'Pallet Order' используются только колонки A-Z
+SHEET_MAX_COLUMNS = {'Pallet Order': 26}
+
+# Колонки заказов из листа 'Pallet Order'
+PALLET_ORDER_COLUMNS = ['Date', 'Client_Name', 'Delivery_Name', 'Pallets_Ordered', 'Temperature', 'Source_Sheet', 'Source_File']
+
+# Канонические поля листа 'Collection Plan' и ключевые слова их заголовков
+COLLECTION_PLAN_COLUMNS = ColumnMappingResolver([
+    ('load_number', ('load', 'number')),
+    ('collection_site', ('collection', 'site')),
+    ('delivery_destination', ('delivery', 'destination')),
+    ('pallets_ordered', ('pallets', 'ordered')),
+    ('pallet_type', ('pallet', 'type')),
+    ('trailer_type', ('trailer', 'type')),
+    ('trailer_fill', ('trailer', 'fill')),
+    ('driver', ('driver',)),
+    ('vehicle', ('vehicle',)),
+    ('route', ('route',)),
+])
+
+# Число файлов в обработке на один процесс пула: остальные отправляются по мере получения результатов
+PARALLEL_WINDOW_PER_WORKER = 2
+
+# Поиск строки заголовков с кешем по шаблону листа (один на процесс)
+HEADER_DETECTOR = HeaderDetector()
+
+# Коды завершения для запуска из планировщика
+EXIT_OK = 0
+EXIT_FAILURE = 1        # критическая ошибка
+EXIT_USAGE = 2          # неверные аргументы или папка не найдена (как у argparse)
+EXIT_FILE_ERRORS = 3    # обработка завершена, но часть файлов не обработана
+EXIT_INTERRUPTED = 130  # прервано пользователем (Ctrl+C)
+
 class AdvancedDatasetBuilder:
-    def __init__(self):
+    # Версия логики разбора: при ее изменении все файлы будут обработаны заново
+    PARSER_VERSION = 'dataset_builder_advanced/1'
+    
+    # Режимы записи: весь датасет целиком, потоково по мере обработки файлов
+    # или каталогом Parquet с разделами по дате
+    OUTPUT_MODES = ('combined', 'stream', 'partitioned')
+    
+    def __init__(self, workers: Optional[int] = 1, load_existing: bool = True,
+                 output_mode: str = 'combined', write_csv: bool = True, engine: str = 'auto',
+                 passwords: Optional[List[str]] = None, output_dir: str = '.', incremental: bool = True,
+                 profile: Optional[str] = None, profile_threshold: float = 0.0, store: bool = False,
+                 reprocess: Optional[List[str]] = None, checkpoint_files: Optional[int] = None,
+                 checkpoint_seconds: Optional[float] = None):
+        if output_mode not in self.OUTPUT_MODES:
+            raise ValueError(f"Неизвестный режим записи: {output_mode}")
+        
         self.combined_data = []
-        self.processed_files = set()
-        self.load_existing_dataset()
+        self.output_mode = output_mode
+        self.write_csv = write_csv
+        
+        # Движок чтения Excel ('auto' - calamine, если установлен, иначе openpyxl)
+        self.engine = resolve_engine(engine)
+        
+        # Пароли для защищенных книг (по умолчанию 'Test'); подошедший пароль запоминается для папки
+        self.credentials = CredentialResolver(passwords)
+        
+        # Выходные файлы в папке output_dir
+        self.output_dir = output_dir
+        self.csv_path = self.output_path("combined_dataset.csv")
+        self.parquet_path = self.output_path("combined_dataset.parquet")
+        self.dataset_dir = self.output_path("combined_dataset")
+        self.statistics_path = self.output_path("processing_statistics.csv")
+        self.run_log_path = self.output_path(RUN_LOG_PATH)
+        self.store_path = self.output_path(STORE_PATH)
+        
+        # База SQLite с записями датасета для запросов (дополнительно к файлам датасета)
+        self.store = DatasetStore(self.store_path) if store else None
+        self.scan_cache = DirectoryScanCache(self.output_path(SCAN_CACHE_PATH))
+        
+        # Инкрементальный запуск дополняет датасет; полный - пересобирает его из всех файлов
+        self.incremental = incremental
+        
+        # Количество процессов для обработки файлов (1 - последовательно, None - по числу ядер)
+        self.workers = workers or os.cpu_count() or 1
+        
+        # Манифест обработанных файлов и файлы текущего запуска
+        self.manifest = ProcessingManifest(self.output_path(MANIFEST_PATH))
+        # Журнал фиксаций: датасет и манифест заменяются вместе после сброса на диск
+        self.commit_log = CommitLog(self.output_path(COMMIT_LOG_PATH))
+        # Контрольные точки длинного запуска: обработанные файлы фиксируются каждые N файлов или T секунд
+        self.checkpoints = CheckpointSchedule(checkpoint_files, checkpoint_seconds)
+        self.changed_files = set()
+        self.failed_files = set()
+        # Измененные файлы, новые записи которых еще не сохранены: их старые записи заменяются при сохранении
+        self.replaced_files = set()
+        # Подписи обработанных файлов (размер, время, хеш), снятые до разбора: записываются в манифест
+        self.file_signatures: Dict[str, Dict[str, Any]] = {}
+        # Имена файлов и даты (YYYY-MM-DD), файлы которых нужно обработать заново, даже если они не менялись
+        self.reprocess = set(reprocess or ())
+        # Файлы, уже обработанные заново: в режиме наблюдения повторная обработка не повторяется
+        self.reprocessed_files = set()
+        
+        # Журнал текущего запуска (создается в ingest_files) и метрики последнего обработанного файла
+        self.run_log: Optional[RunLog] = None
+        self.last_file_metrics: Optional[Dict[str, Any]] = None
+        self.last_file_signature: Optional[Dict[str, Any]] = None
+        # Найденные строки заголовков листов последнего файла
+        self.header_matches: Dict[str, HeaderMatch] = {}
+        
+        # Профилирование каждого файла или всего запуска; сохраняются профили медленнее порога
+        self.profiler = PipelineProfiler(profile, self.output_path(PROFILE_DIR), profile_threshold) if profile else None
+        
+        if load_existing:
+            self.recover_outputs()
+        if load_existing and incremental:
+            self.load_scan_cache()
+            self.load_manifest()
+            self.load_existing_dataset()
         
         # Статистика
         self.stats = {
             'files_processed': 0,
             'files_skipped': 0,
+            'files_changed': 0,
             'orders_extracted': 0,
             'deliveries_extracted': 0,
-            'errors': 0
+            'errors': 0,
+            'engine': self.engine
         }
     
+    def recover_outputs(self):
+        """Завершает фиксацию, прерванную сбоем прошлого запуска, и проверяет зафиксированные файлы"""
+        try:
+            entry = self.commit_log.recover()
+            if entry is not None:
+                logging.warning(f"Завершена прерванная фиксация {entry['commit_id']}: {', '.join(entry['files'])}")
+            for path in self.commit_log.verify():
+                logging.error(f"Размер файла {path} не совпадает с зафиксированным: файл поврежден или изменен вне сборщика")
+        except Exception as e:
+            logging.error(f"Ошибка проверки журнала фиксаций: {e}")
+    
+    def output_path(self, name: str) -> str:
+        """Путь к выходному файлу в папке результатов"""
+        return os.path.normpath(os.path.join(self.output_dir, name))
+    
+    def dataset_exists(self) -> bool:
+        """Проверяет, есть ли на диске выходной датасет"""
+        if self.output_mode == 'partitioned' and os.path.isdir(self.dataset_dir):
+            return True
+        if checkpoint_parts(self.parquet_path):
+            return True
+        return os.path.exists(self.parquet_path) or os.path.exists(self.csv_path)
+    
     def load_existing_dataset(self):
-        """Загружает существующий датасет для добавления новых данных"""
-        csv_path = "combined_dataset.csv"
-        parquet_path = "combined_dataset.parquet"
-        
-        if os.path.exists(csv_path):
-            try:
-                existing_df = pd.read_csv(csv_path)
-                self.combined_data = existing_df.to_dict('records')
-                logging.info(f"Загружен существующий датасет: {len(self.combined_data)} записей")
-                
-                # Загружаем список уже обработанных файлов
-                if 'Source_File' in existing_df.columns:
-                    self.processed_files = set(existing_df['Source_File'].unique())
-                    
-            except Exception as e:
-                logging.error(f"Ошибка загрузки существующего датасета: {e}")
-        elif os.path.exists(parquet_path):
-            try:
-                existing_df = pd.read_parquet(parquet_path)
-                self.combined_data = existing_df.to_dict('records')
-                logging.info(f"Загружен существующий датасет: {len(self.combined_data)} записей")
+        """Загружает сведения о существующем датасете, не читая его записи"""
+        if not self.dataset_exists():
+            if len(self.manifest) or self.manifest.legacy_files:
+                logging.warning("Датасет не найден, манифест сброшен: все файлы будут обработаны заново")
+                self.manifest.reset()
+            return
+        
+        try:
+            # Число записей берется из метаданных Parquet, без чтения данных
+            if os.path.exists(self.parquet_path):
+                logging.info(f"Найден существующий датасет: {pq.read_metadata(self.parquet_path).num_rows} записей")
+            
+            # Обработанные файлы известны из манифеста
+            if self.manifest.exists():
+                return
+            
+            # Датасет собран до появления манифеста: читаем только колонку Source_File
+            source_files = self.read_existing_column('Source_File')
+            if source_files is not None:
+                self.manifest.legacy_files = {name: int(count) for name, count in source_files.astype(object).value_counts().items()}
+                logging.info(f"Загружен список обработанных файлов из датасета: {len(self.manifest.legacy_files)}")
                 
-                if 'Source_File' in existing_df.columns:
-                    self.processed_files = set(existing_df['Source_File'].unique())
-                    
-            except Exception as e:
-                logging.error(f"Ошибка загрузки существующего датасета: {e}")
+        except Exception as e:
+            logging.error(f"Ошибка загрузки существующего датасета: {e}")
     
-    def extract_date_from_filename(self, filename: str) -> Optional[str]:
-        """Извлекает дату из имени файла с улучшенной логикой"""
-        # Паттерны для поиска даты
-        patterns = [
-            r'(\d{2})(\d{2})(\d{4})',  # DDMMYYYY
-            r'(\d{2})(\d{2})(\d{2})',  # DDMMYY
-            r'(\d{1,2})[-_](\d{1,2})[-_](\d{2,4})',  # DD-MM-YY или DD_MM_YY
-        ]
+    def read_existing_column(self, column: str) -> Optional[pd.Series]:
+        """Читает одну колонку существующего датасета (Parquet предпочтительнее CSV)"""
+        if os.path.exists(self.parquet_path):
+            if column not in pq.read_schema(self.parquet_path).names:
+                return None
+            return pd.read_parquet(self.parquet_path, columns=[column])[column]
         
-        for pattern in patterns:
-            match = re.search(pattern, filename)
-            if match:
-                groups = match.groups()
-                
-                if len(groups) == 3:
-                    if len(groups[2]) == 2:  # YY
-                        day, month, year = groups
-                        # Предполагаем, что год 20xx
-                        full_year = f"20{year}"
-                    elif len(groups[2]) == 4:  # YYYY
-                        day, month, year = groups
-                        full_year = year
-                    else:
-                        continue
-                    
-                    try:
-                        date_obj = datetime(int(full_year), int(month), int(day))
-                        return date_obj.strftime('%Y-%m-%d')
-                    except ValueError:
-                        continue
+        if os.path.exists(self.csv_path):
+            existing_df = pd.read_csv(self.csv_path, usecols=lambda name: name == column)
+            return existing_df[column] if column in existing_df.columns else None
         
         return None
     
+    def load_scan_cache(self):
+        """Загружает кеш сканирования папок"""
+        try:
+            self.scan_cache.load()
+        except Exception as e:
+            logging.warning(f"Кеш сканирования папок не загружен, папки будут прочитаны заново: {e}")
+    
+    def load_manifest(self):
+        """Загружает манифест обработанных файлов"""
+        try:
+            if self.manifest.load():
+                logging.info(f"Загружен манифест: {len(self.manifest)} обработанных файлов")
+        except Exception as e:
+            logging.error(f"Ошибка загрузки манифеста: {e}")
+    
+    def extract_date_from_filename(self, filename: str) -> Optional[str]:
+        """Извлекает дату из имени файла с улучшенной логикой"""
+        # DDMMYYYY, DDMMYY (год 20YY), DD-MM-YY или DD_MM_YY - по порядку
+        return parse_filename_date(filename)
+    
     def extract_temperature(self, client_name: str) -> str:
         """Извлекает температуру из названия клиента"""
-        if not client_name or not isinstance(client_name, str):
-            return "+3°C"
-        
-        # Паттерны для поиска температуры
-        temp_patterns = [
-            r'\(\+(\d+)°C\)',
-            r'\+(\d+)°C',
-            r'(\d+)°C',
-            r'(\d+)C',
-        ]
-        
-        for pattern in temp_patterns:
-            match = re.search(pattern, client_name, re.IGNORECASE)
-            if match:
-                temp_value = match.group(1)
-                return f"+{temp_value}°C"
-        
-        return "+3°C"  # По умолчанию
+        return parse_temperature(client_name)
     
-    def read_excel_sheet(self, file_path: str, sheet_name: str, password: str = None) -> Optional[pd.DataFrame]:
-        """Читает лист Excel с улучшенной обработкой ошибок"""
+    def open_workbook(self, file_path: str, password: str = None) -> WorkbookHandle:
+        """Открывает книгу Excel один раз; зашифрованная книга расшифровывается подобранным паролем
+        
+        Ошибка открытия (поврежденный или заблокированный файл, неподходящий пароль) передается вызывающему:
+        такой файл считается необработанным.
+        """
+        filename = os.path.basename(file_path)
         try:
-            if password:
-                return pd.read_excel(file_path, sheet_name=sheet_name, password=password)
-            else:
-                return pd.read_excel(file_path, sheet_name=sheet_name)
+            workbook = WorkbookHandle(file_path, password=password, engine=self.engine, credentials=self.credentials)
+            if workbook.encrypted:
+                logging.info(f"Файл {filename} защищен паролем и расшифрован")
+            return workbook
         except Exception as e:
-            error_msg = str(e).lower()
-            
-            if "password" in error_msg:
-                logging.info(f"Лист {sheet_name} защищен паролем. Пробуем с паролем 'Test'...")
-                try:
-                    return pd.read_excel(file_path, sheet_name=sheet_name, password="Test")
-                except Exception as e2:
-                    logging.warning(f"Не удалось открыть лист {sheet_name} даже с паролем: {e2}")
-                    return None
-            elif "sheet" in error_msg and "not found" in error_msg:
-                logging.warning(f"Лист '{sheet_name}' не найден в файле {os.path.basename(file_path)}")
-                return None
-            else:
-                logging.error(f"Ошибка чтения листа {sheet_name}: {e}")
-                return None
+            logging.error(f"Ошибка открытия файла {filename}: {e}")
+            raise
     
-    def find_header_row(self, df: pd.DataFrame) -> int:
-        """Находит строку с заголовками в таблице"""
-        if df is None or df.empty:
-            return 0
+    def read_excel_sheets(self, file_path: str, sheet_names: List[str], password: str = None,
+                          metrics: Optional[FileMetrics] = None) -> Dict[str, Optional[pd.DataFrame]]:
+        """Читает несколько листов Excel из одной загрузки книги"""
+        sheets = {sheet_name: None for sheet_name in sheet_names}
         
-        # Ищем строку с заголовками (содержит ключевые слова)
-        header_keywords = ['client', 'customer', 'delivery', 'pallet', 'load', 'collection']
+        started = time.perf_counter()
+        workbook = self.open_workbook(file_path, password)
+        if metrics is not None:
+            metrics.data['open_seconds'] = time.perf_counter() - started
         
-        for idx, row in df.iterrows():
-            row_str = ' '.join(str(cell).lower() for cell in row if pd.notna(cell))
-            if any(keyword in row_str for keyword in header_keywords):
-                return idx
+        with workbook:
+            for sheet_name in sheet_names:
+                # Список листов известен заранее, отсутствующий лист не вызывает исключения
+                if not workbook.has_sheet(sheet_name):
+                    logging.warning(f"Лист '{sheet_name}' не найден в файле {os.path.basename(file_path)}")
+                    continue
+                try:
+                    started = time.perf_counter()
+                    sheets[sheet_name] = workbook.read_sheet(sheet_name, SHEET_MAX_COLUMNS.get(sheet_name))
+                    if metrics is not None:
+                        metrics.add_sheet(sheet_name, time.perf_counter() - started, len(sheets[sheet_name]))
+                except Exception as e:
+                    # Лист, который не удалось прочитать, - ошибка всего файла: файл будет обработан повторно
+                    logging.error(f"Ошибка чтения листа {sheet_name}: {e}")
+                    raise
         
-        return 0
+        return sheets
+    
+    def read_excel_sheet(self, file_path: str, sheet_name: str, password: str = None) -> Optional[pd.DataFrame]:
+        """Читает лист Excel с улучшенной обработкой ошибок"""
+        return self.read_excel_sheets(file_path, [sheet_name], password)[sheet_name]
+    
+    def find_header_row(self, df: pd.DataFrame, sheet_name: Optional[str] = None) -> int:
+        """Находит строку с заголовками в таблице (первую строку с ключевым словом в начале листа)"""
+        match = HEADER_DETECTOR.detect(df)
+        if sheet_name is not None:
+            self.header_matches[sheet_name] = match
+        return match.row
     
-    def process_pallet_order_sheet(self, df: pd.DataFrame, file_date: str, filename: str) -> List[Dict[str, Any]]:
+    def extract_temperatures(self, client_names: pd.Series) -> pd.Series:
+        """Извлекает температуру для колонки названий клиентов: каждое уникальное название разбирается один раз"""
+        return parse_temperatures(client_names)
+    
+    def process_pallet_order_sheet(self, df: pd.DataFrame, file_date: str, filename: str) -> pd.DataFrame:
         """Обрабатывает лист 'Pallet Order' с улучшенной логикой"""
-        orders = []
-        
         if df is None or df.empty:
-            return orders
+            return pd.DataFrame(columns=PALLET_ORDER_COLUMNS)
         
         # Находим строку с заголовками
-        header_row = self.find_header_row(df)
+        header_row = self.find_header_row(df, 'Pallet Order')
         
         # Получаем заголовки доставок (колонки B-Z)
-        delivery_headers = []
-        for col_idx in range(1, min(26, len(df.columns))):
-            if header_row < len(df):
-                header_value = df.iloc[header_row, col_idx]
-                if pd.notna(header_value) and str(header_value).strip():
-                    delivery_headers.append((col_idx, str(header_value).strip()))
-        
-        # Обрабатываем строки с заказами
-        for idx, row in df.iterrows():
-            if idx <= header_row:  # Пропускаем заголовки
-                continue
-            
-            client_name = row.iloc[0] if len(row) > 0 else None
-            
-            # Пропускаем пустые строки
-            if pd.isna(client_name) or not isinstance(client_name, str) or client_name.strip() == "":
-                continue
-            
-            # Извлекаем температуру
-            temperature = self.extract_temperature(client_name)
-            
-            # Обрабатываем заказы по колонкам
-            for col_idx, delivery_name in delivery_headers:
-                if col_idx < len(row):
-                    pallet_count = row.iloc[col_idx]
-                    
-                    # Пропускаем пустые заказы
-                    if pd.isna(pallet_count) or pallet_count == 0:
-                        continue
-                    
-                    order = {
-                        'Date': file_date,
-                        'Client_Name': client_name.strip(),
-                        'Delivery_Name': delivery_name,
-                        'Pallets_Ordered': float(pallet_count),
-                        'Temperature': temperature,
-                        'Source_Sheet': 'Pallet Order',
-                        'Source_File': filename
-                    }
-                    orders.append(order)
-        
-        return orders
-    
-    def process_collection_plan_sheet(self, df: pd.DataFrame, file_date: str, filename: str) -> List[Dict[str, Any]]:
-        """Обрабатывает лист 'Collection Plan' с улучшенной логикой"""
-        deliveries = []
+        headers = df.iloc[header_row, 1:26]
+        header_names = np.array([str(value).strip() if pd.notna(value) else '' for value in headers], dtype=object)
+        delivery_columns = np.flatnonzero(header_names != '')
+        
+        # Строки с заказами: ниже заголовка, с непустым названием клиента в колонке A
+        body = df.iloc[header_row + 1:]
+        client_names = body.iloc[:, 0].map(lambda v: v.strip() if isinstance(v, str) else None)
+        valid_clients = (client_names.notna() & client_names.ne('')).to_numpy()
+        
+        # Разворачиваем матрицу клиент x доставка, пропуская пустые и нулевые заказы
+        pallet_counts = body.iloc[:, delivery_columns + 1]
+        mask = (pallet_counts.notna() & pallet_counts.ne(0)).to_numpy() & valid_clients[:, None]
+        rows, columns = np.nonzero(mask)
+        
+        temperatures = self.extract_temperatures(client_names).to_numpy(dtype=object)
         
+        return pd.DataFrame({
+            'Date': file_date,
+            'Client_Name': client_names.to_numpy(dtype=object)[rows],
+            'Delivery_Name': header_names[delivery_columns][columns],
+            'Pallets_Ordered': pallet_counts.to_numpy(dtype=object)[rows, columns].astype(float),
+            'Temperature': temperatures[rows],
+            'Source_Sheet': 'Pallet Order',
+            'Source_File': filename
+        }, columns=PALLET_ORDER_COLUMNS)
+    
+    def process_collection_plan_sheet(self, df: pd.DataFrame, file_date: str, filename: str) -> pd.DataFrame:
+        """Обрабатывает лист 'Collection Plan' с улучшенной логикой"""
         if df is None or df.empty:
-            return deliveries
+            return pd.DataFrame(columns=['Date', 'Source_Sheet', 'Source_File'])
         
         # Находим строку с заголовками
-        header_row = self.find_header_row(df)
+        header_row = self.find_header_row(df, 'Collection Plan')
         
         # Создаем DataFrame с правильными заголовками
         if header_row > 0:
@@ -234,96 +371,54 @@ class AdvancedDatasetBuilder:
         else:
             df_clean = df
         
-        # Ищем колонки по названиям
-        columns = df_clean.columns.tolist()
-        column_mapping = {}
-        
-        for col in columns:
-            col_str = str(col).lower()
-            if 'load' in col_str and 'number' in col_str:
-                column_mapping['load_number'] = col
-            elif 'collection' in col_str and 'site' in col_str:
-                column_mapping['collection_site'] = col
-            elif 'delivery' in col_str and 'destination' in col_str:
-                column_mapping['delivery_destination'] = col
-            elif 'pallets' in col_str and 'ordered' in col_str:
-                column_mapping['pallets_ordered'] = col
-            elif 'pallet' in col_str and 'type' in col_str:
-                column_mapping['pallet_type'] = col
-            elif 'trailer' in col_str and 'type' in col_str:
-                column_mapping['trailer_type'] = col
-            elif 'trailer' in col_str and 'fill' in col_str:
-                column_mapping['trailer_fill'] = col
-            elif 'driver' in col_str:
-                column_mapping['driver'] = col
-            elif 'vehicle' in col_str:
-                column_mapping['vehicle'] = col
-            elif 'route' in col_str:
-                column_mapping['route'] = col
-        
-        # Обрабатываем каждую строку как отдельную доставку
-        for idx, row in df_clean.iterrows():
-            # Пропускаем пустые строки
-            if row.isna().all():
-                continue
-            
-            delivery = {
-                'Date': file_date,
-                'Source_Sheet': 'Collection Plan',
-                'Source_File': filename
-            }
-            
-            # Заполняем данные из найденных колонок
-            for field, col in column_mapping.items():
-                if col in df_clean.columns and idx < len(df_clean):
-                    value = row[col]
-                    if pd.notna(value):
-                        delivery[field] = value
-            
-            # Добавляем все остальные колонки
-            for col in df_clean.columns:
-                if col not in column_mapping.values() and idx < len(df_clean):
-                    value = row[col]
-                    if pd.notna(value):
-                        delivery[f'extra_{col}'] = value
-            
-            deliveries.append(delivery)
+        # Пропускаем пустые строки
+        df_clean = df_clean[~df_clean.isna().all(axis=1).to_numpy()]
+        
+        # Сопоставляем заголовок с полями (один раз на шаблон листа) и отбираем колонки
+        deliveries = COLLECTION_PLAN_COLUMNS.apply(df_clean).reset_index(drop=True)
+        deliveries.insert(0, 'Date', file_date)
+        deliveries.insert(1, 'Source_Sheet', 'Collection Plan')
+        deliveries.insert(2, 'Source_File', filename)
         
         return deliveries
     
-    def merge_orders_and_deliveries(self, orders: List[Dict], deliveries: List[Dict]) -> List[Dict]:
+    def records_without_na(self, df: pd.DataFrame) -> List[Dict[str, Any]]:
+        """Преобразует таблицу в список записей, не включая пустые значения"""
+        columns = list(df.columns)
+        present = df.notna().to_numpy()
+        return [
+            {column: value for column, value, is_present in zip(columns, row, row_present) if is_present}
+            for row, row_present in zip(df.to_numpy(dtype=object), present)
+        ]
+    
+    def merge_orders_and_deliveries(self, orders: Union[pd.DataFrame, List[Dict]], deliveries: Union[pd.DataFrame, List[Dict]]) -> List[Dict]:
         """Объединяет данные из 'Pallet Order' и 'Collection Plan' с улучшенной логикой"""
         merged_data = []
         
-        # Создаем словарь доставок по ключевым признакам
-        delivery_dict = {}
+        if isinstance(orders, pd.DataFrame):
+            orders = orders.to_dict('records')
+        if isinstance(deliveries, pd.DataFrame):
+            deliveries = self.records_without_na(deliveries)
+        
+        # Точный индекс: доставки без места сбора (у заказа его нет), при совпадении ключа берется последняя
+        exact_index = {}
         for delivery in deliveries:
-            key = (
-                delivery.get('delivery_destination'),
-                delivery.get('pallets_ordered'),
-                delivery.get('collection_site')
-            )
-            if key[0] and key[1]:  # Есть место доставки и количество паллет
-                delivery_dict[key] = delivery
+            destination = delivery.get('delivery_destination')
+            pallets = delivery.get('pallets_ordered')
+            key = join_key(destination, pallets)
+            if key is not None and destination and pallets and delivery.get('collection_site') is None:
+                exact_index[key] = delivery
+        
+        # Индекс частичного совпадения: первая доставка с тем же местом доставки и количеством паллет
+        partial_index = first_match_index(deliveries, ['delivery_destination', 'pallets_ordered'])
         
         # Объединяем заказы с доставками
         for order in orders:
-            key = (
-                order.get('Delivery_Name'),
-                order.get('Pallets_Ordered'),
-                None  # collection_site из заказа не доступен
-            )
+            key = join_key(order.get('Delivery_Name'), order.get('Pallets_Ordered'))
             
             best_match = None
-            if key in delivery_dict:
-                best_match = delivery_dict[key]
-            else:
-                # Ищем частичное совпадение
-                for delivery in deliveries:
-                    if (order.get('Delivery_Name') == delivery.get('delivery_destination') and
-                        order.get('Pallets_Ordered') == delivery.get('pallets_ordered')):
-                        best_match = delivery
-                        break
+            if key is not None:
+                best_match = exact_index.get(key) or partial_index.get(key)
             
             if best_match:
                 # Объединяем данные, избегая дублирования
@@ -337,42 +432,79 @@ class AdvancedDatasetBuilder:
                 merged_data.append(order)
         
         # Добавляем доставки без сопоставленных заказов
-        for delivery in deliveries:
-            if not any(d.get('load_number') == delivery.get('load_number') for d in merged_data):
-                merged_data.append(delivery)
+        append_unmatched(merged_data, deliveries, 'load_number')
         
         return merged_data
     
-    def process_excel_file(self, file_path: str) -> List[Dict[str, Any]]:
+    def skip_if_processed(self, file_path: str) -> bool:
+        """Проверяет по манифесту, обработан ли файл ранее, и учитывает пропуск в статистике"""
+        filename = os.path.basename(file_path)
+        status = self.manifest.file_status(file_path, self.PARSER_VERSION)
+        
+        # Файл есть в датасете, но отсутствует в манифесте (датасет собран до появления манифеста)
+        if status == STATUS_NEW and self.manifest.adopt(file_path, self.PARSER_VERSION):
+            status = STATUS_UNCHANGED
+        
+        if status == STATUS_UNCHANGED and self.reprocess_requested(filename):
+            logging.info(f"Файл {filename} указан для повторной обработки, его записи будут заменены")
+            self.reprocessed_files.add(filename)
+            status = STATUS_CHANGED
+        elif status == STATUS_CHANGED:
+            logging.info(f"Файл {filename} изменился, его записи будут заменены")
+        
+        if status == STATUS_UNCHANGED:
+            logging.info(f"Файл {filename} уже обработан, пропускаем")
+            self.stats['files_skipped'] += 1
+            return True
+        
+        if status == STATUS_CHANGED:
+            self.changed_files.add(filename)
+            self.stats['files_changed'] += 1
+        return False
+    
+    def reprocess_requested(self, filename: str) -> bool:
+        """Проверяет, указан ли файл для повторной обработки по имени или по дате"""
+        if not self.reprocess or filename in self.reprocessed_files:
+            return False
+        return filename in self.reprocess or self.extract_date_from_filename(filename) in self.reprocess
+    
+    def process_excel_file(self, file_path: str, check_processed: bool = True) -> List[Dict[str, Any]]:
         """Обрабатывает один Excel файл"""
         filename = os.path.basename(file_path)
         logging.info(f"Обрабатываю файл: {filename}")
         
         # Проверяем, не обрабатывали ли мы уже этот файл
-        if filename in self.processed_files:
-            logging.info(f"Файл {filename} уже обработан, пропускаем")
-            self.stats['files_skipped'] += 1
+        self.last_file_metrics = None
+        if check_processed and self.skip_if_processed(file_path):
             return []
         
+        metrics = FileMetrics(file_path)
+        self.header_matches = {}
+        
         # Извлекаем дату из имени файла
         file_date = self.extract_date_from_filename(filename)
         
         if not file_date:
             logging.warning(f"Не удалось извлечь дату из имени файла: {filename}")
             self.stats['errors'] += 1
+            self.last_file_metrics = metrics.finish('error', error="не удалось извлечь дату из имени файла")
             return []
         
         try:
-            # Читаем лист 'Pallet Order'
-            pallet_order_df = self.read_excel_sheet(file_path, 'Pallet Order')
-            orders = self.process_pallet_order_sheet(pallet_order_df, file_date, filename)
+            # Читаем оба листа из одной загрузки книги
+            sheets = self.read_excel_sheets(file_path, ['Pallet Order', 'Collection Plan'], metrics=metrics)
             
-            # Читаем лист 'Collection Plan'
-            collection_plan_df = self.read_excel_sheet(file_path, 'Collection Plan')
-            deliveries = self.process_collection_plan_sheet(collection_plan_df, file_date, filename)
+            # Обрабатываем лист 'Pallet Order'
+            with metrics.timed('pallet_order_seconds'):
+                orders = self.process_pallet_order_sheet(sheets['Pallet Order'], file_date, filename)
+            
+            # Обрабатываем лист 'Collection Plan'
+            with metrics.timed('collection_plan_seconds'):
+                deliveries = self.process_collection_plan_sheet(sheets['Collection Plan'], file_date, filename)
             
             # Объединяем данные
-            merged_data = self.merge_orders_and_deliveries(orders, deliveries)
+            with metrics.timed('merge_seconds'):
+                merged_data = self.merge_orders_and_deliveries(orders, deliveries)
             
             # Обновляем статистику
             self.stats['orders_extracted'] += len(orders)
@@ -380,131 +512,647 @@ class AdvancedDatasetBuilder:
             self.stats['files_processed'] += 1
             
             logging.info(f"Извлечено {len(orders)} заказов, {len(deliveries)} доставок, {len(merged_data)} объединенных записей")
+            self.last_file_metrics = metrics.finish(
+                orders=len(orders), deliveries=len(deliveries), records=len(merged_data),
+                header_confidence={sheet_name: match.confidence for sheet_name, match in self.header_matches.items()},
+            )
             
             return merged_data
             
         except Exception as e:
             logging.error(f"Ошибка обработки файла {filename}: {e}")
             self.stats['errors'] += 1
+            self.last_file_metrics = metrics.finish('error', error=str(e))
             return []
     
-    def find_excel_files(self, year_folder: str) -> List[str]:
-        """Находит все Excel файлы с маршрутами в указанной папке"""
-        patterns = [
-            os.path.join(year_folder, "**", "Lyons collections*.xlsx"),
-            os.path.join(year_folder, "**", "Lyons collections*.xlsm")
-        ]
+    def profile_scope(self, scope: str, name: str):
+        """Профилирует блок, если включено профилирование с этим охватом; иначе ничего не делает"""
+        if self.profiler is None or self.profiler.scope != scope:
+            return nullcontext(SimpleNamespace(seconds=None, path=None))
+        return self.profiler.profile(name)
+    
+    def process_file_profiled(self, file_path: str, signature: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+        """Обрабатывает новый или измененный файл; путь к сохраненному профилю попадает в метрики файла"""
+        # Подпись для манифеста снимается до разбора: файл, перезаписанный во время разбора, обработается заново
+        self.last_file_signature = signature or content_signature(file_path)
+        with self.profile_scope('file', os.path.basename(file_path)) as profile:
+            file_records = self.process_excel_file(file_path, check_processed=False)
+        if profile.path and self.last_file_metrics is not None:
+            self.last_file_metrics['profile'] = profile.path
+        return file_records
+    
+    def plan_files(self, excel_files: List[str]) -> List[str]:
+        """Отбирает новые и измененные файлы; пропуски учитываются в статистике"""
+        # Пропуски определяем в основном процессе: рабочим процессам манифест не нужен
+        return [f for f in excel_files if not self.skip_if_processed(f)]
+    
+    def iter_processed_files(self, excel_files: List[str], planned: bool = False) -> Iterator[Tuple[str, List[Dict[str, Any]]]]:
+        """Обрабатывает новые и измененные файлы последовательно или в пуле процессов, сохраняя порядок файлов"""
+        pending_files = excel_files if planned else self.plan_files(excel_files)
+        if not pending_files:
+            return
+        
+        if self.workers <= 1:
+            for file_path in pending_files:
+                errors_before = self.stats['errors']
+                try:
+                    file_records = self.process_file_profiled(file_path, self.manifest.checked_signature(file_path))
+                    self.file_signatures[os.path.basename(file_path)] = self.last_file_signature
+                except Exception as e:
+                    logging.error(f"Критическая ошибка обработки файла {file_path}: {e}")
+                    self.stats['errors'] += 1
+                    file_records = []
+                if self.stats['errors'] > errors_before:
+                    self.failed_files.add(os.path.basename(file_path))
+                self.log_file_metrics(file_path, self.last_file_metrics)
+                yield file_path, file_records
+            return
+        
+        max_workers = min(self.workers, len(pending_files))
+        logging.info(f"Параллельная обработка: {len(pending_files)} файлов, процессов: {max_workers}")
+        
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker,
+                                 initargs=(self.engine, self.credentials.passwords, self.profiler)) as executor:
+            # Записи готовых файлов не накапливаются: в обработке не больше окна файлов
+            window = PARALLEL_WINDOW_PER_WORKER * max_workers
+            files = iter(pending_files)
+            in_flight = deque((file_path, self.submit_file(executor, file_path)) for file_path in islice(files, window))
+            
+            # Результаты объединяем строго в порядке файлов, как при последовательной обработке
+            while in_flight:
+                file_path, future = in_flight.popleft()
+                next_path = next(files, None)
+                if next_path is not None:
+                    in_flight.append((next_path, self.submit_file(executor, next_path)))
+                try:
+                    file_records, stats_delta, file_metrics, signature = future.result()
+                except Exception as e:
+                    logging.error(f"Критическая ошибка обработки файла {file_path}: {e}")
+                    self.stats['errors'] += 1
+                    self.failed_files.add(os.path.basename(file_path))
+                    self.log_file_metrics(file_path, None)
+                    yield file_path, []
+                    continue
+                
+                for key, value in stats_delta.items():
+                    self.stats[key] += value
+                if stats_delta.get('errors'):
+                    self.failed_files.add(os.path.basename(file_path))
+                self.file_signatures[os.path.basename(file_path)] = signature
+                self.log_file_metrics(file_path, file_metrics)
+                yield file_path, file_records
+    
+    def submit_file(self, executor: ProcessPoolExecutor, file_path: str):
+        """Отправляет файл в пул вместе с подписью, уже снятой при проверке"""
+        return executor.submit(_process_file_in_worker, file_path, self.manifest.checked_signature(file_path))
+    
+    def log_file_metrics(self, file_path: str, file_metrics: Optional[Dict[str, Any]]):
+        """Дописывает метрики обработанного файла в журнал запуска"""
+        if self.run_log is None:
+            return
+        if file_metrics is None:
+            # Файл не дошел до разбора (критическая ошибка или сбой рабочего процесса)
+            file_metrics = FileMetrics(file_path).finish('error')
+        self.run_log.append(file_metrics)
+    
+    def add_file_records(self, file_path: str, file_records: List[Dict[str, Any]]):
+        """Добавляет записи обработанного файла к новым данным и отмечает файл в манифесте"""
+        filename = os.path.basename(file_path)
+        
+        # Файл с ошибкой не отмечаем: он будет обработан повторно при следующем запуске
+        if filename in self.failed_files:
+            return
+        
+        # Старые записи измененного файла отбрасываются при сохранении датасета
+        if filename in self.changed_files:
+            self.replaced_files.add(filename)
+        self.combined_data.extend(file_records)
+        self.record_file(file_path, file_records)
+    
+    def record_file(self, file_path: str, file_records: List[Dict[str, Any]]):
+        """Отмечает обработанный файл в манифесте и заменяет его записи в базе"""
+        if self.store is not None:
+            self.store.upsert_file(os.path.basename(file_path), records_to_table(file_records))
+        signature = self.file_signatures.pop(os.path.basename(file_path), None)
+        self.manifest.record(file_path, len(file_records), self.PARSER_VERSION, signature)
+    
+    def prepare_store(self):
+        """Открывает базу; при полной пересборке очищает ее, при первом использовании переносит в нее датасет"""
+        if self.store.connection is None:
+            self.store.open()
+        
+        if not self.incremental:
+            self.store.clear()
+            return
+        if self.store.ingested_files() or not self.dataset_exists():
+            return
+        
+        # Однократный перенос всех записей: записи измененного файла заменяются, только когда он обработан заново;
+        # датасет читается пакетами, в памяти - записи одного исходного файла
+        if self.output_mode == 'partitioned' and os.path.isdir(self.dataset_dir):
+            tables = PartitionedDatasetWriter(self.dataset_dir).iter_tables()
+        else:
+            tables = self.iter_existing_tables(())
+        
+        migrated_rows = 0
+        for source_file, table in iter_source_tables(tables):
+            self.store.upsert_file(source_file, table)
+            migrated_rows += table.num_rows
+        
+        if migrated_rows:
+            logging.info(f"Существующий датасет перенесен в базу {self.store_path}: {migrated_rows} записей")
+    
+    def iter_existing_tables(self, replaced_files: Iterable[str]) -> Iterator[pa.Table]:
+        """Читает существующий датасет пакетами в схеме датасета, без записей заменяемых файлов"""
+        # Полная пересборка не использует существующий датасет
+        if not self.incremental:
+            return
+        
+        yield from iter_dataset_tables(self.parquet_path, self.csv_path, replaced_files)
+    
+    def stream_dataset(self, pending_files: List[str], transaction: Optional[OutputTransaction] = None) -> int:
+        """Потоково записывает датасет: существующие записи, затем записи каждого нового файла"""
+        new_records = 0
+        csv_path = self.csv_path if self.write_csv else None
+        
+        # Прежние записи измененных файлов (только их) остаются в памяти до конца запуска:
+        # если файл не удастся обработать заново, они возвращаются в датасет
+        replaced_tables = []
+        # Записи файлов, обработанных после предыдущей контрольной точки
+        checkpoint_tables = []
+        checkpoint_sources = set()
+        
+        writer = StreamingDatasetWriter(self.parquet_path, csv_path, transaction).open()
+        try:
+            for table in self.iter_existing_tables(()):
+                table, replaced = split_sources(table, self.changed_files)
+                writer.write_table(table)
+                if replaced.num_rows:
+                    replaced_tables.append(replaced)
+            
+            for file_path, file_records in self.iter_processed_files(pending_files, planned=True):
+                filename = os.path.basename(file_path)
+                
+                # Файл с ошибкой не отмечаем: он будет обработан повторно при следующем запуске
+                if filename in self.failed_files:
+                    if filename in self.changed_files:
+                        for table in replaced_tables:
+                            writer.write_table(split_sources(table, [filename])[1])
+                        logging.warning(f"Файл {filename} не обработан заново, его прежние записи сохранены")
+                    continue
+                
+                file_table = records_to_table(file_records)
+                writer.write_table(file_table)
+                self.record_file(file_path, file_records)
+                new_records += len(file_records)
+                
+                if self.checkpoints.enabled:
+                    checkpoint_tables.append(file_table)
+                    checkpoint_sources.add(filename)
+                if self.checkpoints.file_done():
+                    writer = self.stream_checkpoint(writer, checkpoint_tables, checkpoint_sources)
+                    checkpoint_tables = []
+                    checkpoint_sources = set()
+        except BaseException:
+            writer.abort()
+            raise
+        writer.close()
+        
+        logging.info(f"Датасет записан потоково: {writer.rows_written} записей")
+        return new_records
+    
+    def stream_checkpoint(self, writer: StreamingDatasetWriter, tables: List[pa.Table],
+                          sources: Iterable[str]) -> StreamingDatasetWriter:
+        """Контрольная точка потоковой записи: фиксирует записи файлов, обработанных после предыдущей точки, и манифест
+        
+        Записи фиксируются частью рядом с датасетом, а запись датасета продолжается без повторного копирования:
+        датасет на диске не меняется, и прежние записи еще не обработанных измененных файлов остаются в нем.
+        Следующий запуск читает части вместе с датасетом, итоговая фиксация включает их в датасет.
+        """
+        # Полная пересборка: прежний датасет больше не действует, первая точка фиксирует записанный датасет целиком
+        if not self.incremental:
+            run_transaction = writer.transaction
+            with self.commit_log.transaction(run_id=self.run_log.run_id, checkpoint=True) as transaction:
+                writer.transaction = transaction
+                writer.close()
+                self.manifest.save(transaction)
+            self.log_checkpoint()
+            self.incremental = True
+            
+            next_writer = StreamingDatasetWriter(writer.parquet_path, writer.csv_path, run_transaction).open()
+            for table in iter_dataset_tables(self.parquet_path, self.csv_path):
+                next_writer.write_table(table)
+            return next_writer
+        
+        with self.commit_log.transaction(run_id=self.run_log.run_id, checkpoint=True) as transaction:
+            write_checkpoint_part(self.parquet_path, tables, sources, transaction)
+            self.manifest.save(transaction)
+        self.log_checkpoint()
+        return writer
+    
+    def migrate_to_partitions(self, writer: PartitionedDatasetWriter):
+        """Однократно переносит существующий датасет в каталог с разделами по дате"""
+        # Части измененных файлов заменяются, только когда файл обработан заново;
+        # датасет читается пакетами, в памяти - записи одного исходного файла
+        migrated_rows = 0
+        for source_file, table in iter_source_tables(self.iter_existing_tables(())):
+            writer.write_table(table, source_file, replace=False)
+            migrated_rows += table.num_rows
+        
+        if migrated_rows:
+            logging.info(f"Существующий датасет перенесен в каталог {self.dataset_dir}: {migrated_rows} записей")
+    
+    def write_partitions(self, pending_files: List[str], transaction: Optional[OutputTransaction] = None) -> int:
+        """Записывает датасет по разделам дат: переписываются только части обработанных файлов"""
+        new_records = 0
+        
+        # Полная пересборка пишется в отдельный каталог, который заменяет прежний в конце или на контрольной точке
+        if self.incremental:
+            writer = PartitionedDatasetWriter(self.dataset_dir)
+            if not writer.exists():
+                self.migrate_to_partitions(writer)
+        else:
+            writer = PartitionedDatasetWriter(f"{self.dataset_dir}.tmp")
+            if writer.exists():
+                shutil.rmtree(writer.dataset_dir)
+        
+        for file_path, file_records in self.iter_processed_files(pending_files, planned=True):
+            filename = os.path.basename(file_path)
+            
+            # Файл с ошибкой не отмечаем: он будет обработан повторно при следующем запуске
+            if filename in self.failed_files:
+                continue
+            
+            writer.write_records(file_records, filename, replace=filename in self.changed_files)
+            self.record_file(file_path, file_records)
+            new_records += len(file_records)
+            
+            if self.checkpoints.file_done():
+                writer = self.partition_checkpoint(writer)
+        
+        if writer.dataset_dir != self.dataset_dir:
+            os.makedirs(writer.dataset_dir, exist_ok=True)
+            if transaction is not None:
+                transaction.stage(writer.dataset_dir, self.dataset_dir)
+            else:
+                install(writer.dataset_dir, self.dataset_dir)
+        
+        logging.info(f"Датасет записан по разделам: {writer.parts_written} частей, {writer.rows_written} записей")
+        return new_records
+    
+    def partition_checkpoint(self, writer: PartitionedDatasetWriter) -> PartitionedDatasetWriter:
+        """Контрольная точка записи по разделам: части уже на диске, фиксируется манифест
+        
+        При полной пересборке каталог с записанными частями заменяет прежний, и запись продолжается в нем.
+        """
+        with self.commit_log.transaction(run_id=self.run_log.run_id, checkpoint=True) as transaction:
+            if writer.dataset_dir != self.dataset_dir:
+                transaction.stage(writer.dataset_dir, self.dataset_dir)
+            self.manifest.save(transaction)
+        self.log_checkpoint()
         
-        excel_files = []
-        for pattern in patterns:
-            files = glob.glob(pattern, recursive=True)
-            excel_files.extend(files)
+        if writer.dataset_dir == self.dataset_dir:
+            return writer
+        next_writer = PartitionedDatasetWriter(self.dataset_dir)
+        next_writer.rows_written = writer.rows_written
+        next_writer.parts_written = writer.parts_written
+        return next_writer
+    
+    def checkpoint(self):
+        """Контрольная точка: фиксирует датасет с записями обработанных файлов и манифест"""
+        with self.commit_log.transaction(run_id=self.run_log.run_id, checkpoint=True) as transaction:
+            self.save_dataset(transaction)
+            self.manifest.save(transaction)
         
-        # Убираем дубликаты и сортируем
-        excel_files = list(set(excel_files))
-        excel_files.sort()
+        # Зафиксированные записи дальше читаются из датасета, даже при полной пересборке
+        self.combined_data = []
+        self.replaced_files = set()
+        self.incremental = True
+        self.log_checkpoint()
+    
+    def log_checkpoint(self):
+        """Начинает отсчет до следующей контрольной точки и отмечает ее в журнале"""
+        self.checkpoints.reset()
+        logging.info(f"Контрольная точка: зафиксировано обработанных файлов - {len(self.manifest)}")
+        self.run_log.append({'event': 'checkpoint', 'files_recorded': len(self.manifest)})
+    
+    def find_excel_files(self, year_folder: str) -> List[str]:
+        """Находит все Excel файлы с маршрутами в указанной папке"""
+        # Один проход по дереву папок; неизмененные папки берутся из кеша сканирования
+        excel_files = scan_excel_files(year_folder, EXCEL_FILE_PATTERNS, self.scan_cache)
+        self.scan_cache.save()
         
         return excel_files
     
-    def save_dataset(self):
-        """Сохраняет датасет в CSV и Parquet форматах"""
-        if not self.combined_data:
-            logging.warning("Нет данных для сохранения")
+    def save_dataset(self, transaction: Optional[OutputTransaction] = None):
+        """Сохраняет датасет в CSV и Parquet форматах (при фиксации transaction, если она указана)"""
+        if not self.combined_data and not self.replaced_files:
+            logging.warning("Нет новых данных для сохранения, датасет не изменен")
             return
         
+        # Очищаем новые данные
         df = pd.DataFrame(self.combined_data)
-        
-        # Очищаем данные
         df = df.replace('', pd.NA)
         df = df.dropna(how='all')  # Удаляем полностью пустые строки
         
-        # Сохраняем в CSV
-        csv_path = "combined_dataset.csv"
-        df.to_csv(csv_path, index=False, encoding='utf-8')
-        logging.info(f"Датасет сохранен в CSV: {csv_path}")
+        # Полная перезапись: существующие записи (без записей измененных файлов) читаются только здесь
+        csv_path = self.csv_path if self.write_csv else None
+        with StreamingDatasetWriter(self.parquet_path, csv_path, transaction) as writer:
+            for table in self.iter_existing_tables(self.replaced_files):
+                writer.write_table(table)
+            writer.write_table(frame_to_table(df))
         
-        # Сохраняем в Parquet
-        parquet_path = "combined_dataset.parquet"
-        df.to_parquet(parquet_path, index=False)
-        logging.info(f"Датасет сохранен в Parquet: {parquet_path}")
+        if self.write_csv:
+            logging.info(f"Датасет сохранен в CSV: {self.csv_path}")
+        logging.info(f"Датасет сохранен в Parquet: {self.parquet_path}")
         
-        logging.info(f"Всего записей в датасете: {len(df)}")
-        logging.info(f"Колонки: {list(df.columns)}")
+        logging.info(f"Всего записей в датасете: {writer.rows_written}")
+        logging.info(f"Колонки: {DATASET_SCHEMA.names}")
         
         # Сохраняем статистику
         self.save_statistics()
     
     def save_statistics(self):
         """Сохраняет статистику обработки"""
-        stats_df = pd.DataFrame([self.stats])
-        stats_df.to_csv("processing_statistics.csv", index=False)
-        logging.info("Статистика сохранена в processing_statistics.csv")
+        # Идентификатор запуска связывает статистику с подробным журналом запуска
+        run_id = {'run_id': self.run_log.run_id} if self.run_log is not None else {}
+        stats_df = pd.DataFrame([{**run_id, **self.stats}])
+        stats_df.to_csv(self.statistics_path, index=False)
+        logging.info(f"Статистика сохранена в {self.statistics_path}")
     
-    def run(self):
-        """Основной метод запуска"""
-        print("=== Advanced Dataset Builder for Logistics Routes ===")
-        print("Сбор данных из Excel-файлов с ежедневными маршрутами")
-        print()
+    def ingest_files(self, excel_files: List[str]) -> int:
+        """Обрабатывает новые и измененные файлы из списка и сохраняет датасет, статистику и манифест"""
+        self.combined_data = []
+        self.changed_files = set()
+        self.failed_files = set()
+        self.replaced_files = set()
+        self.file_signatures = {}
+        self.run_log = RunLog(self.run_log_path)
+        self.checkpoints.reset()
+        
+        if self.profiler is not None:
+            self.profiler.run_id = self.run_log.run_id
+        
+        # Датасет и манифест заменяются одной фиксацией; при ошибке итоговые файлы не меняются
+        transaction = self.commit_log.transaction(run_id=self.run_log.run_id)
+        with self.profile_scope('run', 'run') as profile, transaction:
+            # Отбираем новые и измененные файлы
+            pending_files = self.plan_files(excel_files)
+            if self.store is not None:
+                self.prepare_store()
+            
+            # Обрабатываем каждый файл
+            new_records = 0
+            if self.output_mode == 'stream':
+                new_records = self.stream_dataset(pending_files, transaction)
+            elif self.output_mode == 'partitioned':
+                new_records = self.write_partitions(pending_files, transaction)
+            else:
+                for file_path, file_records in self.iter_processed_files(pending_files, planned=True):
+                    self.add_file_records(file_path, file_records)
+                    new_records += len(file_records)
+                    if self.checkpoints.file_done():
+                        self.checkpoint()
+            
+            logging.info(f"\nОбработано файлов: {self.stats['files_processed']}")
+            logging.info(f"Пропущено файлов: {self.stats['files_skipped']}")
+            logging.info(f"Изменено файлов: {self.stats['files_changed']}")
+            logging.info(f"Ошибок: {self.stats['errors']}")
+            logging.info(f"Извлечено заказов: {self.stats['orders_extracted']}")
+            logging.info(f"Извлечено доставок: {self.stats['deliveries_extracted']}")
+            logging.info(f"Добавлено новых записей: {new_records}")
+            
+            # Сохраняем датасет и манифест во временные файлы и фиксируем их вместе
+            started = time.perf_counter()
+            if self.output_mode == 'combined':
+                self.save_dataset(transaction)
+            else:
+                self.save_statistics()
+            self.manifest.save(transaction)
+            transaction.commit()
+            save_seconds = time.perf_counter() - started
+        
+        # Итог запуска в журнале: статистика, время сохранения и пиковая память основного процесса
+        self.run_log.finish(
+            files_found=len(excel_files),
+            files_failed=len(self.failed_files),
+            new_records=new_records,
+            save_seconds=save_seconds,
+            output_mode=self.output_mode,
+            workers=self.workers,
+            profile=profile.path,
+            **self.stats,
+        )
+        
+        return new_records
+    
+    def watch(self, input_roots: List[str], interval: float = 60.0, settle_seconds: float = 30.0) -> int:
+        """Следит за папками и дописывает в датасет новые файлы по мере их появления (до Ctrl+C)"""
+        missing_roots = [root for root in input_roots if not os.path.isdir(root)]
+        if missing_roots:
+            logging.error(f"Папки не найдены: {', '.join(missing_roots)}")
+            return EXIT_USAGE
         
-        # Запрашиваем путь к папке с годом
+        def find_files() -> List[str]:
+            return sorted(set(file_path for root in input_roots for file_path in self.find_excel_files(root)))
+        
+        # Файлы с ошибкой (заблокированные, еще записываемые, с неизвестным паролем) возвращаются следующим опросом
+        def forget_failed(files: List[str]):
+            watcher.forget([file_path for file_path in files if os.path.basename(file_path) in self.failed_files])
+        
+        os.makedirs(self.output_dir, exist_ok=True)
+        watcher = FolderWatcher(find_files, settle_seconds)
+        
+        # Сначала обрабатываем файлы, появившиеся, пока сборщик не работал
+        excel_files = find_files()
+        watcher.snapshot(excel_files)
+        self.ingest_files(excel_files)
+        forget_failed(excel_files)
+        # Даже после полной пересборки новые файлы только дописываются
+        self.incremental = True
+        
+        logging.info(f"Наблюдение за папками: {', '.join(input_roots)} (опрос каждые {interval:g} с, Ctrl+C - выход)")
+        try:
+            while True:
+                time.sleep(interval)
+                ready_files = watcher.poll()
+                if not ready_files:
+                    continue
+                
+                logging.info(f"Новые или измененные файлы: {len(ready_files)}")
+                try:
+                    self.ingest_files(ready_files)
+                    forget_failed(ready_files)
+                except Exception as e:
+                    # Ошибка пакета не останавливает наблюдение: файлы будут взяты следующим опросом
+                    logging.error(f"Ошибка обработки новых файлов: {e}")
+                    watcher.forget(ready_files)
+        except KeyboardInterrupt:
+            logging.info("Наблюдение остановлено")
+        
+        return EXIT_OK
+    
+    def prompt_year_path(self) -> str:
+        """Запрашивает у пользователя путь к папке с годом"""
         while True:
             year_path = input("Введите путь к папке с годом (например, W:\\Customers\\Natures Way reports\\Archive\\2024): ").strip()
             
             if os.path.exists(year_path):
-                break
+                return year_path
             else:
                 print(f"Папка не найдена: {year_path}")
                 print("Попробуйте еще раз или нажмите Ctrl+C для выхода")
+    
+    def run(self, input_roots: Optional[List[str]] = None) -> int:
+        """Основной метод запуска; возвращает код завершения"""
+        print("=== Advanced Dataset Builder for Logistics Routes ===")
+        print("Сбор данных из Excel-файлов с ежедневными маршрутами")
+        print()
+        
+        # Без указанных папок запрашиваем путь к папке с годом
+        if input_roots is None:
+            input_roots = [self.prompt_year_path()]
+        
+        missing_roots = [root for root in input_roots if not os.path.isdir(root)]
+        if missing_roots:
+            logging.error(f"Папки не найдены: {', '.join(missing_roots)}")
+            return EXIT_USAGE
         
         # Находим Excel файлы
-        excel_files = self.find_excel_files(year_path)
+        excel_files = sorted(set(file_path for root in input_roots for file_path in self.find_excel_files(root)))
         
         if not excel_files:
-            logging.warning(f"Excel файлы не найдены в папке: {year_path}")
-            return
+            logging.warning(f"Excel файлы не найдены в папках: {', '.join(input_roots)}")
+            return EXIT_OK
         
+        os.makedirs(self.output_dir, exist_ok=True)
         logging.info(f"Найдено {len(excel_files)} Excel файлов")
+        logging.info(f"Движок чтения Excel: {self.engine}")
         
-        # Обрабатываем каждый файл
-        new_records = 0
-        for file_path in excel_files:
-            try:
-                file_records = self.process_excel_file(file_path)
-                self.combined_data.extend(file_records)
-                new_records += len(file_records)
-            except Exception as e:
-                logging.error(f"Критическая ошибка обработки файла {file_path}: {e}")
-                self.stats['errors'] += 1
-        
-        logging.info(f"\nОбработано файлов: {self.stats['files_processed']}")
-        logging.info(f"Пропущено файлов: {self.stats['files_skipped']}")
-        logging.info(f"Ошибок: {self.stats['errors']}")
-        logging.info(f"Извлечено заказов: {self.stats['orders_extracted']}")
-        logging.info(f"Извлечено доставок: {self.stats['deliveries_extracted']}")
-        logging.info(f"Добавлено новых записей: {new_records}")
-        
-        # Сохраняем датасет
-        self.save_dataset()
+        self.ingest_files(excel_files)
         
         print("\nОбработка завершена!")
         print(f"Результат сохранен в файлы:")
-        print("- combined_dataset.csv")
-        print("- combined_dataset.parquet")
-        print("- processing_statistics.csv")
+        if self.output_mode == 'partitioned':
+            print(f"- {self.dataset_dir}/Date=YYYY-MM-DD/*.parquet")
+        else:
+            if self.write_csv:
+                print(f"- {self.csv_path}")
+            print(f"- {self.parquet_path}")
+        print(f"- {self.statistics_path}")
+        print(f"- {self.run_log_path}")
+        if self.store is not None:
+            print(f"- {self.store_path}")
+        print(f"- {self.manifest.path}")
+        print(f"- {self.commit_log.path}")
         print("- dataset_builder.log")
+        
+        # Файлы с ошибками будут обработаны повторно при следующем запуске
+        if self.failed_files:
+            logging.warning(f"Файлов с ошибками: {len(self.failed_files)}")
+            return EXIT_FILE_ERRORS
+        return EXIT_OK
+
+# Экземпляр сборщика в рабочем процессе пула (создается один раз на процесс)
+_worker_builder = None
+
+def _init_worker(engine: str = 'auto', passwords: Optional[List[str]] = None, profiler: Optional[PipelineProfiler] = None):
+    """Инициализирует рабочий процесс: сборщик без загрузки существующего датасета"""
+    global _worker_builder
+    _worker_builder = AdvancedDatasetBuilder(workers=1, load_existing=False, engine=engine, passwords=passwords)
+    _worker_builder.profiler = profiler
 
-def main():
-    """Точка входа в программу"""
+def _process_file_in_worker(file_path: str, signature: Optional[Dict[str, Any]] = None
+                            ) -> Tuple[List[Dict[str, Any]], Dict[str, int], Optional[Dict[str, Any]], Dict[str, Any]]:
+    """Обрабатывает один файл в рабочем процессе и возвращает записи, прирост статистики, метрики и подпись файла"""
+    stats_before = dict(_worker_builder.stats)
+    file_records = _worker_builder.process_file_profiled(file_path, signature)
+    stats_delta = {key: value - stats_before[key] for key, value in _worker_builder.stats.items()
+                   if isinstance(value, int)}
+    return file_records, stats_delta, _worker_builder.last_file_metrics, _worker_builder.last_file_signature
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    """Разбирает аргументы командной строки"""
+    parser = argparse.ArgumentParser(
+        description="Сбор данных из Excel-файлов с ежедневными маршрутами. "
+                    "Без указанных папок путь запрашивается интерактивно.")
+    parser.add_argument('inputs', nargs='*', metavar='FOLDER',
+                        help="папки с Excel-файлами (например, папка с годом)")
+    parser.add_argument('-o', '--output-dir', default='.',
+                        help="папка для датасета, манифеста и статистики (по умолчанию текущая)")
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help="число процессов обработки, 0 - по числу ядер (по умолчанию 1)")
+    parser.add_argument('--full', action='store_true',
+                        help="пересобрать датасет из всех файлов вместо инкрементального дополнения")
+    parser.add_argument('--output-mode', choices=AdvancedDatasetBuilder.OUTPUT_MODES, default='combined',
+                        help="запись целиком, потоково или каталогом с разделами по дате")
+    parser.add_argument('--format', choices=('parquet', 'csv+parquet'), default='csv+parquet',
+                        help="форматы выходных файлов (по умолчанию csv+parquet)")
+    parser.add_argument('--reprocess', action='append', metavar='FILE_OR_DATE',
+                        help="обработать заново файл (имя файла или дата YYYY-MM-DD) и заменить его записи, "
+                             "можно указать несколько раз")
+    parser.add_argument('--checkpoint-files', type=int, default=0, metavar='N',
+                        help="фиксировать датасет и манифест каждые N обработанных файлов (по умолчанию 0 - нет)")
+    parser.add_argument('--checkpoint-seconds', type=float, default=600.0, metavar='SECONDS',
+                        help="фиксировать датасет и манифест не реже чем раз в SECONDS секунд обработки, "
+                             "0 - только в конце запуска (по умолчанию 600)")
+    parser.add_argument('--store', action='store_true',
+                        help=f"также сохранять записи в базу SQLite {STORE_PATH} для запросов")
+    parser.add_argument('--engine', choices=ENGINES, default='auto',
+                        help="движок чтения Excel (по умолчанию auto)")
+    parser.add_argument('--password', action='append', dest='passwords', metavar='PASSWORD',
+                        help="пароль для защищенных книг, можно указать несколько раз")
+    parser.add_argument('--profile', choices=PROFILE_SCOPES,
+                        help="профилировать каждый файл (file) или весь запуск (run), профили - в папке profiles")
+    parser.add_argument('--profile-threshold', type=float, default=0.0, metavar='SECONDS',
+                        help="сохранять профиль, только если обработка заняла не меньше SECONDS секунд (по умолчанию 0)")
+    parser.add_argument('--watch', action='store_true',
+                        help="не завершаться, а следить за папками и обрабатывать новые файлы")
+    parser.add_argument('--interval', type=float, default=60.0,
+                        help="период опроса папок в режиме наблюдения, секунд (по умолчанию 60)")
+    parser.add_argument('--settle', type=float, default=30.0,
+                        help="сколько секунд файл не должен меняться, чтобы считаться записанным (по умолчанию 30)")
+    args = parser.parse_args(argv)
+    if args.watch and not args.inputs:
+        parser.error("для режима наблюдения нужно указать папки")
+    return args
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """Точка входа в программу; возвращает код завершения"""
+    args = parse_args(argv)
+    # Без указанных папок - интерактивный режим с запросом пути и паузой после ошибки
+    interactive = not args.inputs
+    
     try:
-        builder = AdvancedDatasetBuilder()
-        builder.run()
+        builder = AdvancedDatasetBuilder(
+            workers=args.workers or None,
+            output_mode=args.output_mode,
+            write_csv=args.format == 'csv+parquet',
+            engine=args.engine,
+            passwords=args.passwords,
+            output_dir=args.output_dir,
+            incremental=not args.full,
+            profile=args.profile,
+            profile_threshold=args.profile_threshold,
+            store=args.store,
+            reprocess=args.reprocess,
+            checkpoint_files=args.checkpoint_files,
+            checkpoint_seconds=args.checkpoint_seconds,
+        )
+        if args.watch:
+            return builder.watch(args.inputs, interval=args.interval, settle_seconds=args.settle)
+        return builder.run(args.inputs or None)
     except KeyboardInterrupt:
         print("\nПрограмма прервана пользователем")
         logging.info("Программа прервана пользователем")
+        return EXIT_INTERRUPTED
     except Exception as e:
         print(f"Критическая ошибка: {e}")
         logging.error(f"Критическая ошибка: {e}")
-        input("Нажмите Enter для выхода...")
+        if interactive:
+            input("Нажмите Enter для выхода...")
+        return EXIT_FAILURE
 
 if __name__ == "__main__":
-    main()
+    multiprocessing.freeze_support()  # Нужно для пула процессов в собранном .exe
+    sys.exit(main())
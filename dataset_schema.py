@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Dataset schema for Dataset Builder
+Постоянный набор колонок и компактные типы выходного датасета
+"""
+
+import json
+from typing import Any, Dict, List
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+# Колонка, в которую попадают все остальные (extra_*) поля записи в виде JSON
+EXTRA_COLUMN = 'Extra'
+
+# Основные колонки в порядке вывода
+CORE_COLUMNS = [
+    'Date', 'Client_Name', 'Delivery_Name', 'Pallets_Ordered', 'Temperature',
+    'Source_Sheet', 'Source_File',
+    'load_number', 'collection_site', 'delivery_destination', 'pallets_ordered',
+    'pallet_type', 'trailer_type', 'trailer_fill', 'driver', 'vehicle', 'route',
+]
+
+# Типы колонок: дата, целые количества паллет, доля заполнения и номер загрузки (почти уникален);
+# остальные строки повторяются от записи к записи и хранятся со словарным кодированием
+DATE_COLUMNS = ['Date']
+INTEGER_COLUMNS = ['Pallets_Ordered', 'pallets_ordered']
+FLOAT_COLUMNS = ['trailer_fill']
+STRING_COLUMNS = ['load_number']
+DICTIONARY_TYPE = pa.dictionary(pa.int32(), pa.string())
+
+
+def _column_type(name: str) -> pa.DataType:
+    """Тип колонки в схеме датасета"""
+    if name in DATE_COLUMNS:
+        return pa.date32()
+    if name in INTEGER_COLUMNS:
+        return pa.int32()
+    if name in FLOAT_COLUMNS:
+        return pa.float64()
+    if name in STRING_COLUMNS:
+        return pa.string()
+    return DICTIONARY_TYPE
+
+
+DATASET_SCHEMA = pa.schema(
+    [pa.field(name, _column_type(name)) for name in CORE_COLUMNS]
+    + [pa.field(EXTRA_COLUMN, pa.string())]
+)
+
+
+def _json_default(value: Any):
+    """Преобразует значения numpy и даты для JSON"""
+    if isinstance(value, np.generic):
+        return value.item()
+    return str(value)
+
+
+def _text_column(column: pd.Series) -> pd.Series:
+    """Текстовое представление колонки с сохранением пустых значений"""
+    present = column.notna()
+    result = pd.Series(None, index=column.index, dtype=object)
+    result[present] = column[present].astype(str)
+    return result
+
+
+def _extra_column(df: pd.DataFrame) -> pd.Series:
+    """Собирает неосновные колонки каждой строки в JSON (только непустые значения)"""
+    if df.empty or len(df.columns) == 0:
+        return pd.Series(None, index=df.index, dtype=object)
+
+    columns = [str(column) for column in df.columns]
+    present = df.notna().to_numpy()
+    values = []
+    for row, row_present in zip(df.to_numpy(dtype=object), present):
+        extra = {column: value for column, value, is_present in zip(columns, row, row_present) if is_present}
+        values.append(json.dumps(extra, ensure_ascii=False, default=_json_default) if extra else None)
+    return pd.Series(values, index=df.index, dtype=object)
+
+
+def _merge_extra(existing: Any, new: Any) -> Any:
+    """Объединяет два JSON с дополнительными полями"""
+    if not isinstance(existing, str) or not isinstance(new, str):
+        return new if not isinstance(existing, str) else existing
+    merged = {**json.loads(existing), **json.loads(new)}
+    return json.dumps(merged, ensure_ascii=False)
+
+
+def _date_column(column: pd.Series) -> pd.Series:
+    """Даты в формате ISO (строки, даты или временные метки); нераспознанные значения - NaT"""
+    return pd.to_datetime(column, errors='coerce', format='ISO8601').dt.normalize()
+
+
+def _integer_column(column: pd.Series) -> pd.Series:
+    """Целые значения колонки; дробные, нечисловые и слишком большие значения - NaN"""
+    numeric = pd.to_numeric(column, errors='coerce').astype('float64')
+    is_integer = (numeric % 1 == 0) & (numeric.abs() < 2 ** 31)
+    return numeric.where(is_integer)
+
+
+def frame_to_table(df: pd.DataFrame) -> pa.Table:
+    """Приводит таблицу записей к схеме датасета
+
+    Значения, которые нельзя без потерь привести к типу основной колонки (дробные паллеты,
+    нераспознанная дата), сохраняются в исходном виде в колонке Extra под именем колонки.
+    """
+    columns = {}
+    lost_values = {}
+    for name in CORE_COLUMNS:
+        column_type = DATASET_SCHEMA.field(name).type
+        if name not in df.columns:
+            columns[name] = pa.nulls(len(df), type=column_type)
+            continue
+
+        column = df[name]
+        if name in DATE_COLUMNS:
+            values = _date_column(column)
+            columns[name] = pa.array(values, from_pandas=True).cast(column_type)
+        elif name in INTEGER_COLUMNS:
+            values = _integer_column(column)
+            columns[name] = pa.array(values, type=column_type, from_pandas=True)
+        elif name in FLOAT_COLUMNS:
+            values = pd.to_numeric(column, errors='coerce').astype('float64')
+            columns[name] = pa.array(values, type=column_type, from_pandas=True)
+        else:
+            values = _text_column(column)
+            array = pa.array(values, type=pa.string(), from_pandas=True)
+            columns[name] = array.dictionary_encode() if column_type == DICTIONARY_TYPE else array
+
+        is_lost = column.notna() & values.isna()
+        if is_lost.any():
+            lost_values[name] = column.where(is_lost)
+
+    extra_columns = [column for column in df.columns if column not in CORE_COLUMNS and column != EXTRA_COLUMN]
+    extra_df = df[extra_columns]
+    if lost_values:
+        extra_df = pd.concat([extra_df, pd.DataFrame(lost_values, index=df.index)], axis=1)
+    extra = _extra_column(extra_df)
+    if EXTRA_COLUMN in df.columns:
+        # Уже приведенная таблица: существующий JSON дополняется новыми полями
+        existing = _text_column(df[EXTRA_COLUMN])
+        extra = pd.Series([
+            _merge_extra(old, new) for old, new in zip(existing, extra)
+        ], index=df.index, dtype=object)
+    columns[EXTRA_COLUMN] = pa.array(extra, type=pa.string(), from_pandas=True)
+
+    return pa.table(columns, schema=DATASET_SCHEMA)
+
+
+def records_to_table(records: List[Dict[str, Any]]) -> pa.Table:
+    """Приводит список записей к схеме датасета"""
+    return frame_to_table(pd.DataFrame(records))
+
+
+def conform_table(table: pa.Table) -> pa.Table:
+    """Приводит таблицу с произвольным набором колонок к схеме датасета"""
+    if table.schema.equals(DATASET_SCHEMA):
+        return table
+    return frame_to_table(table.to_pandas())
+
+
+def table_to_frame(table: pa.Table) -> pd.DataFrame:
+    """Таблица датасета для записи в CSV: целые остаются целыми и при пропусках"""
+    return table.to_pandas(integer_object_nulls=True)
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Dataset store for Dataset Builder
+Локальная база SQLite с записями датасета: замена записей по исходному файлу и запросы без чтения всего датасета
+"""
+
+import os
+import sqlite3
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Optional, Sequence
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from dataset_schema import DATASET_SCHEMA, conform_table
+
+STORE_PATH = "combined_dataset.sqlite"
+
+RECORDS_TABLE = 'records'
+SOURCE_FILES_TABLE = 'source_files'
+
+# Имена колонок в SQLite не различают регистр: pallets_ordered из 'Collection Plan' совпала бы
+# с Pallets_Ordered из 'Pallet Order'
+STORE_COLUMN_NAMES = {'pallets_ordered': 'plan_pallets_ordered'}
+
+# Колонки, по которым чаще всего отбираются записи
+INDEXED_COLUMNS = ['Date', 'Source_File', 'load_number', 'Delivery_Name', 'delivery_destination']
+
+# Записи вставляются пачками, чтобы не держать в памяти копию всего файла в виде кортежей
+INSERT_BATCH_SIZE = 10000
+
+
+def _sql_type(data_type: pa.DataType) -> str:
+    """Тип колонки SQLite для типа колонки датасета (даты хранятся строками YYYY-MM-DD)"""
+    if pa.types.is_integer(data_type):
+        return 'INTEGER'
+    if pa.types.is_floating(data_type):
+        return 'REAL'
+    return 'TEXT'
+
+
+def _quote(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+
+def store_column(name: str) -> str:
+    """Имя колонки датасета в базе"""
+    return STORE_COLUMN_NAMES.get(name, name)
+
+
+def _plain_column(column: pa.ChunkedArray) -> pa.ChunkedArray:
+    """Колонка в виде, который SQLite принимает без адаптеров: даты и словари - строками"""
+    if pa.types.is_dictionary(column.type) or pa.types.is_date(column.type):
+        return pc.cast(column, pa.string())
+    return column
+
+
+class DatasetStore:
+    """Записи датасета в базе SQLite с индексами и учетом загруженных файлов
+
+    Записи каждого исходного файла заменяются целиком в одной транзакции, поэтому повторная
+    загрузка того же файла не создает дубликатов.
+    """
+
+    def __init__(self, path: str = STORE_PATH):
+        self.path = path
+        self.connection: Optional[sqlite3.Connection] = None
+
+    def open(self):
+        """Открывает базу и создает таблицы и индексы, если их нет"""
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self.connection = sqlite3.connect(self.path)
+        # Журнал WAL: запросы читателей не блокируются загрузкой новых файлов
+        self.connection.execute('PRAGMA journal_mode=WAL')
+
+        columns = ', '.join(f"{_quote(store_column(field.name))} {_sql_type(field.type)}" for field in DATASET_SCHEMA)
+        with self.connection:
+            self.connection.execute(f"CREATE TABLE IF NOT EXISTS {RECORDS_TABLE} ({columns})")
+            for column in INDEXED_COLUMNS:
+                self.connection.execute(
+                    f"CREATE INDEX IF NOT EXISTS idx_{RECORDS_TABLE}_{column.lower()} ON {RECORDS_TABLE} ({_quote(column)})")
+            self.connection.execute(
+                f"CREATE TABLE IF NOT EXISTS {SOURCE_FILES_TABLE} "
+                f"(Source_File TEXT PRIMARY KEY, records INTEGER NOT NULL, ingested_at TEXT NOT NULL)")
+        return self
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _iter_rows(self, table: pa.Table) -> Iterator[List[tuple]]:
+        """Строки таблицы пачками кортежей в порядке колонок схемы"""
+        for batch in conform_table(table).to_batches(INSERT_BATCH_SIZE):
+            columns = [_plain_column(pa.chunked_array([column])).to_pylist() for column in batch.columns]
+            yield list(zip(*columns))
+
+    def upsert_file(self, source_file: Optional[str], table: pa.Table):
+        """Заменяет все записи исходного файла записями table"""
+        placeholders = ', '.join('?' for _ in DATASET_SCHEMA)
+        with self.connection:
+            if source_file is None:
+                self.connection.execute(f"DELETE FROM {RECORDS_TABLE} WHERE Source_File IS NULL")
+            else:
+                self.connection.execute(f"DELETE FROM {RECORDS_TABLE} WHERE Source_File = ?", (source_file,))
+            for rows in self._iter_rows(table):
+                self.connection.executemany(f"INSERT INTO {RECORDS_TABLE} VALUES ({placeholders})", rows)
+            if source_file is not None:
+                self.connection.execute(
+                    f"INSERT OR REPLACE INTO {SOURCE_FILES_TABLE} VALUES (?, ?, ?)",
+                    (source_file, table.num_rows, datetime.now().isoformat(timespec='seconds')))
+
+    def clear(self):
+        """Удаляет все записи (перед полной пересборкой)"""
+        with self.connection:
+            self.connection.execute(f"DELETE FROM {RECORDS_TABLE}")
+            self.connection.execute(f"DELETE FROM {SOURCE_FILES_TABLE}")
+
+    def ingested_files(self) -> Dict[str, int]:
+        """Загруженные файлы и число их записей"""
+        cursor = self.connection.execute(f"SELECT Source_File, records FROM {SOURCE_FILES_TABLE}")
+        return {source_file: records for source_file, records in cursor}
+
+    def record_count(self) -> int:
+        """Число записей в базе"""
+        return self.connection.execute(f"SELECT COUNT(*) FROM {RECORDS_TABLE}").fetchone()[0]
+
+    def query(self, sql: str, params: Sequence[Any] = ()) -> pd.DataFrame:
+        """Выполняет запрос SQL и возвращает результат таблицей"""
+        return pd.read_sql_query(sql, self.connection, params=params)
@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Dataset writers for Dataset Builder
+Потоковая и секционированная запись датасета: записи каждого файла сразу сбрасываются на диск
+"""
+
+import glob
+import json
+import os
+import shutil
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from commit_log import OutputTransaction, fsync_dir, fsync_file, install
+from dataset_schema import DATASET_SCHEMA, conform_table, frame_to_table, records_to_table, table_to_frame
+
+# Размер пакета при чтении существующего датасета из CSV
+CSV_CHUNK_ROWS = 50000
+
+# Каталог частей контрольных точек рядом с файлом Parquet датасета
+CHECKPOINT_DIR_SUFFIX = '.checkpoints'
+
+
+def split_sources(table: pa.Table, sources: Iterable[str]) -> Tuple[pa.Table, pa.Table]:
+    """Делит строки таблицы на записи остальных файлов и записи исходных файлов sources"""
+    value_set = pa.array(sorted(sources), type=pa.string())
+    is_source = pc.fill_null(pc.is_in(table['Source_File'], value_set=value_set), False)
+    return table.filter(pc.invert(is_source)), table.filter(is_source)
+
+
+def iter_source_tables(tables: Iterable[pa.Table]) -> Iterator[Tuple[Optional[str], pa.Table]]:
+    """Группирует пакеты датасета по исходным файлам: записи каждого файла выдаются одной таблицей
+
+    Каждый пакет группируется по Source_File один раз. Записи файла в датасете идут подряд (так их
+    пишут сборщики), поэтому в памяти держатся только записи файла, которые продолжаются в следующем пакете.
+    """
+    pending_source = None
+    pending: List[pa.Table] = []
+    for table in tables:
+        if table.num_rows == 0:
+            continue
+
+        indexed = table.append_column('__row', pa.array(np.arange(table.num_rows)))
+        groups = indexed.group_by('Source_File', use_threads=False).aggregate([('__row', 'list')])
+        rows = groups['__row_list'].combine_chunks()
+        for index, source in enumerate(groups['Source_File'].to_pylist()):
+            if pending and source != pending_source:
+                yield pending_source, pa.concat_tables(pending)
+                pending = []
+            pending_source = source
+            pending.append(table.take(rows[index].values))
+
+    if pending:
+        yield pending_source, pa.concat_tables(pending)
+
+
+def iter_parquet_tables(path: str) -> Iterator[pa.Table]:
+    """Читает файл Parquet пакетами в схеме датасета"""
+    for batch in pq.ParquetFile(path).iter_batches():
+        yield conform_table(pa.Table.from_batches([batch]))
+
+
+def checkpoint_dir(parquet_path: str) -> str:
+    """Каталог частей контрольных точек датасета"""
+    return f"{parquet_path}{CHECKPOINT_DIR_SUFFIX}"
+
+
+def checkpoint_parts(parquet_path: str) -> List[Tuple[str, Set[str]]]:
+    """Части контрольных точек в порядке фиксации и исходные файлы, записи которых в них зафиксированы"""
+    directory = checkpoint_dir(parquet_path)
+    if not os.path.isdir(directory):
+        return []
+
+    parts = []
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith('.parquet'):
+            continue
+        path = os.path.join(directory, name)
+        metadata = pq.read_schema(path).metadata or {}
+        parts.append((path, set(json.loads(metadata.get(b'sources', b'[]')))))
+    return parts
+
+
+def write_checkpoint_part(parquet_path: str, tables: List[pa.Table], sources: Iterable[str],
+                          transaction: OutputTransaction):
+    """Записывает часть контрольной точки: записи исходных файлов sources, обработанных после предыдущей точки
+
+    Список файлов хранится в метаданных части: файл без записей тоже заменяет свои прежние записи.
+    """
+    directory = checkpoint_dir(parquet_path)
+    os.makedirs(directory, exist_ok=True)
+    numbers = [int(name.split('.')[0]) for name in os.listdir(directory) if name.endswith('.parquet')]
+    path = os.path.join(directory, f"{max(numbers, default=0) + 1:06d}.parquet")
+
+    table = pa.concat_tables([conform_table(table) for table in tables]) if tables else DATASET_SCHEMA.empty_table()
+    table = table.replace_schema_metadata({'sources': json.dumps(sorted(sources), ensure_ascii=False)})
+    pq.write_table(table, f"{path}.tmp")
+    fsync_file(f"{path}.tmp")
+    transaction.stage(f"{path}.tmp", path)
+
+
+def iter_dataset_tables(parquet_path: str, csv_path: Optional[str] = None,
+                        exclude_sources: Iterable[str] = ()) -> Iterator[pa.Table]:
+    """Читает однофайловый датасет пакетами в схеме датасета, пропуская записи исходных файлов exclude_sources
+
+    Читается Parquet, а если его нет - CSV. Вместе с StreamingDatasetWriter это замена записей
+    исходных файлов без загрузки всего датасета в память. Части контрольных точек прерванного запуска
+    читаются после датасета и заменяют записи своих исходных файлов в датасете и в более ранних частях.
+    """
+    excluded = set(exclude_sources)
+    parts = checkpoint_parts(parquet_path)
+
+    if os.path.exists(parquet_path):
+        tables = iter_parquet_tables(parquet_path)
+    elif csv_path and os.path.exists(csv_path):
+        tables = (frame_to_table(chunk) for chunk in pd.read_csv(csv_path, chunksize=CSV_CHUNK_ROWS))
+    else:
+        tables = iter(())
+
+    readers = [tables] + [iter_parquet_tables(path) for path, _ in parts]
+    for index, reader in enumerate(readers):
+        replaced = excluded.union(*(part_sources for _, part_sources in parts[index:]))
+        for table in reader:
+            if replaced:
+                table, _ = split_sources(table, replaced)
+            yield table
+
+
+class StreamingDatasetWriter:
+    """Пишет Parquet (и при необходимости CSV) пакетами, не держа весь датасет в памяти
+
+    Данные пишутся во временные файлы, которые при успешном закрытии сбрасываются на диск и заменяют
+    итоговые; с transaction замена откладывается до фиксации вместе с другими файлами запуска.
+    """
+
+    def __init__(self, parquet_path: str, csv_path: Optional[str] = None,
+                 transaction: Optional[OutputTransaction] = None):
+        self.parquet_path = parquet_path
+        self.csv_path = csv_path
+        self.transaction = transaction
+        self.rows_written = 0
+        self.closed = False
+        self._parquet_writer = None
+        self._csv_file = None
+
+    def _tmp_path(self, path: str) -> str:
+        return f"{path}.tmp"
+
+    def open(self):
+        """Открывает временные файлы для записи"""
+        self._parquet_writer = pq.ParquetWriter(self._tmp_path(self.parquet_path), DATASET_SCHEMA)
+        if self.csv_path:
+            self._csv_file = open(self._tmp_path(self.csv_path), 'w', encoding='utf-8', newline='')
+        return self
+
+    def write_table(self, table: pa.Table):
+        """Записывает пакет строк, приводя его к схеме датасета"""
+        table = conform_table(table)
+        if table.num_rows == 0:
+            return
+
+        self._parquet_writer.write_table(table)
+        if self._csv_file is not None:
+            table_to_frame(table).to_csv(self._csv_file, index=False, header=self.rows_written == 0)
+        self.rows_written += table.num_rows
+
+    def write_records(self, records: List[Dict[str, Any]]):
+        """Записывает записи одного обработанного файла"""
+        if records:
+            self.write_table(records_to_table(records))
+
+    def close(self):
+        """Закрывает файлы, сбрасывает их на диск и заменяет ими итоговые файлы датасета"""
+        self._parquet_writer.close()
+        fsync_file(self._tmp_path(self.parquet_path))
+        paths = [self.parquet_path]
+        if self._csv_file is not None:
+            if self.rows_written == 0:
+                # Пустой датасет: записываем хотя бы заголовок
+                self._csv_file.write(','.join(DATASET_SCHEMA.names) + '\n')
+            self._csv_file.flush()
+            os.fsync(self._csv_file.fileno())
+            self._csv_file.close()
+            paths.append(self.csv_path)
+
+        # Записи частей контрольных точек уже вошли в датасет: каталог частей заменяется пустым
+        directory = checkpoint_dir(self.parquet_path)
+        if os.path.isdir(directory) and os.listdir(directory):
+            if os.path.isdir(self._tmp_path(directory)):
+                shutil.rmtree(self._tmp_path(directory))
+            os.makedirs(self._tmp_path(directory))
+            paths.append(directory)
+
+        for path in paths:
+            if self.transaction is not None:
+                self.transaction.stage(self._tmp_path(path), path)
+            else:
+                install(self._tmp_path(path), path)
+        self.closed = True
+
+    def abort(self):
+        """Прерывает запись и удаляет временные файлы, итоговые файлы не меняются"""
+        # Закрытые файлы уже переданы фиксации
+        if self.closed:
+            return
+        if self._parquet_writer is not None:
+            self._parquet_writer.close()
+        if self._csv_file is not None:
+            self._csv_file.close()
+        for path in (self.parquet_path, self.csv_path):
+            if path and os.path.exists(self._tmp_path(path)):
+                os.remove(self._tmp_path(path))
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class PartitionedDatasetWriter:
+    """Пишет датасет в каталог Parquet с разбиением по дате в стиле Hive
+
+    Структура: <каталог>/Date=YYYY-MM-DD/<исходный файл>.parquet. Каждый исходный файл хранится
+    отдельной частью, поэтому запуск переписывает только части затронутых файлов.
+    """
+
+    PARTITION_COLUMN = 'Date'
+    NULL_PARTITION = '__HIVE_DEFAULT_PARTITION__'
+
+    def __init__(self, dataset_dir: str):
+        self.dataset_dir = dataset_dir
+        self.rows_written = 0
+        self.parts_written = 0
+
+    def exists(self) -> bool:
+        """Проверяет, создан ли уже каталог датасета"""
+        return os.path.isdir(self.dataset_dir)
+
+    def part_name(self, source_file: Optional[str]) -> str:
+        """Имя файла части для исходного файла"""
+        return f"{source_file or 'unknown'}.parquet"
+
+    def partition_dir(self, date: Optional[str]) -> str:
+        """Каталог раздела для даты"""
+        return os.path.join(self.dataset_dir, f"{self.PARTITION_COLUMN}={date or self.NULL_PARTITION}")
+
+    def source_parts(self, source_file: Optional[str]) -> List[str]:
+        """Находит части исходного файла во всех разделах"""
+        pattern = os.path.join(glob.escape(self.dataset_dir), f"{self.PARTITION_COLUMN}=*", glob.escape(self.part_name(source_file)))
+        return [os.path.normpath(path) for path in glob.glob(pattern)]
+
+    def iter_tables(self) -> Iterator[pa.Table]:
+        """Читает каталог пакетами в схеме датасета; части одного исходного файла читаются подряд"""
+        pattern = os.path.join(glob.escape(self.dataset_dir), f"{self.PARTITION_COLUMN}=*", '*.parquet')
+        parts = sorted(glob.glob(pattern), key=lambda path: (os.path.basename(path), path))
+        for path in parts:
+            date = os.path.basename(os.path.dirname(path)).split('=', 1)[1]
+            date = None if date == self.NULL_PARTITION else date
+            for batch in pq.ParquetFile(path).iter_batches():
+                table = pa.Table.from_batches([batch])
+                table = table.append_column(self.PARTITION_COLUMN, pa.repeat(pa.scalar(date, pa.string()), table.num_rows))
+                yield conform_table(table)
+
+    def remove_source(self, source_file: Optional[str]) -> int:
+        """Удаляет части исходного файла из всех разделов"""
+        parts = self.source_parts(source_file)
+        for path in parts:
+            os.remove(path)
+        return len(parts)
+
+    def write_table(self, table: pa.Table, source_file: Optional[str], replace: bool = True):
+        """Записывает строки одного исходного файла в разделы по дате
+
+        При replace=True удаляются и части этого файла в других разделах; для нового файла
+        поиск по разделам можно пропустить.
+        """
+        table = conform_table(table)
+
+        # Сначала пишем новые части во временные файлы, затем заменяем ими старые
+        new_parts = {}
+        dates = table[self.PARTITION_COLUMN]
+        for date in pc.unique(dates).to_pylist():
+            mask = pc.is_null(dates) if date is None else pc.equal(dates, date)
+            part = table.filter(mask).drop_columns([self.PARTITION_COLUMN])
+
+            partition_dir = self.partition_dir(date)
+            os.makedirs(partition_dir, exist_ok=True)
+            part_path = os.path.normpath(os.path.join(partition_dir, self.part_name(source_file)))
+            pq.write_table(part, f"{part_path}.tmp")
+            fsync_file(f"{part_path}.tmp")
+            new_parts[part_path] = part.num_rows
+
+        # Части исходного файла в других разделах (например, при смене даты) больше не нужны
+        if replace:
+            for path in self.source_parts(source_file):
+                if path not in new_parts:
+                    os.remove(path)
+
+        for part_path, num_rows in new_parts.items():
+            os.replace(f"{part_path}.tmp", part_path)
+            fsync_dir(os.path.dirname(part_path))
+            self.rows_written += num_rows
+            self.parts_written += 1
+
+    def write_records(self, records: List[Dict[str, Any]], source_file: str, replace: bool = True):
+        """Записывает (заменяет) записи одного обработанного файла"""
+        self.write_table(records_to_table(records), source_file, replace)
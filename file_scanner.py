@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+File scanner for Dataset Builder
+Поиск Excel-файлов за один проход os.scandir с кешем содержимого папок по времени изменения
+"""
+
+import fnmatch
+import json
+import os
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+
+SCAN_CACHE_PATH = "scan_cache.json"
+
+# Файлы с ежедневными маршрутами
+EXCEL_FILE_PATTERNS = ('Lyons collections*.xlsx', 'Lyons collections*.xlsm')
+
+# Временные файлы блокировки, которые Excel создает рядом с открытой книгой
+LOCK_FILE_PREFIX = '~$'
+
+# Папка, измененная позже этого срока до сканирования, не кешируется: время изменения
+# на некоторых файловых системах хранится с точностью до секунд, и новый файл мог бы не попасть в кеш
+RACY_INTERVAL_NS = 2 * 10 ** 9
+
+
+class DirectoryScanCache:
+    """Кеш содержимого папок: подходящие файлы и вложенные папки для каждого времени изменения папки
+
+    Время изменения папки меняется при добавлении, удалении или переименовании элементов в ней,
+    поэтому для неизмененной папки список файлов берется из кеша без чтения папки.
+    """
+
+    def __init__(self, path: str = SCAN_CACHE_PATH):
+        self.path = path
+        # Папка -> {'mtime_ns': ..., 'files': [...], 'subdirs': [...]}
+        self.entries: Dict[str, Dict] = {}
+        self.dirty = False
+
+    def load(self) -> bool:
+        """Загружает кеш с диска, если он существует"""
+        if not os.path.exists(self.path):
+            return False
+
+        with open(self.path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        self.entries = data.get('directories', {})
+        return True
+
+    def save(self):
+        """Сохраняет кеш на диск, если он изменился"""
+        if not self.dirty:
+            return
+
+        # Поиск файлов выполняется до создания папки результатов
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        # Временный файл заменяет кеш целиком: прерванный запуск не оставит обрезанный кеш
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'directories': self.entries}, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+        self.dirty = False
+
+    def get(self, directory: str, mtime_ns: int) -> Optional[Tuple[List[str], List[str]]]:
+        """Файлы и вложенные папки из кеша, если папка не менялась"""
+        entry = self.entries.get(directory)
+        if entry is None or entry['mtime_ns'] != mtime_ns:
+            return None
+        return entry['files'], entry['subdirs']
+
+    def put(self, directory: str, mtime_ns: int, files: List[str], subdirs: List[str]):
+        """Запоминает содержимое папки"""
+        self.entries[directory] = {'mtime_ns': mtime_ns, 'files': files, 'subdirs': subdirs}
+        self.dirty = True
+
+
+def list_directory(directory: str, patterns: Sequence[str] = EXCEL_FILE_PATTERNS) -> Tuple[List[str], List[str]]:
+    """Читает папку один раз: подходящие под шаблоны файлы и вложенные папки
+
+    Как и glob, пропускает скрытые элементы (имена с точки) и сравнивает имена с учетом
+    регистра файловой системы. Файлы блокировки Excel (~$...) пропускаются.
+    """
+    files = []
+    subdirs = []
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            name = entry.name
+            if name.startswith('.') or name.startswith(LOCK_FILE_PREFIX):
+                continue
+            if entry.is_dir():
+                subdirs.append(name)
+            elif any(fnmatch.fnmatch(name, pattern) for pattern in patterns) and entry.is_file():
+                files.append(name)
+    return files, subdirs
+
+
+def scan_excel_files(root: str, patterns: Sequence[str] = EXCEL_FILE_PATTERNS,
+                     cache: Optional[DirectoryScanCache] = None) -> List[str]:
+    """Рекурсивно находит файлы по шаблонам за один проход; неизмененные папки берутся из кеша"""
+    found = []
+    directories = [root]
+    while directories:
+        directory = directories.pop()
+        try:
+            mtime_ns = os.stat(directory).st_mtime_ns
+        except OSError:
+            continue
+
+        cache_key = os.path.abspath(directory)
+        listing = cache.get(cache_key, mtime_ns) if cache is not None else None
+        if listing is None:
+            try:
+                listing = list_directory(directory, patterns)
+            except OSError:
+                continue
+            if cache is not None and time.time_ns() - mtime_ns > RACY_INTERVAL_NS:
+                cache.put(cache_key, mtime_ns, *listing)
+
+        files, subdirs = listing
+        found.extend(os.path.join(directory, name) for name in files)
+        directories.extend(os.path.join(directory, name) for name in subdirs)
+
+    return sorted(found)
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Folder watcher for Dataset Builder
+Отслеживание новых и измененных файлов в папках опросом с ожиданием окончания записи
+"""
+
+import os
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from file_scanner import RACY_INTERVAL_NS
+
+# Подпись файла: размер и время изменения
+FileSignature = Tuple[int, int]
+
+
+def file_signature(file_path: str) -> Optional[FileSignature]:
+    """Размер и время изменения файла или None, если файл недоступен"""
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+
+class FolderWatcher:
+    """Находит файлы, которые появились или изменились с прошлого опроса и больше не записываются
+
+    Файл считается готовым, когда его размер и время изменения не менялись settle_seconds секунд:
+    файл, который еще копируется на общий диск, подождет следующего опроса. Опрос работает и на
+    сетевых дисках, где уведомления файловой системы не приходят.
+
+    Файлы папки, время изменения которой не менялось с прошлого опроса, не проверяются: новые,
+    удаленные и замененные через переименование (как при сохранении из Excel) файлы меняют время
+    изменения папки. Файл, перезаписанный на месте, находится полной проверкой раз в full_scan_every опросов.
+    """
+
+    def __init__(self, find_files: Callable[[], List[str]], settle_seconds: float = 30.0,
+                 clock: Callable[[], float] = time.monotonic, full_scan_every: int = 10):
+        self.find_files = find_files
+        self.settle_seconds = settle_seconds
+        self.clock = clock
+        self.full_scan_every = full_scan_every
+        self.polls = 0
+        # Файл -> подпись, с которой он уже передан на обработку
+        self.handled: Dict[str, FileSignature] = {}
+        # Файл -> (подпись, время, с которого она не меняется)
+        self.pending: Dict[str, Tuple[FileSignature, float]] = {}
+        # Папка -> время изменения, при котором ее файлы были проверены
+        self.directories: Dict[str, int] = {}
+
+    def changed_directories(self, files: List[str], full_scan: bool = False) -> Dict[str, Optional[int]]:
+        """Папки файлов, изменившиеся с прошлой проверки, и их текущее время изменения"""
+        changed = {}
+        for directory in set(os.path.dirname(file_path) for file_path in files):
+            try:
+                mtime_ns = os.stat(directory).st_mtime_ns
+            except OSError:
+                mtime_ns = None
+            if full_scan or mtime_ns is None or self.directories.get(directory) != mtime_ns:
+                changed[directory] = mtime_ns
+        return changed
+
+    def remember_directories(self, directories: Dict[str, Optional[int]]):
+        """Запоминает время изменения проверенных папок
+
+        Папка, измененная совсем недавно, не запоминается: время изменения на некоторых файловых
+        системах хранится с точностью до секунд, и следующее изменение могло бы его не поменять.
+        """
+        now_ns = time.time_ns()
+        for directory, mtime_ns in directories.items():
+            if mtime_ns is not None and now_ns - mtime_ns > RACY_INTERVAL_NS:
+                self.directories[directory] = mtime_ns
+            else:
+                self.directories.pop(directory, None)
+
+    def snapshot(self, files: Optional[List[str]] = None):
+        """Отмечает текущее состояние файлов как уже обработанное"""
+        files = files if files is not None else self.find_files()
+        # Время изменения папок берется до проверки файлов: файл, добавленный после, изменит его
+        directories = self.changed_directories(files, full_scan=True)
+        for file_path in files:
+            signature = file_signature(file_path)
+            if signature is not None:
+                self.handled[file_path] = signature
+                self.pending.pop(file_path, None)
+        self.remember_directories(directories)
+
+    def forget(self, files: List[str]):
+        """Снимает отметку об обработке, чтобы файлы были возвращены следующим опросом"""
+        for file_path in files:
+            self.handled.pop(file_path, None)
+
+    def poll(self) -> List[str]:
+        """Возвращает новые и измененные файлы, запись которых завершена"""
+        now = self.clock()
+        self.polls += 1
+        full_scan = self.full_scan_every > 0 and self.polls % self.full_scan_every == 0
+        files = self.find_files()
+        directories = self.changed_directories(files, full_scan)
+
+        ready = []
+        for file_path in files:
+            # В неизмененной папке проверяются только новые и еще записываемые файлы
+            if (os.path.dirname(file_path) not in directories and file_path in self.handled
+                    and file_path not in self.pending):
+                continue
+
+            signature = file_signature(file_path)
+            if signature is None or self.handled.get(file_path) == signature:
+                continue
+
+            pending = self.pending.get(file_path)
+            if pending is None or pending[0] != signature:
+                # Файл появился или еще меняется - ждем, пока подпись перестанет меняться
+                self.pending[file_path] = (signature, now)
+                if self.settle_seconds > 0:
+                    continue
+            elif now - pending[1] < self.settle_seconds:
+                continue
+
+            # Файл передается на обработку с той подписью, которая была проверена
+            self.handled[file_path] = signature
+            self.pending.pop(file_path, None)
+            ready.append(file_path)
+
+        self.remember_directories(directories)
+        return sorted(ready)
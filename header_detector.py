@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Header detector for Dataset Builder
+Поиск строки заголовков в начале листа векторными операциями с кешем по шаблону листа
+"""
+
+import re
+from collections import OrderedDict
+from typing import NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+# Ключевые слова заголовков листов с маршрутами
+HEADER_KEYWORDS = ('client', 'customer', 'delivery', 'pallet', 'load', 'collection')
+
+# Заголовок ищется только среди первых строк листа
+HEADER_SCAN_ROWS = 50
+
+# Сколько строк после заголовка сравнивается с ним по заполненности
+CONFIDENCE_ROWS = 5
+
+# Числа в первой строке (даты, номера) не меняют шаблон листа
+_DIGITS = re.compile(r'\d+')
+
+# Ключ шаблона: число колонок и первая строка листа без чисел
+TemplateKey = Tuple[int, Tuple[str, ...]]
+
+
+class HeaderMatch(NamedTuple):
+    """Строка заголовков (позиция), уверенность от 0 до 1 и признак, что шаблон взят из кеша"""
+    row: int
+    confidence: float
+    cached: bool = False
+
+
+class HeaderDetector:
+    """Находит первую строку листа, в которой есть ключевое слово заголовка
+
+    Просматриваются только первые max_rows строк. Найденная строка запоминается для шаблона листа
+    (число колонок и первая строка без чисел): для следующего файла того же шаблона проверяются
+    только строки до запомненной.
+    """
+
+    def __init__(self, keywords: Sequence[str] = HEADER_KEYWORDS, max_rows: int = HEADER_SCAN_ROWS,
+                 cache_size: int = 256):
+        self.keywords = tuple(keyword.lower() for keyword in keywords)
+        self.pattern = '|'.join(re.escape(keyword) for keyword in self.keywords)
+        self.max_rows = max_rows
+        self.cache_size = cache_size
+        self.cache: 'OrderedDict[TemplateKey, int]' = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def template_key(self, df: pd.DataFrame) -> TemplateKey:
+        """Отпечаток шаблона листа"""
+        return len(df.columns), tuple(_DIGITS.sub('#', str(column)) for column in df.columns)
+
+    def keyword_rows(self, df: pd.DataFrame, rows: int) -> np.ndarray:
+        """Для первых rows строк: есть ли в строке ячейка с ключевым словом"""
+        values = df.iloc[:rows].to_numpy(dtype=object)
+        if values.size == 0:
+            return np.zeros(len(values), dtype=bool)
+
+        cells = pd.Series(values.ravel())
+        matches = cells.notna() & cells.astype(str).str.lower().str.contains(self.pattern, regex=True)
+        return matches.to_numpy().reshape(values.shape).any(axis=1)
+
+    def confidence(self, df: pd.DataFrame, row: int) -> float:
+        """Насколько строка похожа на заголовок: доля текстовых ячеек и заполненность относительно данных"""
+        values = df.iloc[row:row + CONFIDENCE_ROWS + 1].to_numpy(dtype=object)
+        filled = pd.notna(values)
+        header_filled = int(filled[0].sum())
+        if header_filled == 0:
+            return 0.0
+
+        text_share = sum(isinstance(value, str) for value in values[0][filled[0]]) / header_filled
+        data_width = int(filled[1:].sum(axis=1).max()) if len(filled) > 1 else header_filled
+        fill_share = min(1.0, header_filled / data_width) if data_width else 1.0
+        return round(text_share * fill_share, 3)
+
+    def lookup(self, key: TemplateKey) -> Optional[int]:
+        """Строка заголовков, запомненная для шаблона"""
+        row = self.cache.get(key)
+        if row is not None:
+            self.cache.move_to_end(key)
+        return row
+
+    def remember(self, key: TemplateKey, row: int):
+        """Запоминает строку заголовков для шаблона, вытесняя самый старый шаблон"""
+        self.cache[key] = row
+        self.cache.move_to_end(key)
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def detect(self, df: Optional[pd.DataFrame]) -> HeaderMatch:
+        """Находит строку заголовков; если ее нет среди первых строк - 0 с нулевой уверенностью"""
+        if df is None or df.empty:
+            return HeaderMatch(0, 0.0)
+
+        key = self.template_key(df)
+        cached_row = self.lookup(key)
+        if cached_row is not None and cached_row < len(df):
+            # Шаблон подтверждается, если первое ключевое слово по-прежнему в запомненной строке
+            found = np.flatnonzero(self.keyword_rows(df, cached_row + 1))
+            if len(found) and found[0] == cached_row:
+                self.hits += 1
+                return HeaderMatch(cached_row, self.confidence(df, cached_row), cached=True)
+
+        self.misses += 1
+        found = np.flatnonzero(self.keyword_rows(df, self.max_rows))
+        if not len(found):
+            return HeaderMatch(0, 0.0)
+
+        row = int(found[0])
+        self.remember(key, row)
+        return HeaderMatch(row, self.confidence(df, row))
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Join index for Dataset Builder
+Хеш-индексы для объединения заказов и доставок без квадратичного перебора
+"""
+
+from typing import Any, Dict, Hashable, Iterable, List, Optional
+
+import pandas as pd
+
+
+def join_key(*values: Any) -> Optional[Hashable]:
+    """Ключ для хеш-индекса или None, если значение не может совпасть при сравнении через ==
+
+    NaN/NaT не равны даже сами себе, поэтому такие значения в индекс не попадают.
+    None, наоборот, равен None и остается обычным ключом.
+    """
+    for value in values:
+        if value is not None and pd.api.types.is_scalar(value) and pd.isna(value):
+            return None
+
+    try:
+        hash(values)
+    except TypeError:
+        return None
+    return values
+
+
+def first_match_index(records: Iterable[Dict[str, Any]], fields: List[str]) -> Dict[Hashable, Dict[str, Any]]:
+    """Индекс: значение ключевых полей -> первая запись с таким значением"""
+    index = {}
+    for record in records:
+        key = join_key(*(record.get(field) for field in fields))
+        if key is not None and key not in index:
+            index[key] = record
+    return index
+
+
+def append_unmatched(merged_data: List[Dict[str, Any]], records: Iterable[Dict[str, Any]], field: str):
+    """Добавляет записи, значение поля которых не встречается среди уже объединенных записей
+
+    Эквивалентно проверке any(d.get(field) == record.get(field) for d in merged_data)
+    для каждой записи, но выполняется за линейное время.
+    """
+    seen = set()
+    for existing in merged_data:
+        key = join_key(existing.get(field))
+        if key is not None:
+            seen.add(key)
+
+    for record in records:
+        key = join_key(record.get(field))
+        if key is not None and key in seen:
+            continue
+        merged_data.append(record)
+        if key is not None:
+            seen.add(key)
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Value parsers for Dataset Builder
+Разбор температуры из названия клиента и даты из имени файла: заранее скомпилированные шаблоны и кеш
+"""
+
+import re
+from datetime import datetime
+from functools import lru_cache
+from typing import Any, Optional, Sequence
+
+import pandas as pd
+
+# Температура, если в названии клиента она не указана
+DEFAULT_TEMPERATURE = "+3°C"
+
+# Паттерны температуры в порядке приоритета: каждая группа - первое вхождение своего паттерна
+TEMPERATURE_PATTERN = re.compile(
+    r'^(?=.*?\(\+(\d+)°C\))?(?=.*?\+(\d+)°C)?(?=.*?(\d+)°C)?(?=.*?(\d+)C)?',
+    re.IGNORECASE | re.DOTALL
+)
+
+# Паттерны даты в имени файла в порядке проверки
+DDMMYYYY_PATTERN = re.compile(r'(\d{2})(\d{2})(\d{4})')
+DDMMYY_PATTERN = re.compile(r'(\d{2})(\d{2})(\d{2})')
+SEPARATED_DATE_PATTERN = re.compile(r'(\d{1,2})[-_](\d{1,2})[-_](\d{2,4})')  # DD-MM-YY или DD_MM_YY
+DATE_PATTERNS = (DDMMYYYY_PATTERN, DDMMYY_PATTERN, SEPARATED_DATE_PATTERN)
+
+# Названия клиентов повторяются изо дня в день: кеша хватает на несколько сотен клиентов с запасом
+TEMPERATURE_CACHE_SIZE = 4096
+DATE_CACHE_SIZE = 4096
+
+
+@lru_cache(maxsize=TEMPERATURE_CACHE_SIZE)
+def _temperature(client_name: str) -> str:
+    """Температура для непустой строки (результат кешируется по исходной строке)"""
+    groups = TEMPERATURE_PATTERN.match(client_name).groups()
+    value = next((group for group in groups if group is not None), None)
+    return DEFAULT_TEMPERATURE if value is None else f"+{value}°C"
+
+
+def parse_temperature(client_name: Any) -> str:
+    """Извлекает температуру из названия клиента; по умолчанию +3°C"""
+    if not client_name or not isinstance(client_name, str):
+        return DEFAULT_TEMPERATURE
+    return _temperature(client_name)
+
+
+def parse_temperatures(client_names: pd.Series) -> pd.Series:
+    """Температура для колонки названий клиентов: каждое уникальное название разбирается один раз"""
+    codes, uniques = pd.factorize(client_names.astype(object))
+    temperatures = pd.Series([parse_temperature(name) for name in uniques] + [DEFAULT_TEMPERATURE], dtype=object)
+    # Пустые значения получают код -1 - последний элемент, температуру по умолчанию
+    return pd.Series(temperatures.to_numpy()[codes], index=client_names.index, dtype=object)
+
+
+@lru_cache(maxsize=DATE_CACHE_SIZE)
+def parse_filename_date(filename: str, patterns: Sequence[re.Pattern] = DATE_PATTERNS) -> Optional[str]:
+    """Извлекает дату из имени файла в формате YYYY-MM-DD
+
+    Паттерны проверяются по порядку, для каждого - первое вхождение; если оно не является
+    датой, проверяется следующий паттерн. Двузначный год считается годом 20YY.
+    """
+    for pattern in patterns:
+        match = pattern.search(filename)
+        if not match:
+            continue
+
+        day, month, year = match.groups()
+        if len(year) == 2:
+            year = f"20{year}"
+        elif len(year) != 4:
+            continue
+
+        try:
+            return datetime(int(year), int(month), int(day)).strftime('%Y-%m-%d')
+        except ValueError:
+            continue
+
+    return None
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Pipeline profiler for Dataset Builder
+Профилирование обработки cProfile: профиль сохраняется только для файлов и запусков медленнее порога
+"""
+
+import cProfile
+import io
+import logging
+import os
+import pstats
+import re
+import time
+from contextlib import contextmanager
+from types import SimpleNamespace
+from typing import Iterator, Optional
+
+# Что профилируется: каждый файл отдельно или весь запуск целиком
+PROFILE_SCOPES = ('file', 'run')
+
+PROFILE_DIR = "profiles"
+
+# Число функций в текстовой сводке профиля
+SUMMARY_LINES = 40
+
+
+def _safe_name(name: str) -> str:
+    """Имя для файла профиля без расширения и недопустимых символов"""
+    return re.sub(r'[^\w.-]+', '_', os.path.splitext(name)[0]).strip('_') or 'profile'
+
+
+class PipelineProfiler:
+    """Профилирует блок кода и сохраняет профиль, если блок выполнялся не меньше threshold секунд
+
+    Рядом с файлом .prof (для pstats, snakeviz) пишется текстовая сводка .txt с самыми
+    затратными функциями по суммарному времени.
+    """
+
+    def __init__(self, scope: str = 'file', profile_dir: str = PROFILE_DIR, threshold: float = 0.0):
+        if scope not in PROFILE_SCOPES:
+            raise ValueError(f"Неизвестный режим профилирования: {scope}")
+        self.scope = scope
+        self.profile_dir = profile_dir
+        self.threshold = threshold
+        # Префикс имен файлов профиля (идентификатор запуска)
+        self.run_id: Optional[str] = None
+
+    def profile_path(self, name: str) -> str:
+        """Путь к файлу профиля для файла или запуска name"""
+        prefix = f"{self.run_id}_" if self.run_id else ''
+        return os.path.join(self.profile_dir, f"{prefix}{_safe_name(name)}.prof")
+
+    @contextmanager
+    def profile(self, name: str) -> Iterator[SimpleNamespace]:
+        """Профилирует блок; после выхода result.seconds - время блока, result.path - сохраненный профиль"""
+        result = SimpleNamespace(seconds=None, path=None)
+        profiler = cProfile.Profile()
+        started = time.perf_counter()
+        profiler.enable()
+        try:
+            yield result
+        finally:
+            profiler.disable()
+            result.seconds = time.perf_counter() - started
+            if result.seconds >= self.threshold:
+                result.path = self.save(profiler, name)
+                logging.info(f"Профиль {name} ({result.seconds:.2f} с) сохранен в {result.path}")
+
+    def save(self, profiler: cProfile.Profile, name: str) -> str:
+        """Сохраняет профиль и его текстовую сводку"""
+        os.makedirs(self.profile_dir, exist_ok=True)
+        path = self.profile_path(name)
+        profiler.dump_stats(path)
+
+        summary = io.StringIO()
+        pstats.Stats(profiler, stream=summary).sort_stats('cumulative').print_stats(SUMMARY_LINES)
+        with open(f"{os.path.splitext(path)[0]}.txt", 'w', encoding='utf-8') as f:
+            f.write(summary.getvalue())
+        return path
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Processing manifest for Dataset Builder
+Манифест обработанных файлов для инкрементальных запусков
+"""
+
+import hashlib
+import json
+import os
+from datetime import datetime
+from typing import Any, Dict, Optional
+
+from commit_log import OutputTransaction, atomic_write_text
+
+MANIFEST_PATH = "processing_manifest.json"
+
+# Статусы файла относительно манифеста
+STATUS_NEW = 'new'
+STATUS_CHANGED = 'changed'
+STATUS_UNCHANGED = 'unchanged'
+
+
+def file_content_hash(file_path: str, chunk_size: int = 1024 * 1024) -> str:
+    """Считает SHA-256 содержимого файла"""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def content_signature(file_path: str, content_hash: Optional[str] = None) -> Dict[str, Any]:
+    """Размер, время изменения и хеш содержимого файла
+
+    Размер и время снимаются до чтения содержимого: если файл изменится позже, при следующей
+    проверке время не совпадет и содержимое будет сверено заново.
+    """
+    stat = os.stat(file_path)
+    return {
+        'size': stat.st_size,
+        'mtime': stat.st_mtime,
+        'sha256': content_hash or file_content_hash(file_path),
+    }
+
+
+class ProcessingManifest:
+    """Манифест: для каждого файла хранит путь, размер, время изменения, хеш, число записей и версию парсера"""
+
+    def __init__(self, path: str = MANIFEST_PATH):
+        self.path = path
+        # Ключ - имя файла, совпадает со значением колонки Source_File
+        self.entries: Dict[str, Dict[str, Any]] = {}
+        # Файлы из датасета, собранного до появления манифеста: имя -> число записей
+        self.legacy_files: Dict[str, int] = {}
+        # Подписи измененных файлов, содержимое которых уже хешировано при проверке: имя -> подпись
+        self.checked: Dict[str, Dict[str, Any]] = {}
+
+    def exists(self) -> bool:
+        """Проверяет, сохранен ли манифест на диске"""
+        return os.path.exists(self.path)
+
+    def load(self) -> bool:
+        """Загружает манифест с диска, если он существует"""
+        if not os.path.exists(self.path):
+            return False
+
+        with open(self.path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        self.entries = data.get('files', {})
+        self.legacy_files = data.get('legacy_files', {})
+        return True
+
+    def reset(self):
+        """Очищает манифест (например, если датасет был удален)"""
+        self.entries = {}
+        self.legacy_files = {}
+
+    def save(self, transaction: Optional[OutputTransaction] = None):
+        """Сохраняет манифест на диск целиком: сразу или при фиксации transaction вместе с датасетом"""
+        data = {
+            'updated_at': datetime.now().isoformat(timespec='seconds'),
+            'files': self.entries,
+            'legacy_files': self.legacy_files,
+        }
+        text = json.dumps(data, ensure_ascii=False, indent=1, sort_keys=True)
+        if transaction is not None:
+            transaction.stage_text(self.path, text)
+        else:
+            atomic_write_text(self.path, text)
+
+    def __contains__(self, filename: str) -> bool:
+        return filename in self.entries
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get(self, filename: str) -> Optional[Dict[str, Any]]:
+        """Возвращает запись манифеста для файла"""
+        return self.entries.get(filename)
+
+    def file_status(self, file_path: str, parser_version: str) -> str:
+        """Определяет, новый ли файл, изменился ли он или уже обработан"""
+        self.checked.pop(os.path.basename(file_path), None)
+        entry = self.entries.get(os.path.basename(file_path))
+        if entry is None:
+            return STATUS_NEW
+
+        if entry.get('parser_version') != parser_version:
+            return STATUS_CHANGED
+
+        stat = os.stat(file_path)
+        if entry.get('size') == stat.st_size and entry.get('mtime') == stat.st_mtime:
+            return STATUS_UNCHANGED
+
+        # Размер или время изменились - сверяем содержимое (файл мог быть просто скопирован)
+        if entry.get('size') == stat.st_size:
+            content_hash = file_content_hash(file_path)
+            if entry.get('sha256') == content_hash:
+                entry['mtime'] = stat.st_mtime
+                return STATUS_UNCHANGED
+            self.checked[os.path.basename(file_path)] = {'size': stat.st_size, 'mtime': stat.st_mtime, 'sha256': content_hash}
+
+        return STATUS_CHANGED
+
+    def checked_signature(self, file_path: str) -> Optional[Dict[str, Any]]:
+        """Подпись файла, снятая при проверке до его разбора, если содержимое уже хешировано"""
+        return self.checked.pop(os.path.basename(file_path), None)
+
+    def adopt(self, file_path: str, parser_version: str) -> bool:
+        """Переносит файл из датасета, собранного до появления манифеста, в манифест"""
+        filename = os.path.basename(file_path)
+        if filename not in self.legacy_files:
+            return False
+        self.record(file_path, self.legacy_files.pop(filename), parser_version)
+        return True
+
+    def record(self, file_path: str, records: int, parser_version: str, signature: Optional[Dict[str, Any]] = None):
+        """Записывает в манифест результат обработки файла
+
+        signature - подпись (content_signature), снятая до разбора файла: файл, перезаписанный
+        во время разбора, не будет считаться обработанным с новым содержимым.
+        """
+        self.entries[os.path.basename(file_path)] = {
+            'path': os.path.abspath(file_path),
+            **(signature or content_signature(file_path)),
+            'records': int(records),
+            'parser_version': parser_version,
+            'processed_at': datetime.now().isoformat(timespec='seconds'),
+        }
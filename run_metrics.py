@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Run metrics for Dataset Builder
+Журнал запусков: время этапов, объем и пиковая память по каждому файлу в формате JSONL
+"""
+
+import json
+import os
+import sys
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Any, Dict, Iterator, Optional
+
+RUN_LOG_PATH = "processing_runs.jsonl"
+
+
+def new_run_id() -> str:
+    """Идентификатор запуска: время начала и случайный суффикс"""
+    return f"{datetime.now():%Y%m%d-%H%M%S}-{uuid.uuid4().hex[:6]}"
+
+
+def peak_rss_bytes() -> Optional[int]:
+    """Пиковый объем памяти процесса в байтах или None, если его нельзя узнать"""
+    try:
+        import resource
+    except ImportError:
+        resource = None
+
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux возвращает килобайты, macOS - байты
+        return int(peak) if sys.platform == 'darwin' else int(peak) * 1024
+
+    # Windows: модуля resource нет, пиковый рабочий набор дает psutil (если установлен)
+    try:
+        import psutil
+    except ImportError:
+        return None
+    memory = psutil.Process().memory_info()
+    return int(getattr(memory, 'peak_wset', memory.rss))
+
+
+class FileMetrics:
+    """Метрики обработки одного файла: время чтения листов и этапов разбора, строки и записи"""
+
+    def __init__(self, file_path: str):
+        self._started = time.perf_counter()
+        try:
+            size = os.path.getsize(file_path)
+        except OSError:
+            size = None
+        self.data: Dict[str, Any] = {
+            'event': 'file',
+            'file': os.path.basename(file_path),
+            'bytes_read': size,
+            'sheets': {},
+        }
+
+    @contextmanager
+    def timed(self, key: str) -> Iterator[None]:
+        """Записывает время выполнения блока в секундах под ключом key"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.data[key] = time.perf_counter() - started
+
+    def add_sheet(self, sheet_name: str, read_seconds: float, rows: int):
+        """Учитывает прочитанный лист: время чтения и число строк"""
+        self.data['sheets'][sheet_name] = {'read_seconds': read_seconds, 'rows': rows}
+
+    def finish(self, status: str = 'ok', **values) -> Dict[str, Any]:
+        """Завершает замер файла и возвращает метрики"""
+        self.data.update(values)
+        self.data['status'] = status
+        self.data['rows_scanned'] = sum(sheet['rows'] for sheet in self.data['sheets'].values())
+        self.data['total_seconds'] = time.perf_counter() - self._started
+        self.data['peak_rss_bytes'] = peak_rss_bytes()
+        self.data['pid'] = os.getpid()
+        return self.data
+
+
+class RunLog:
+    """Дописывает события запуска в файл JSONL; каждая строка содержит идентификатор запуска"""
+
+    def __init__(self, path: str = RUN_LOG_PATH, run_id: Optional[str] = None):
+        self.path = path
+        self.run_id = run_id or new_run_id()
+        self.started_at = datetime.now()
+        self._started = time.perf_counter()
+
+    def append(self, event: Dict[str, Any]):
+        """Дописывает событие; файл открывается на каждую запись, чтобы журнал не терялся при сбое"""
+        line = json.dumps({'run_id': self.run_id, **event}, ensure_ascii=False, default=str)
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(line + '\n')
+
+    def finish(self, **values):
+        """Дописывает итоговое событие запуска"""
+        self.append({
+            'event': 'run',
+            'started_at': self.started_at.isoformat(timespec='seconds'),
+            'finished_at': datetime.now().isoformat(timespec='seconds'),
+            'total_seconds': time.perf_counter() - self._started,
+            'peak_rss_bytes': peak_rss_bytes(),
+            **values,
+        })
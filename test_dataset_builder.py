@@ -10,6 +10,8 @@ import pandas as pd
 from datetime import datetime
 import tempfile
 import shutil
+import glob
+import time
 
 def create_test_excel_file():
     """Создает тестовый Excel файл для проверки функциональности"""
@@ -83,6 +85,58 @@ def test_temperature_extraction():
         status = "✓" if extracted_temp == expected_temp else "✗"
         print(f"{status} {client_name} -> {extracted_temp} (ожидалось: {expected_temp})")
 
+def test_value_parsers():
+    """Тестирует разбор температуры и дат: прежнее поведение, значения по умолчанию и кеш"""
+    import numpy as np
+    from parsers import DDMMYYYY_PATTERN, _temperature, parse_filename_date, parse_temperature, parse_temperatures
+    
+    temperature_cases = [
+        ('Client A (+10°C)', '+10°C'),
+        ('Client B', '+3°C'),
+        ('Client D (+15C)', '+15°C'),
+        ('Chill +5°c store', '+5°C'),
+        ('Farm 2 (+8°C) 12C', '+8°C'),   # Скобки с плюсом важнее остальных паттернов
+        ('Depot 7C, zone +4°C', '+4°C'),
+        ('', '+3°C'),
+        (None, '+3°C'),
+        (np.nan, '+3°C'),
+        (12, '+3°C'),
+    ]
+    date_cases = [
+        ('Lyons collections 01012024.xlsx', '2024-01-01'),
+        ('Lyons collections 150623.xlsx', '2023-06-15'),        # DDMMYY -> 20YY
+        ('Lyons collections 5-3-24.xlsx', '2024-03-05'),
+        ('Lyons collections 05_03_2024.xlsm', '2024-03-05'),
+        ('Lyons collections 32012024.xlsx', None),   # Неверная дата - следующие паттерны тоже не подходят
+        ('Lyons collections 32-01-24 05-03-24.xlsx', None),   # Проверяется только первое вхождение
+        ('Lyons collections 31022024.xlsx', None),
+        ('Lyons collections latest.xlsx', None),
+    ]
+    
+    print("\nТестирование разбора значений:")
+    for value, expected in temperature_cases:
+        assert parse_temperature(value) == expected, value
+    for filename, expected in date_cases:
+        assert parse_filename_date(filename) == expected, filename
+    print(f"✓ Температур: {len(temperature_cases)}, дат: {len(date_cases)}")
+    
+    # Простой сборщик ищет только DDMMYYYY
+    assert parse_filename_date('Lyons collections 150623.xlsx', (DDMMYYYY_PATTERN,)) is None
+    
+    # Колонка целиком совпадает с разбором по одной строке и сохраняет индекс
+    column = pd.Series([value for value, _ in temperature_cases] * 3, index=range(100, 130), dtype=object)
+    temperatures = parse_temperatures(column)
+    assert temperatures.tolist() == [expected for _, expected in temperature_cases] * 3
+    assert list(temperatures.index) == list(column.index)
+    
+    # Повторяющиеся названия разбираются один раз
+    _temperature.cache_clear()
+    parse_temperatures(column)
+    parse_temperatures(column)
+    info = _temperature.cache_info()
+    print(f"✓ Кеш температур: {info}")
+    assert info.misses == 6 and info.hits == 6
+
 def test_excel_processing():
     """Тестирует обработку Excel файла"""
     from dataset_builder import DatasetBuilder
@@ -136,6 +190,1451 @@ def test_advanced_features():
         # Очищаем временные файлы
         shutil.rmtree(temp_dir)
 
+def installed_engines():
+    """Движки чтения Excel, доступные в текущем окружении"""
+    from workbook_reader import calamine_available
+    return ['openpyxl'] + (['calamine'] if calamine_available() else [])
+
+def test_streaming_reader():
+    """Тестирует, что потоковое чтение листа совпадает с pandas.read_excel"""
+    from openpyxl import Workbook
+    from openpyxl.styles import PatternFill
+    from workbook_reader import WorkbookHandle
+    
+    temp_dir = tempfile.mkdtemp()
+    file_path = os.path.join(temp_dir, 'Lyons collections 01012024.xlsx')
+    
+    # Повторяющиеся заголовки, пустая строка внутри данных, ошибка формулы и оформленные пустые строки в конце
+    workbook = Workbook()
+    sheet = workbook.active
+    sheet.title = 'Pallet Order'
+    sheet.append(['Client', 'Delivery 1', 'Delivery 1', None, 'Delivery 4'])
+    sheet.append(['Client A (+10°C)', 5, 2.5, None, '#DIV/0!'])
+    sheet.append([])
+    sheet.append(['Client B', 3.0, None, 'note', 0])
+    sheet.cell(row=1, column=30, value='Far column')
+    for row in range(5, 200):
+        sheet.cell(row=row, column=1).fill = PatternFill('solid', fgColor='FFFF00')
+    workbook.save(file_path)
+    
+    try:
+        expected = pd.read_excel(file_path, sheet_name='Pallet Order')
+        
+        print(f"\nТестирование потокового чтения:")
+        
+        for engine in installed_engines():
+            with WorkbookHandle(file_path, engine=engine) as handle:
+                actual = handle.read_sheet('Pallet Order')
+                limited = handle.read_sheet('Pallet Order', max_col=26)
+            
+            print(f"✓ {engine}: прочитано строк: {len(actual)}, колонок: {len(actual.columns)}")
+            
+            pd.testing.assert_frame_equal(actual, expected)
+            # Колонки A-Z: пустые колонки после последней заполненной не читаются
+            pd.testing.assert_frame_equal(limited, expected.iloc[:, :5])
+            assert expected.iloc[:, 5:26].isna().all().all()
+        
+    finally:
+        shutil.rmtree(temp_dir)
+
+def test_engine_equivalence():
+    """Тестирует, что все установленные движки чтения дают одинаковые листы и записи"""
+    from dataset_builder import DatasetBuilder
+    from dataset_builder_advanced import AdvancedDatasetBuilder
+    from workbook_reader import WorkbookHandle
+    
+    test_file, temp_dir = create_test_excel_file()
+    
+    try:
+        results = {}
+        for engine in installed_engines():
+            with WorkbookHandle(test_file, engine=engine) as handle:
+                sheets = handle.read_sheets(handle.sheet_names)
+            
+            basic_records = DatasetBuilder(engine=engine).process_excel_file(test_file)
+            builder = AdvancedDatasetBuilder(load_existing=False, engine=engine)
+            advanced_records = builder.process_excel_file(test_file, check_processed=False)
+            results[engine] = (sheets, basic_records + advanced_records, builder.stats['engine'])
+        
+        print(f"\nТестирование движков чтения:")
+        print(f"✓ Движки: {list(results)}")
+        
+        expected_sheets, expected_records, _ = results['openpyxl']
+        for engine, (sheets, records, stats_engine) in results.items():
+            assert stats_engine == engine
+            assert sheets.keys() == expected_sheets.keys()
+            for sheet_name, df in sheets.items():
+                pd.testing.assert_frame_equal(df, expected_sheets[sheet_name])
+            assert records == expected_records
+        
+    finally:
+        shutil.rmtree(temp_dir)
+
+def test_encrypted_workbook():
+    """Тестирует расшифровку защищенной книги подобранным паролем"""
+    import importlib.util
+    from dataset_builder_advanced import AdvancedDatasetBuilder
+    from credential_resolver import is_encrypted
+    
+    if importlib.util.find_spec('msoffcrypto') is None:
+        print("\nmsoffcrypto-tool не установлен, тест защищенных книг пропущен")
+        return
+    from msoffcrypto.format.ooxml import OOXMLFile
+    
+    test_file, temp_dir = create_test_excel_file()
+    # Та же книга, зашифрованная паролем, в соседней папке
+    os.makedirs(os.path.join(temp_dir, 'protected'))
+    encrypted_file = os.path.join(temp_dir, 'protected', os.path.basename(test_file))
+    with open(test_file, 'rb') as source, open(encrypted_file, 'wb') as target:
+        OOXMLFile(source).encrypt('Secret', target)
+    
+    try:
+        builder = AdvancedDatasetBuilder(load_existing=False, passwords=['Wrong', 'Secret'])
+        plain_records = builder.process_excel_file(test_file, check_processed=False)
+        encrypted_records = builder.process_excel_file(encrypted_file, check_processed=False)
+        
+        print(f"\nТестирование защищенных книг:")
+        print(f"✓ Записей из защищенной книги: {len(encrypted_records)}")
+        
+        assert not is_encrypted(test_file) and is_encrypted(encrypted_file)
+        assert encrypted_records == plain_records
+        # Подошедший пароль проверяется первым для остальных файлов папки
+        assert builder.credentials.candidates(encrypted_file) == ['Secret', 'Wrong']
+        
+    finally:
+        shutil.rmtree(temp_dir)
+
+def create_test_archive(days=4):
+    """Создает папку с несколькими тестовыми файлами за разные дни"""
+    test_file_path, temp_dir = create_test_excel_file()
+    
+    for day in range(2, days + 1):
+        shutil.copy(test_file_path, os.path.join(temp_dir, f'Lyons collections {day:02d}012024.xlsx'))
+    
+    return temp_dir
+
+def reference_header_row(df):
+    """Прежний поиск строки заголовков: полный проход по строкам листа"""
+    header_keywords = ['client', 'customer', 'delivery', 'pallet', 'load', 'collection']
+    for idx, row in df.iterrows():
+        row_str = ' '.join(str(cell).lower() for cell in row if pd.notna(cell))
+        if any(keyword in row_str for keyword in header_keywords):
+            return idx
+    return 0
+
+def test_header_detection():
+    """Тестирует поиск заголовков: совпадение с прежним поиском, уверенность и кеш шаблона"""
+    from header_detector import HeaderDetector
+    
+    title = 'Orders 01/01/2024'
+    sheets = [
+        pd.DataFrame([[None, None], ['Client', 'DC Cork'], ['Farm 1', 5]], columns=[title, 'Unnamed: 1']),
+        pd.DataFrame([['Load Number', 'Driver'], ['L001', 'John']], columns=['Plan', 'Unnamed: 1']),
+        pd.DataFrame([['Client A (+10°C)', 5, 2.0, 1], ['Farm 2', 0, None, 4]], columns=['Client', 'D1', 'D2', 'D3']),
+        pd.DataFrame([['Farm 1', 3], ['Farm 2', 4]], columns=['A', 'B']),
+        pd.DataFrame(columns=['A', 'B']),
+    ]
+    detector = HeaderDetector()
+    
+    print(f"\nТестирование поиска заголовков:")
+    for df in sheets:
+        match = detector.detect(df)
+        print(f"✓ Строка {match.row}, уверенность {match.confidence}")
+        assert match.row == reference_header_row(df)
+    
+    # Настоящая шапка - уверенно, строка данных с ключевым словом и отсутствие шапки - нет
+    assert detector.detect(sheets[0]).confidence == 1.0
+    assert detector.detect(sheets[2]).confidence < 0.5
+    assert detector.detect(sheets[3]).confidence == 0.0
+    
+    # Файл следующего дня того же шаблона берет строку из кеша
+    next_day = sheets[0].rename(columns={title: 'Orders 02/01/2024'})
+    match = detector.detect(next_day)
+    assert match.cached and match.row == 1
+    # Измененный макет того же шаблона находится заново
+    moved = pd.DataFrame([['Client', 'DC Cork'], [None, None], ['Farm 1', 5]], columns=next_day.columns)
+    match = detector.detect(moved)
+    assert not match.cached and match.row == 0
+    
+    # Заголовок ищется только в начале листа
+    long_sheet = pd.DataFrame({'A': ['x'] * 80 + ['Client'], 'B': range(81)})
+    assert HeaderDetector(max_rows=50).detect(long_sheet).row == 0
+    assert HeaderDetector(max_rows=100).detect(long_sheet).row == 80
+
+def test_column_mapping():
+    """Тестирует сопоставление колонок: канонические поля, колонки extra_* и кеш по шаблону заголовка"""
+    from column_resolver import ColumnMappingResolver
+    
+    resolver = ColumnMappingResolver([
+        ('load_number', ('load', 'number')),
+        ('collection_site', ('collection', 'site')),
+        ('pallets_ordered', ('pallets', 'ordered')),
+        ('driver', ('driver',)),
+    ])
+    columns = ['Load Number', 'Notes', 'Collection Site', 'PALLETS ORDERED', 'Comment', 'Driver']
+    first_day = pd.DataFrame([['L001', 'n1', 'Site A', 5, 'c1', 'John']], columns=columns)
+    next_day = pd.DataFrame([['L002', None, 'Site B', 3, 'c2', 'Jane'], ['L003', 'n3', 'Site C', 4, 'c3', 'Bob']], columns=columns)
+    
+    print(f"\nТестирование сопоставления колонок:")
+    
+    # Известные заголовки - канонические поля в порядке правил, остальные колонки - extra_*
+    mapped = resolver.apply(first_day)
+    print(f"✓ Колонки: {list(mapped.columns)}")
+    assert list(mapped.columns) == ['load_number', 'collection_site', 'pallets_ordered', 'driver', 'extra_Notes', 'extra_Comment']
+    assert mapped.iloc[0].tolist() == ['L001', 'Site A', 5, 'John', 'n1', 'c1']
+    
+    # Лист того же шаблона берет сопоставление из кеша
+    hits = resolver.resolve.cache_info().hits
+    mapped = resolver.apply(next_day)
+    assert resolver.resolve.cache_info().hits == hits + 1
+    assert mapped['driver'].tolist() == ['Jane', 'Bob']
+    assert mapped['extra_Comment'].tolist() == ['c2', 'c3']
+    
+    # Другой заголовок сопоставляется заново; при повторе поля побеждает последняя колонка,
+    # а предыдущая остается дополнительной
+    misses = resolver.resolve.cache_info().misses
+    mapping = resolver.resolve(('Driver', 'Spare Driver', 'Route'))
+    assert resolver.resolve.cache_info().misses == misses + 1
+    assert mapping.fields == {'driver': 1}
+    assert mapping.extras == (0, 2)
+    
+    # Без известных заголовков все колонки становятся extra_*
+    assert list(resolver.apply(pd.DataFrame(columns=['A', 'B'])).columns) == ['extra_A', 'extra_B']
+    print(f"✓ Кеш: {resolver.resolve.cache_info()}")
+
+def test_parallel_matches_serial():
+    """Тестирует, что параллельная обработка дает тот же результат, что и последовательная"""
+    import dataset_builder_advanced
+    from dataset_builder_advanced import AdvancedDatasetBuilder
+    
+    # Файлов больше, чем окно обработки: остальные отправляются в пул по мере получения результатов
+    temp_dir = create_test_archive(days=7)
+    window_per_worker = dataset_builder_advanced.PARALLEL_WINDOW_PER_WORKER
+    dataset_builder_advanced.PARALLEL_WINDOW_PER_WORKER = 1
+    
+    try:
+        results = {}
+        for workers in (1, 2):
+            builder = AdvancedDatasetBuilder(workers=workers, load_existing=False)
+            excel_files = builder.find_excel_files(temp_dir)
+            records = []
+            for file_path, file_records in builder.iter_processed_files(excel_files):
+                records.extend(file_records)
+            results[workers] = (pd.DataFrame(records).to_csv(index=False), builder.stats)
+        
+        print(f"\nТестирование параллельной обработки:")
+        print(f"✓ Статистика: {results[2][1]}")
+        
+        assert results[1][0] == results[2][0]
+        assert results[1][1] == results[2][1]
+        assert results[2][1]['files_processed'] == 7
+        
+    finally:
+        dataset_builder_advanced.PARALLEL_WINDOW_PER_WORKER = window_per_worker
+        shutil.rmtree(temp_dir)
+
+def test_incremental_manifest():
+    """Тестирует пропуск необработанных и замену записей измененных файлов по манифесту"""
+    from dataset_builder_advanced import AdvancedDatasetBuilder
+    
+    temp_dir = create_test_archive(days=3)
+    original_cwd = os.getcwd()
+    
+    def run_once():
+        # Каждый запуск - новый сборщик: состояние берется только из манифеста и датасета на диске
+        builder = AdvancedDatasetBuilder()
+        for file_path, file_records in builder.iter_processed_files(builder.find_excel_files(temp_dir)):
+            builder.add_file_records(file_path, file_records)
+        builder.save_dataset()
+        builder.manifest.save()
+        return builder
+    
+    try:
+        # Выходные файлы и манифест пишутся во временную папку
+        os.chdir(temp_dir)
+        
+        builder = run_once()
+        first_run = pd.read_parquet(builder.parquet_path)
+        assert builder.stats['files_processed'] == 3
+        
+        # Повторный запуск: все файлы уже в манифесте, датасет не читается и не перезаписывается
+        dataset_mtime = os.path.getmtime(builder.parquet_path)
+        builder = run_once()
+        assert builder.stats['files_skipped'] == 3
+        assert builder.combined_data == []
+        assert os.path.getmtime(builder.parquet_path) == dataset_mtime
+        
+        # Исправленный файл с тем же именем: его записи заменяются, а не дублируются
+        changed_file = os.path.join(temp_dir, 'Lyons collections 02012024.xlsx')
+        with pd.ExcelWriter(changed_file, engine='openpyxl') as writer:
+            pd.DataFrame({'Client': ['Client X', 'Client Y', 'Client Z'], 'Delivery 1': [7, 8, 9]}).to_excel(writer, sheet_name='Pallet Order', index=False)
+        
+        builder = run_once()
+        dataset = pd.read_parquet(builder.parquet_path)
+        changed_records = dataset[dataset['Source_File'] == os.path.basename(changed_file)]
+        
+        print(f"\nТестирование инкрементальной обработки:")
+        print(f"✓ Статистика: {builder.stats}")
+        
+        assert builder.stats['files_changed'] == 1
+        assert builder.stats['files_skipped'] == 2
+        assert list(changed_records['Client_Name']) == ['Client Y', 'Client Z']
+        assert len(dataset) == len(first_run) - len(first_run) // 3 + 2
+        
+    finally:
+        os.chdir(original_cwd)
+        shutil.rmtree(temp_dir)
+
+def test_unreadable_file_not_recorded():
+    """Тестирует, что файл, который не удалось открыть, не попадает в манифест и обрабатывается повторно"""
+    from dataset_builder import DatasetBuilder
+    from dataset_builder_advanced import AdvancedDatasetBuilder
+    
+    temp_dir = create_test_archive(days=3)
+    broken_file = os.path.join(temp_dir, 'Lyons collections 02012024.xlsx')
+    with open(broken_file, 'rb') as f:
+        original = f.read()
+    
+    try:
+        print(f"\nТестирование поврежденных файлов:")
+        
+        for name, builder_class in [('basic', DatasetBuilder), ('advanced', AdvancedDatasetBuilder)]:
+            output_dir = os.path.join(temp_dir, name)
+            with open(broken_file, 'wb') as f:
+                f.write(b'not a workbook')
+            
+            builder = builder_class(output_dir=output_dir)
+            builder.run([temp_dir])
+            assert os.path.basename(broken_file) not in builder.manifest
+            assert len(builder.manifest) == 2
+            if builder_class is AdvancedDatasetBuilder:
+                assert builder.stats['errors'] == 1
+                assert builder.failed_files == {os.path.basename(broken_file)}
+            
+            # Исправленный файл обрабатывается при следующем запуске
+            with open(broken_file, 'wb') as f:
+                f.write(original)
+            builder = builder_class(output_dir=output_dir)
+            builder.run([temp_dir])
+            dataset = pd.read_parquet(builder.parquet_path)
+            
+            print(f"✓ {name}: после исправления файла записей {len(dataset)}")
+            
+            assert os.path.basename(broken_file) in builder.manifest
+            assert (dataset['Source_File'] == os.path.basename(broken_file)).any()
+        
+    finally:
+        shutil.rmtree(temp_dir)
+
+def test_file_rewritten_during_processing():
+    """Тестирует, что файл, перезаписанный во время разбора, обрабатывается заново при следующем запуске"""
+    from dataset_builder import DatasetBuilder
+    from dataset_builder_advanced import AdvancedDatasetBuilder
+    
+    temp_dir = create_test_archive(days=3)
+    rewritten = os.path.join(temp_dir, 'Lyons collections 02012024.xlsx')
+    with open(rewritten, 'rb') as f:
+        original = f.read()
+    
+    # Новое содержимое файла: одним клиентом меньше
+    sheets = pd.read_excel(rewritten, sheet_name=None)
+    sheets['Pallet Order'] = sheets['Pallet Order'].iloc[:-1]
+    
+    try:
+        print(f"\nТестирование файла, перезаписанного во время разбора:")
+        
+        for name, builder_class in [('basic', DatasetBuilder), ('advanced', AdvancedDatasetBuilder)]:
+            output_dir = os.path.join(temp_dir, name)
+            with open(rewritten, 'wb') as f:
+                f.write(original)
+            
+            # Файл перезаписывается после разбора, но до записи в манифест
+            builder = builder_class(output_dir=output_dir)
+            process_excel_file = builder.process_excel_file
+            def rewriting_process(file_path, *args, **kwargs):
+                file_records = process_excel_file(file_path, *args, **kwargs)
+                if file_path == rewritten:
+                    with pd.ExcelWriter(rewritten, engine='openpyxl') as writer:
+                        for sheet_name, df in sheets.items():
+                            df.to_excel(writer, sheet_name=sheet_name, index=False)
+                return file_records
+            builder.process_excel_file = rewriting_process
+            builder.run([temp_dir])
+            
+            # Следующий запуск видит новое содержимое и заменяет записи файла
+            builder = builder_class(output_dir=output_dir)
+            builder.run([temp_dir])
+            dataset = pd.read_parquet(builder.parquet_path)
+            fresh = builder_class(output_dir=os.path.join(temp_dir, f'{name}_fresh'))
+            fresh.run([temp_dir])
+            expected = pd.read_parquet(fresh.parquet_path)
+            
+            print(f"✓ {name}: записей {len(dataset)}")
+            
+            assert dataset['Source_File'].astype(str).value_counts().to_dict() == expected['Source_File'].astype(str).value_counts().to_dict()
+            assert builder.manifest.get(os.path.basename(rewritten))['sha256'] == fresh.manifest.get(os.path.basename(rewritten))['sha256']
+        
+    finally:
+        shutil.rmtree(temp_dir)
+
+def test_streaming_output():
+    """Тестирует потоковую запись датасета"""
+    from dataset_builder_advanced import AdvancedDatasetBuilder
+    from dataset_schema import DATASET_SCHEMA
+    
+    temp_dir = create_test_archive(days=3)
+    
+    try:
+        builder = AdvancedDatasetBuilder(load_existing=False, output_mode='stream')
+        builder.parquet_path = os.path.join(temp_dir, 'combined_dataset.parquet')
+        builder.csv_path = os.path.join(temp_dir, 'combined_dataset.csv')
+        
+        excel_files = builder.find_excel_files(temp_dir)
+        new_records = builder.stream_dataset(builder.plan_files(excel_files))
+        
+        parquet_df = pd.read_parquet(builder.parquet_path)
+        csv_df = pd.read_csv(builder.csv_path)
+        
+        print(f"\nТестирование потоковой записи:")
+        print(f"✓ Записано записей: {new_records}")
+        
+        assert new_records == 21
+        assert len(parquet_df) == len(csv_df) == new_records
+        assert list(parquet_df.columns) == DATASET_SCHEMA.names
+        assert parquet_df['Source_File'].nunique() == 3
+        
+    finally:
+        shutil.rmtree(temp_dir)
+
+def test_partitioned_output():
+    """Тестирует запись датасета с разделами по дате"""
+    from dataset_builder_advanced import AdvancedDatasetBuilder
+    
+    temp_dir = create_test_archive(days=3)
+    dataset_dir = os.path.join(temp_dir, 'combined_dataset')
+    
+    try:
+        builder = AdvancedDatasetBuilder(load_existing=False, output_mode='partitioned')
+        builder.dataset_dir = dataset_dir
+        builder.write_partitions(builder.plan_files(builder.find_excel_files(temp_dir)))
+        
+        partitions = sorted(os.listdir(dataset_dir))
+        assert partitions == ['Date=2024-01-01', 'Date=2024-01-02', 'Date=2024-01-03']
+        
+        # Повторная запись файла заменяет только его часть
+        untouched_part = os.path.join(dataset_dir, 'Date=2024-01-01', 'Lyons collections 01012024.xlsx.parquet')
+        mtime_before = os.path.getmtime(untouched_part)
+        
+        changed_file = os.path.join(temp_dir, 'Lyons collections 02012024.xlsx')
+        builder.changed_files.add(os.path.basename(changed_file))
+        builder.write_partitions([changed_file])
+        
+        df = pd.read_parquet(dataset_dir)
+        day_df = pd.read_parquet(dataset_dir, filters=[('Date', '=', '2024-01-02')])
+        
+        print(f"\nТестирование записи по разделам:")
+        print(f"✓ Разделы: {partitions}")
+        
+        assert len(df) == 21
+        assert len(day_df) == 7
+        assert os.path.getmtime(untouched_part) == mtime_before
+        
+    finally:
+        shutil.rmtree(temp_dir)
+
+def test_source_grouping():
+    """Тестирует группировку пакетов датасета по исходным файлам и перенос датасета в разделы по пакетам"""
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    from dataset_builder_advanced import AdvancedDatasetBuilder
+    from dataset_writer import iter_source_tables
+    
+    # Записи файла продолжаются в следующем пакете, пустой Source_File, пустой пакет
+    batches = [['a', 'a', 'b'], ['b', None, None], [], [None, 'c', 'c'], ['d', 'e', 'd']]
+    tables = []
+    for batch in batches:
+        tables.append(pa.table({'Source_File': pa.array(batch, type=pa.string()),
+                                'Row': pa.array(range(len(tables) * 10, len(tables) * 10 + len(batch)), type=pa.int64())}))
+    dataset = pa.concat_tables(tables)
+    
+    groups = list(iter_source_tables(tables))
+    assert [source for source, _ in groups] == ['a', 'b', None, 'c', 'd', 'e']
+    for source, table in groups:
+        mask = pc.is_null(dataset['Source_File']) if source is None else pc.equal(dataset['Source_File'], source)
+        assert table.equals(dataset.filter(mask))
+    
+    temp_dir = create_test_archive(days=3)
+    output_dir = os.path.join(temp_dir, 'output')
+    
+    try:
+        AdvancedDatasetBuilder(output_dir=output_dir).run([temp_dir])
+        combined = pd.read_parquet(os.path.join(output_dir, 'combined_dataset.parquet'))
+        
+        # Существующий датасет читается пакетами по 5 записей: записи файлов переходят через границы пакетов
+        builder = AdvancedDatasetBuilder(output_dir=output_dir, output_mode='partitioned')
+        iter_existing_tables = builder.iter_existing_tables
+        builder.iter_existing_tables = lambda replaced_files: (
+            pa.Table.from_batches([batch]) for table in iter_existing_tables(replaced_files)
+            for batch in table.to_batches(max_chunksize=5))
+        builder.run([temp_dir])
+        partitioned = pd.read_parquet(builder.dataset_dir)
+        
+        print(f"\nТестирование группировки по исходным файлам:")
+        print(f"✓ Перенесено в разделы: {len(partitioned)} записей")
+        
+        columns = ['Source_File', 'Client_Name', 'Delivery_Name', 'Load_Number']
+        columns = [column for column in columns if column in combined.columns]
+        expected = combined[columns].astype(str).sort_values(columns).reset_index(drop=True)
+        actual = partitioned[columns].astype(str).sort_values(columns).reset_index(drop=True)
+        assert len(partitioned) == len(combined) == 21
+        assert actual.equals(expected)
+        
+    finally:
+        shutil.rmtree(temp_dir)
+
+def test_dataset_schema():
+    """Тестирует приведение записей к схеме датасета"""
+    import json
+    import pyarrow as pa
+    from dataset_schema import DATASET_SCHEMA, records_to_table
+    
+    records = [
+        {'Date': '2024-01-02', 'Client_Name': 'Client A', 'Pallets_Ordered': 4.0, 'extra_Notes': 'late'},
+        {'Date': 'not a date', 'Client_Name': 'Client A', 'Pallets_Ordered': 2.5, 'Source_File': 'file.xlsx'},
+    ]
+    table = records_to_table(records)
+    
+    print(f"\nТестирование схемы датасета:")
+    print(f"✓ Колонок: {len(table.schema)}")
+    
+    assert table.schema.equals(DATASET_SCHEMA)
+    assert table['Date'].type == pa.date32()
+    assert table['Pallets_Ordered'].to_pylist() == [4, None]
+    assert pa.types.is_dictionary(table['Client_Name'].type)
+    
+    # Неизвестные поля и значения, которые нельзя привести к типу колонки, сохраняются в Extra
+    extras = [json.loads(value) for value in table['Extra'].to_pylist()]
+    assert extras == [{'extra_Notes': 'late'}, {'Date': 'not a date', 'Pallets_Ordered': 2.5}]
+
+def test_command_line():
+    """Тестирует неинтерактивный запуск из командной строки и коды завершения"""
+    import dataset_builder
+    import dataset_builder_advanced
+    
+    temp_dir = create_test_archive(days=3)
+    output_dir = os.path.join(temp_dir, 'output')
+    
+    try:
+        exit_code = dataset_builder_advanced.main([temp_dir, '--output-dir', output_dir, '--format', 'parquet'])
+        assert exit_code == dataset_builder_advanced.EXIT_OK
+        assert sorted(os.listdir(output_dir)) == ['combined_dataset.parquet', 'dataset_commits.jsonl', 'processing_manifest.json', 'processing_runs.jsonl', 'processing_statistics.csv']
+        assert len(pd.read_parquet(os.path.join(output_dir, 'combined_dataset.parquet'))) == 21
+        
+        # Файл без даты в имени не обрабатывается - запуск завершается с кодом ошибки файлов
+        shutil.copy(os.path.join(temp_dir, 'Lyons collections 01012024.xlsx'), os.path.join(temp_dir, 'Lyons collections latest.xlsx'))
+        assert dataset_builder_advanced.main([temp_dir, '-o', output_dir]) == dataset_builder_advanced.EXIT_FILE_ERRORS
+        
+        # Полная пересборка базовым сборщиком и несуществующая папка
+        assert dataset_builder.main([temp_dir, '-o', output_dir, '--full']) == dataset_builder.EXIT_OK
+        assert dataset_builder.main([os.path.join(temp_dir, 'missing'), '-o', output_dir]) == dataset_builder.EXIT_USAGE
+        
+        # Поврежденная книга, которую не удается открыть, тоже считается ошибкой файла
+        os.remove(os.path.join(temp_dir, 'Lyons collections latest.xlsx'))
+        with open(os.path.join(temp_dir, 'Lyons collections 04012024.xlsx'), 'wb') as f:
+            f.write(b'not a workbook')
+        assert dataset_builder.main([temp_dir, '-o', output_dir]) == dataset_builder.EXIT_FILE_ERRORS
+        assert dataset_builder_advanced.main([temp_dir, '-o', output_dir]) == dataset_builder_advanced.EXIT_FILE_ERRORS
+        
+        builder = dataset_builder_advanced.AdvancedDatasetBuilder(output_dir=output_dir)
+        builder.run([temp_dir])
+        assert builder.failed_files == {'Lyons collections 04012024.xlsx'}
+        assert 'Lyons collections 04012024.xlsx' not in builder.manifest
+        
+        print(f"\nТестирование командной строки:")
+        print(f"✓ Результаты: {sorted(os.listdir(output_dir))}")
+        
+    finally:
+        shutil.rmtree(temp_dir)
+
+def test_run_log():
+    """Тестирует журнал запуска: метрики каждого файла и итог запуска с одним идентификатором"""
+    import json
+    from dataset_builder_advanced import AdvancedDatasetBuilder
+    
+    temp_dir = create_test_archive(days=3)
+    
+    try:
+        for workers in (1, 2):
+            output_dir = os.path.join(temp_dir, f'output_{workers}')
+            builder = AdvancedDatasetBuilder(workers=workers, output_dir=output_dir)
+            os.makedirs(output_dir)
+            builder.ingest_files(builder.find_excel_files(temp_dir))
+            
+            with open(builder.run_log_path, encoding='utf-8') as f:
+                events = [json.loads(line) for line in f]
+            file_events = [event for event in events if event['event'] == 'file']
+            run_event = events[-1]
+            statistics = pd.read_csv(builder.statistics_path)
+            
+            print(f"\nТестирование журнала запуска (процессов: {workers}):")
+            print(f"✓ Событий: {len(events)}, первое: {file_events[0]}")
+            
+            assert len(file_events) == 3 and run_event['event'] == 'run'
+            assert {event['run_id'] for event in events} == {statistics['run_id'].iloc[0]}
+            for event in file_events:
+                assert event['status'] == 'ok' and event['bytes_read'] > 0
+                assert set(event['sheets']) == {'Pallet Order', 'Collection Plan'}
+                assert event['rows_scanned'] == sum(sheet['rows'] for sheet in event['sheets'].values())
+                assert event['records'] == 7 and event['merge_seconds'] >= 0
+            assert run_event['files_processed'] == 3 and run_event['new_records'] == 21
+            if run_event['peak_rss_bytes'] is not None:
+                assert run_event['peak_rss_bytes'] > 0
+        
+    finally:
+        shutil.rmtree(temp_dir)
+
+def test_profiling_hook():
+    """Тестирует профилирование файлов и запуска с порогом времени"""
+    import pstats
+    from dataset_builder_advanced import AdvancedDatasetBuilder
+    
+    temp_dir = create_test_archive(days=2)
+    
+    try:
+        profiled = {}
+        for scope, threshold in [('file', 0.0), ('file', 3600.0), ('run', 0.0)]:
+            output_dir = os.path.join(temp_dir, f'output_{scope}_{threshold:g}')
+            os.makedirs(output_dir)
+            builder = AdvancedDatasetBuilder(output_dir=output_dir, profile=scope, profile_threshold=threshold)
+            builder.ingest_files(builder.find_excel_files(temp_dir))
+            
+            profile_dir = os.path.join(output_dir, 'profiles')
+            profiled[scope, threshold] = sorted(os.listdir(profile_dir)) if os.path.isdir(profile_dir) else []
+        
+        print(f"\nТестирование профилирования:")
+        print(f"✓ Профили: {profiled}")
+        
+        # Профиль и текстовая сводка на каждый файл; медленнее часа файлы не обрабатываются
+        assert len(profiled['file', 0.0]) == 4
+        assert profiled['file', 3600.0] == []
+        assert [name.split('_', 1)[1] for name in profiled['run', 0.0]] == ['run.prof', 'run.txt']
+        
+        run_profile = os.path.join(temp_dir, 'output_run_0', 'profiles', profiled['run', 0.0][0])
+        functions = {function for _, _, function in pstats.Stats(run_profile).stats}
+        assert 'process_excel_file' in functions and 'save_dataset' in functions
+        
+    finally:
+        shutil.rmtree(temp_dir)
+
+def test_dataset_store():
+    """Тестирует базу SQLite: перенос датасета, замену записей файла и запросы"""
+    from dataset_builder_advanced import AdvancedDatasetBuilder
+    from dataset_store import DatasetStore
+    
+    temp_dir = create_test_archive(days=3)
+    output_dir = os.path.join(temp_dir, 'output')
+    
+    try:
+        # Датасет собран без базы; при первом запуске с базой он переносится в нее
+        AdvancedDatasetBuilder(output_dir=output_dir).run([temp_dir])
+        builder = AdvancedDatasetBuilder(output_dir=output_dir, store=True)
+        builder.run([temp_dir])
+        builder.store.close()
+        
+        with DatasetStore(builder.store_path) as store:
+            assert store.record_count() == 21
+            assert store.ingested_files() == {f'Lyons collections 0{day}012024.xlsx': 7 for day in (1, 2, 3)}
+        
+        # Исправленный файл: его записи заменяются, а не дублируются
+        changed_file = os.path.join(temp_dir, 'Lyons collections 02012024.xlsx')
+        with pd.ExcelWriter(changed_file, engine='openpyxl') as writer:
+            pd.DataFrame({'Client': ['Client A'], 'Delivery 1': [5]}).to_excel(writer, sheet_name='Pallet Order', index=False)
+            pd.DataFrame({'Load Number': ['L009'], 'Delivery Destination': ['Delivery 1']}).to_excel(writer, sheet_name='Collection Plan', index=False)
+        for _ in range(2):
+            builder = AdvancedDatasetBuilder(output_dir=output_dir, store=True)
+            builder.run([temp_dir])
+            builder.store.close()
+        
+        with DatasetStore(builder.store_path) as store:
+            dataset_rows = len(pd.read_parquet(builder.parquet_path))
+            per_file = store.query("SELECT Source_File, COUNT(*) AS n FROM records GROUP BY Source_File ORDER BY Source_File")
+            weekly = store.query(
+                "SELECT strftime('%Y-%W', Date) AS week, delivery_destination, SUM(plan_pallets_ordered) AS pallets "
+                "FROM records WHERE delivery_destination IS NOT NULL GROUP BY week, delivery_destination")
+            indexes = set(store.query("SELECT name FROM sqlite_master WHERE type = 'index'")['name'])
+            
+            print(f"\nТестирование базы датасета:")
+            print(f"✓ Записей по файлам: {per_file.values.tolist()}")
+            print(f"✓ Паллет по неделям: {len(weekly)} строк")
+            
+            assert store.record_count() == dataset_rows
+            assert per_file['n'].tolist() == [7, 1, 7]
+            assert store.ingested_files()['Lyons collections 02012024.xlsx'] == 1
+            assert len(weekly) > 0
+            assert {'idx_records_date', 'idx_records_source_file', 'idx_records_load_number'} <= indexes
+        
+        # Датасет с разделами по дате переносится в базу частями исходных файлов, дата берется из раздела
+        partitioned_dir = os.path.join(temp_dir, 'partitioned')
+        AdvancedDatasetBuilder(output_dir=partitioned_dir, output_mode='partitioned').run([temp_dir])
+        builder = AdvancedDatasetBuilder(output_dir=partitioned_dir, output_mode='partitioned', store=True)
+        builder.run([temp_dir])
+        builder.store.close()
+        
+        with DatasetStore(builder.store_path) as store:
+            dates = store.query("SELECT Source_File, MIN(Date) AS first, MAX(Date) AS last FROM records GROUP BY Source_File ORDER BY Source_File")
+            assert store.ingested_files() == {'Lyons collections 01012024.xlsx': 7, 'Lyons collections 02012024.xlsx': 1,
+                                              'Lyons collections 03012024.xlsx': 7}
+            assert [str(first)[:10] for first in dates['first']] == ['2024-01-01', '2024-01-02', '2024-01-03']
+            assert dates['first'].tolist() == dates['last'].tolist()
+        
+    finally:
+        shutil.rmtree(temp_dir)
+
+def test_reprocess_file():
+    """Тестирует повторную обработку одного дня: записи файла заменяются, остальные не меняются"""
+    from dataset_builder import DatasetBuilder
+    from dataset_builder_advanced import AdvancedDatasetBuilder
+    
+    temp_dir = create_test_archive(days=3)
+    reprocessed = 'Lyons collections 02012024.xlsx'
+    
+    try:
+        print(f"\nТестирование повторной обработки:")
+        
+        for name, builder_class, options in [
+            ('basic', DatasetBuilder, {}),
+            ('combined', AdvancedDatasetBuilder, {}),
+            ('stream', AdvancedDatasetBuilder, {'output_mode': 'stream'}),
+        ]:
+            output_dir = os.path.join(temp_dir, name)
+            builder_class(output_dir=output_dir, **options).run([temp_dir])
+            before = pd.read_parquet(os.path.join(output_dir, 'combined_dataset.parquet'))
+            
+            # День указан датой; без --reprocess неизмененный файл был бы пропущен
+            builder = builder_class(output_dir=output_dir, reprocess=['2024-01-02'], **options)
+            builder.run([temp_dir])
+            after = pd.read_parquet(builder.parquet_path)
+            csv_rows = len(pd.read_csv(builder.csv_path))
+            
+            others_before = before[before['Source_File'] != reprocessed].reset_index(drop=True)
+            others_after = after[after['Source_File'] != reprocessed].reset_index(drop=True)
+            
+            print(f"✓ {name}: {len(before)} -> {len(after)} записей, "
+                  f"записей файла {reprocessed}: {(after['Source_File'] == reprocessed).sum()}")
+            
+            assert builder.changed_files == {reprocessed}
+            assert len(after) == len(before) == csv_rows
+            assert not after.duplicated().any()
+            pd.testing.assert_frame_equal(others_after, others_before, check_categorical=False)
+        
+        # Разделы по дате: переписывается только часть повторно обработанного файла
+        output_dir = os.path.join(temp_dir, 'partitioned')
+        builder = AdvancedDatasetBuilder(output_dir=output_dir, output_mode='partitioned')
+        builder.run([temp_dir])
+        parts = {path: os.stat(path).st_mtime_ns
+                 for path in glob.glob(os.path.join(builder.dataset_dir, '*', '*.parquet'))}
+        time.sleep(0.01)
+        
+        builder = AdvancedDatasetBuilder(output_dir=output_dir, output_mode='partitioned', reprocess=[reprocessed])
+        builder.run([temp_dir])
+        rewritten = [os.path.basename(path) for path, mtime in parts.items() if os.stat(path).st_mtime_ns != mtime]
+        
+        print(f"✓ partitioned: переписаны части {rewritten}")
+        
+        assert rewritten == [f'{reprocessed}.parquet']
+        assert len(pd.read_parquet(builder.dataset_dir)) == 21
+        
+    finally:
+        shutil.rmtree(temp_dir)
+
+def test_failed_reprocess_keeps_records():
+    """Тестирует, что прежние записи файла сохраняются, если его не удалось обработать заново"""
+    from dataset_builder import DatasetBuilder
+    from dataset_builder_advanced import AdvancedDatasetBuilder
+    
+    temp_dir = create_test_archive(days=3)
+    broken_name = 'Lyons collections 02012024.xlsx'
+    broken_file = os.path.join(temp_dir, broken_name)
+    with open(broken_file, 'rb') as f:
+        original = f.read()
+    
+    def read_dataset(builder):
+        if getattr(builder, 'output_mode', None) == 'partitioned':
+            return pd.read_parquet(builder.dataset_dir)
+        return pd.read_parquet(builder.parquet_path)
+    
+    try:
+        print(f"\nТестирование неудачной повторной обработки:")
+        
+        for name, builder_class, options in [
+            ('basic', DatasetBuilder, {}),
+            ('combined', AdvancedDatasetBuilder, {}),
+            ('stream', AdvancedDatasetBuilder, {'output_mode': 'stream'}),
+            ('partitioned', AdvancedDatasetBuilder, {'output_mode': 'partitioned'}),
+            ('store', AdvancedDatasetBuilder, {'store': True}),
+        ]:
+            output_dir = os.path.join(temp_dir, name)
+            with open(broken_file, 'wb') as f:
+                f.write(original)
+            builder = builder_class(output_dir=output_dir, **options)
+            builder.run([temp_dir])
+            before = read_dataset(builder)
+            
+            # Файл испорчен после обработки: он изменился, но прочитать его нельзя
+            with open(broken_file, 'wb') as f:
+                f.write(b'not a workbook')
+            for reprocess in (['2024-01-02'], None):
+                builder = builder_class(output_dir=output_dir, reprocess=reprocess, **options)
+                builder.run([temp_dir])
+                after = read_dataset(builder)
+                
+                assert len(after) == len(before)
+                assert (after['Source_File'] == broken_name).sum() == (before['Source_File'] == broken_name).sum()
+                assert builder.manifest.get(broken_name)['size'] == len(original)
+            
+            if getattr(builder, 'store', None) is not None:
+                builder.store.open()
+                assert builder.store.ingested_files()[broken_name] == (before['Source_File'] == broken_name).sum()
+                builder.store.close()
+            
+            print(f"✓ {name}: записей до {len(before)}, после {len(after)}")
+        
+    finally:
+        shutil.rmtree(temp_dir)
+
+def test_atomic_commit():
+    """Тестирует фиксацию результатов: сбой до и во время замены файлов не портит датасет"""
+    import commit_log
+    from dataset_builder_advanced import AdvancedDatasetBuilder
+    
+    temp_dir = create_test_archive(days=3)
+    output_dir = os.path.join(temp_dir, 'output')
+    changed_file = os.path.join(temp_dir, 'Lyons collections 02012024.xlsx')
+    
+    def change_file(clients):
+        with pd.ExcelWriter(changed_file, engine='openpyxl') as writer:
+            pd.DataFrame({'Client': clients, 'Delivery 1': range(len(clients))}).to_excel(writer, sheet_name='Pallet Order', index=False)
+    
+    def output_files():
+        return sorted(os.listdir(output_dir))
+    
+    try:
+        builder = AdvancedDatasetBuilder(output_dir=output_dir)
+        builder.run([temp_dir])
+        assert [entry['event'] for entry in builder.commit_log.entries()] == ['prepare', 'commit']
+        files_before = output_files()
+        with open(builder.parquet_path, 'rb') as f:
+            parquet_before = f.read()
+        
+        # Сбой до фиксации: итоговые файлы не меняются, временные удаляются
+        change_file(['Client X', 'Client Y'])
+        builder = AdvancedDatasetBuilder(output_dir=output_dir)
+        def failing_save(transaction=None):
+            raise OSError("диск заполнен")
+        builder.manifest.save = failing_save
+        try:
+            builder.ingest_files(builder.find_excel_files(temp_dir))
+            assert False, "ожидалась ошибка сохранения"
+        except OSError:
+            pass
+        with open(builder.parquet_path, 'rb') as f:
+            assert f.read() == parquet_before
+        assert output_files() == files_before
+        
+        # Сбой во время замены: первый файл заменен, остальные - нет; при запуске замена завершается
+        change_file(['Client X', 'Client Y', 'Client Z'])
+        builder = AdvancedDatasetBuilder(output_dir=output_dir)
+        installed = []
+        original_install = commit_log.install
+        def crashing_install(tmp_path, path):
+            if installed:
+                raise KeyboardInterrupt
+            installed.append(path)
+            original_install(tmp_path, path)
+        commit_log.install = crashing_install
+        try:
+            builder.ingest_files(builder.find_excel_files(temp_dir))
+            assert False, "ожидалось прерывание"
+        except KeyboardInterrupt:
+            pass
+        finally:
+            commit_log.install = original_install
+        assert builder.commit_log.pending() is not None
+        
+        builder = AdvancedDatasetBuilder(output_dir=output_dir)
+        dataset = pd.read_parquet(builder.parquet_path)
+        csv_dataset = pd.read_csv(builder.csv_path)
+        changed_records = dataset[dataset['Source_File'] == os.path.basename(changed_file)]
+        
+        print(f"\nТестирование фиксации результатов:")
+        print(f"✓ Журнал фиксаций: {[entry['event'] for entry in builder.commit_log.entries()]}")
+        print(f"✓ Записей после восстановления: {len(dataset)}")
+        
+        assert builder.commit_log.pending() is None
+        assert builder.commit_log.entries()[-1]['event'] == 'recover'
+        assert list(changed_records['Client_Name']) == ['Client Y', 'Client Z']
+        assert len(dataset) == len(csv_dataset) == 16
+        assert builder.manifest.get(os.path.basename(changed_file))['records'] == 2
+        assert not [name for name in output_files() if name.endswith('.tmp')]
+        assert builder.commit_log.verify() == []
+        
+        # Поврежденный (обрезанный) CSV обнаруживается по размеру из журнала
+        with open(builder.csv_path, 'r+b') as f:
+            f.truncate(100)
+        assert builder.commit_log.verify() == [builder.csv_path]
+        
+    finally:
+        shutil.rmtree(temp_dir)
+
+def test_checkpoint_resume():
+    """Тестирует контрольные точки: после сбоя запуск продолжается с первого необработанного файла"""
+    from dataset_builder import DatasetBuilder
+    from dataset_builder_advanced import AdvancedDatasetBuilder
+    from commit_log import CheckpointSchedule
+    
+    # Порог по времени: часы подменяются, чтобы не ждать
+    now = [0.0]
+    schedule = CheckpointSchedule(every_seconds=60, clock=lambda: now[0])
+    assert not schedule.file_done()
+    now[0] = 61
+    assert schedule.file_done()
+    schedule.reset()
+    assert not schedule.file_done()
+    assert not CheckpointSchedule().file_done()
+    
+    temp_dir = create_test_archive(days=4)
+    
+    try:
+        print(f"\nТестирование контрольных точек:")
+        
+        for name, options in [
+            ('combined', {}),
+            ('stream', {'output_mode': 'stream'}),
+            ('partitioned', {'output_mode': 'partitioned'}),
+            ('full', {'incremental': False}),
+        ]:
+            output_dir = os.path.join(temp_dir, name)
+            builder = AdvancedDatasetBuilder(output_dir=output_dir, checkpoint_files=1, **options)
+            
+            # Сбой на третьем файле: два обработанных файла уже зафиксированы
+            process_excel_file = builder.process_excel_file
+            def crashing_process(file_path, check_processed=True):
+                if '03012024' in file_path:
+                    raise KeyboardInterrupt
+                return process_excel_file(file_path, check_processed)
+            builder.process_excel_file = crashing_process
+            try:
+                builder.run([temp_dir])
+                assert False, "ожидалось прерывание"
+            except KeyboardInterrupt:
+                pass
+            
+            options.pop('incremental', None)
+            builder = AdvancedDatasetBuilder(output_dir=output_dir, **options)
+            assert len(builder.manifest) == 2
+            builder.run([temp_dir])
+            
+            dataset = pd.read_parquet(builder.dataset_dir if name == 'partitioned' else builder.parquet_path)
+            per_file = dataset['Source_File'].astype(str).value_counts().to_dict()
+            
+            print(f"✓ {name}: после продолжения обработано {builder.stats['files_processed']}, "
+                  f"пропущено {builder.stats['files_skipped']}, записей {len(dataset)}")
+            
+            assert builder.stats['files_skipped'] == 2
+            assert builder.stats['files_processed'] == 2
+            assert per_file == {f'Lyons collections 0{day}012024.xlsx': 7 for day in (1, 2, 3, 4)}
+            assert not dataset.drop(columns=['Date']).duplicated().any()
+        
+        # Базовый сборщик: контрольная точка после каждого файла
+        output_dir = os.path.join(temp_dir, 'basic')
+        builder = DatasetBuilder(output_dir=output_dir, checkpoint_files=1)
+        process_excel_file = builder.process_excel_file
+        def crashing_basic_process(file_path):
+            if '03012024' in file_path:
+                raise KeyboardInterrupt
+            return process_excel_file(file_path)
+        builder.process_excel_file = crashing_basic_process
+        try:
+            builder.run([temp_dir])
+            assert False, "ожидалось прерывание"
+        except KeyboardInterrupt:
+            pass
+        
+        builder = DatasetBuilder(output_dir=output_dir)
+        assert len(builder.manifest) == 2
+        builder.run([temp_dir])
+        dataset = pd.read_parquet(builder.parquet_path)
+        
+        print(f"✓ basic: записей {len(dataset)}")
+        
+        assert len(dataset) == len(pd.read_csv(builder.csv_path)) == 40
+        assert dataset['Source_File'].astype(str).value_counts().to_dict() == {
+            f'Lyons collections 0{day}012024.xlsx': 10 for day in (1, 2, 3, 4)}
+        
+    finally:
+        shutil.rmtree(temp_dir)
+
+def test_stream_checkpoint_keeps_changed_records():
+    """Тестирует, что контрольные точки потоковой записи не теряют прежние записи еще не обработанных измененных файлов"""
+    import pyarrow as pa
+    from dataset_builder_advanced import AdvancedDatasetBuilder
+    from dataset_writer import checkpoint_parts, iter_dataset_tables
+    
+    temp_dir = create_test_archive(days=3)
+    output_dir = os.path.join(temp_dir, 'stream')
+    expected = {f'Lyons collections 0{day}012024.xlsx': 7 for day in (1, 2, 3)}
+    
+    try:
+        AdvancedDatasetBuilder(output_dir=output_dir, output_mode='stream').run([temp_dir])
+        builder = AdvancedDatasetBuilder(output_dir=output_dir, output_mode='stream', checkpoint_files=1,
+                                         reprocess=['2024-01-01', '2024-01-02', '2024-01-03'])
+        committed = os.stat(builder.parquet_path).st_mtime_ns
+        
+        # Сбой на третьем файле после двух контрольных точек
+        process_excel_file = builder.process_excel_file
+        def crashing_process(file_path, check_processed=True):
+            if '03012024' in file_path:
+                raise KeyboardInterrupt
+            return process_excel_file(file_path, check_processed)
+        builder.process_excel_file = crashing_process
+        try:
+            builder.run([temp_dir])
+            assert False, "ожидалось прерывание"
+        except KeyboardInterrupt:
+            pass
+        
+        # Датасет не переписывался: записи обработанных файлов зафиксированы частями рядом с ним
+        assert os.stat(builder.parquet_path).st_mtime_ns == committed
+        assert len(checkpoint_parts(builder.parquet_path)) == 2
+        dataset = pa.concat_tables(list(iter_dataset_tables(builder.parquet_path)))
+        assert dataset['Source_File'].to_pandas().value_counts().to_dict() == expected
+        
+        # Следующий запуск обрабатывает третий файл заново и включает части в датасет
+        builder = AdvancedDatasetBuilder(output_dir=output_dir, output_mode='stream', reprocess=['2024-01-03'])
+        builder.run([temp_dir])
+        dataset = pd.read_parquet(builder.parquet_path)
+        
+        print(f"\nТестирование контрольных точек потоковой записи:")
+        print(f"✓ Записей после продолжения: {len(dataset)}")
+        
+        assert builder.stats['files_skipped'] == 2
+        assert dataset['Source_File'].astype(str).value_counts().to_dict() == expected
+        assert len(pd.read_csv(builder.csv_path)) == 21
+        assert checkpoint_parts(builder.parquet_path) == []
+        
+    finally:
+        shutil.rmtree(temp_dir)
+
+def test_folder_watcher():
+    """Тестирует отбор новых файлов с ожиданием окончания записи"""
+    from folder_watcher import FolderWatcher
+    
+    temp_dir = tempfile.mkdtemp()
+    file_path = os.path.join(temp_dir, 'Lyons collections 05012024.xlsx')
+    now = [0.0]
+    watcher = FolderWatcher(lambda: [os.path.join(temp_dir, name) for name in os.listdir(temp_dir)],
+                            settle_seconds=30, clock=lambda: now[0])
+    
+    try:
+        watcher.snapshot()
+        assert watcher.poll() == []
+        
+        # Файл еще копируется: размер меняется между опросами
+        with open(file_path, 'wb') as f:
+            f.write(b'x' * 10)
+        assert watcher.poll() == []
+        now[0] = 20
+        with open(file_path, 'ab') as f:
+            f.write(b'x' * 10)
+        assert watcher.poll() == []
+        
+        # Подпись не менялась дольше settle_seconds - файл готов, и возвращается один раз
+        now[0] = 55
+        ready_files = watcher.poll()
+        now[0] = 120
+        
+        print(f"\nТестирование наблюдения за папкой:")
+        print(f"✓ Готовые файлы: {[os.path.basename(f) for f in ready_files]}")
+        
+        assert ready_files == [file_path]
+        assert watcher.poll() == []
+        
+    finally:
+        shutil.rmtree(temp_dir)
+
+def test_folder_watcher_skips_unchanged_directories():
+    """Тестирует, что опрос проверяет только файлы изменившихся папок"""
+    import folder_watcher
+    from folder_watcher import FolderWatcher
+    
+    temp_dir = tempfile.mkdtemp()
+    folders = [os.path.join(temp_dir, name) for name in ('January', 'February')]
+    past = time.time() - 3600
+    for day, folder in enumerate(folders, start=1):
+        os.makedirs(folder)
+        for name in (f'Lyons collections 0{day}012024.xlsx', f'Lyons collections 0{day}022024.xlsx'):
+            with open(os.path.join(folder, name), 'wb') as f:
+                f.write(b'x')
+            os.utime(os.path.join(folder, name), (past, past))
+        os.utime(folder, (past, past))
+    
+    def find_files():
+        return sorted(os.path.join(folder, name) for folder in folders for name in os.listdir(folder))
+    
+    # Считаем, подписи каких файлов запрашивает опрос
+    checked = []
+    original_signature = folder_watcher.file_signature
+    def counting_signature(file_path):
+        checked.append(os.path.basename(file_path))
+        return original_signature(file_path)
+    folder_watcher.file_signature = counting_signature
+    
+    try:
+        watcher = FolderWatcher(find_files, settle_seconds=0, full_scan_every=3)
+        watcher.snapshot()
+        
+        # Папки не менялись - файлы не проверяются
+        checked.clear()
+        assert watcher.poll() == []
+        assert checked == []
+        
+        # Новый файл в одной папке - проверяются только файлы этой папки
+        new_file = os.path.join(folders[0], 'Lyons collections 03012024.xlsx')
+        with open(new_file, 'wb') as f:
+            f.write(b'x')
+        os.utime(new_file, (past + 60, past + 60))
+        os.utime(folders[0], (past + 60, past + 60))
+        checked.clear()
+        assert watcher.poll() == [new_file]
+        assert sorted(checked) == sorted(os.listdir(folders[0]))
+        
+        # Файл, перезаписанный на месте, находится полной проверкой
+        rewritten = os.path.join(folders[1], 'Lyons collections 02012024.xlsx')
+        with open(rewritten, 'wb') as f:
+            f.write(b'xx')
+        os.utime(folders[1], (past, past))
+        assert watcher.poll() == [rewritten]
+        
+        print(f"\nТестирование опроса неизмененных папок: ✓")
+        
+    finally:
+        folder_watcher.file_signature = original_signature
+        shutil.rmtree(temp_dir)
+
+def test_watch_retries_failed_files():
+    """Тестирует, что в режиме наблюдения файл с ошибкой обрабатывается следующим опросом"""
+    from dataset_builder_advanced import AdvancedDatasetBuilder
+    
+    temp_dir = create_test_archive(days=3)
+    output_dir = os.path.join(temp_dir, 'output')
+    locked_file = os.path.join(temp_dir, 'Lyons collections 03012024.xlsx')
+    
+    builder = AdvancedDatasetBuilder(output_dir=output_dir)
+    
+    # Файл занят другим процессом только при первой попытке; сам файл не меняется
+    attempts = []
+    process_excel_file = builder.process_excel_file
+    def locked_process(file_path, check_processed=True):
+        if file_path == locked_file:
+            attempts.append(file_path)
+            if len(attempts) == 1:
+                raise PermissionError(f"файл занят: {file_path}")
+        return process_excel_file(file_path, check_processed)
+    builder.process_excel_file = locked_process
+    
+    # Два опроса, затем Ctrl+C
+    polls = []
+    original_sleep = time.sleep
+    def sleep(seconds):
+        polls.append(seconds)
+        if len(polls) > 2:
+            raise KeyboardInterrupt
+    time.sleep = sleep
+    
+    try:
+        assert builder.watch([temp_dir], interval=1, settle_seconds=0) == 0
+        time.sleep = original_sleep
+        dataset = pd.read_parquet(builder.parquet_path)
+        
+        print(f"\nТестирование повтора файлов с ошибкой при наблюдении:")
+        print(f"✓ Попыток обработки занятого файла: {len(attempts)}")
+        
+        assert len(attempts) == 2
+        assert os.path.basename(locked_file) in builder.manifest
+        assert dataset['Source_File'].astype(str).value_counts().to_dict() == {
+            f'Lyons collections 0{day}012024.xlsx': 7 for day in (1, 2, 3)}
+        
+    finally:
+        time.sleep = original_sleep
+        shutil.rmtree(temp_dir)
+
+def test_file_scanner():
+    """Тестирует поиск файлов за один проход и кеш сканирования папок"""
+    import glob
+    import file_scanner
+    from file_scanner import DirectoryScanCache, scan_excel_files
+    
+    temp_dir = tempfile.mkdtemp()
+    names = [
+        'January/Lyons collections 01012024.xlsx',
+        'January/week 2/Lyons collections 08012024.xlsm',
+        'January/~$Lyons collections 01012024.xlsx',
+        'January/notes.xlsx',
+        '.hidden/Lyons collections 02012024.xlsx',
+        'Lyons collections 03012024.xlsx',
+    ]
+    for name in names:
+        os.makedirs(os.path.dirname(os.path.join(temp_dir, name)), exist_ok=True)
+        open(os.path.join(temp_dir, name), 'wb').close()
+    
+    # Старый поиск через glob, без файлов блокировки Excel
+    expected = sorted(
+        path for pattern in ['Lyons collections*.xlsx', 'Lyons collections*.xlsm']
+        for path in glob.glob(os.path.join(temp_dir, '**', pattern), recursive=True)
+    )
+    # Кеш хранится вне сканируемой папки, иначе его запись меняет время изменения корня
+    cache_dir = tempfile.mkdtemp()
+    cache_path = os.path.join(cache_dir, 'scan_cache.json')
+    racy_interval = file_scanner.RACY_INTERVAL_NS
+    
+    try:
+        # Файлы только что созданы - без этой поправки папки считались бы "свежими" и не кешировались
+        file_scanner.RACY_INTERVAL_NS = -10 ** 12
+        cache = DirectoryScanCache(cache_path)
+        found = scan_excel_files(temp_dir, cache=cache)
+        cache.save()
+    
+        print(f"\nТестирование сканирования папок:")
+        print(f"✓ Найдено файлов: {len(found)} (glob: {len(expected)})")
+    
+        assert found == expected
+        assert not any(os.path.basename(path).startswith('~$') for path in found)
+    
+        # Повторный запуск берет неизмененные папки из кеша, не читая их
+        cache = DirectoryScanCache(cache_path)
+        assert cache.load()
+        listed = []
+        original_list_directory = file_scanner.list_directory
+        file_scanner.list_directory = lambda directory, patterns: listed.append(directory) or original_list_directory(directory, patterns)
+        try:
+            assert scan_excel_files(temp_dir, cache=cache) == expected
+            assert listed == []
+    
+            # Новый файл меняет время изменения своей папки - перечитывается только она
+            new_file = os.path.join(temp_dir, 'January', 'week 2', 'Lyons collections 09012024.xlsx')
+            open(new_file, 'wb').close()
+            stat = os.stat(os.path.dirname(new_file))
+            os.utime(os.path.dirname(new_file), ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+            assert scan_excel_files(temp_dir, cache=cache) == sorted(expected + [new_file])
+            assert listed == [os.path.dirname(new_file)]
+        finally:
+            file_scanner.list_directory = original_list_directory
+    
+        print(f"✓ Повторное сканирование прочитало только измененную папку")
+    
+    finally:
+        file_scanner.RACY_INTERVAL_NS = racy_interval
+        shutil.rmtree(temp_dir)
+        shutil.rmtree(cache_dir)
+
+def test_benchmark_suite():
+    """Тестирует генератор синтетического архива и замер этапов обработки"""
+    import importlib.util
+    from benchmark import HISTORY_PATH, STAGES, generate_archive, run_benchmark
+    
+    archive_dir = tempfile.mkdtemp()
+    results_dir = tempfile.mkdtemp()
+    # Защищенные файлы - только если установлен msoffcrypto-tool
+    protected_ratio = 0.5 if importlib.util.find_spec('msoffcrypto') is not None else 0.0
+    
+    try:
+        files = generate_archive(archive_dir, days=3, clients=6, destinations=4,
+                                 protected_ratio=protected_ratio, header_offset=2, seed=1)
+        result = run_benchmark(archive_dir, results_dir, params={'days': 3})
+        run_benchmark(archive_dir, results_dir)
+        history = pd.read_csv(os.path.join(results_dir, HISTORY_PATH))
+        
+        print(f"\nТестирование замера производительности:")
+        print(f"✓ Файлов: {result['files']}, записей: {result['records']}, всего {result['total_seconds']:.3f} с")
+        
+        assert result['files'] == len(files) == 3
+        assert result['errors'] == 0
+        assert result['orders'] > 0 and result['deliveries'] > result['orders']
+        assert set(result['stages']) == set(STAGES)
+        assert all(result['stages'][stage] > 0 for stage in STAGES)
+        # История дописывается строкой на каждый запуск
+        assert len(history) == 2
+        assert history['param_days'].iloc[0] == 3
+        assert len([name for name in os.listdir(results_dir) if name.endswith('.json')]) == 2
+        
+    finally:
+        shutil.rmtree(archive_dir)
+        shutil.rmtree(results_dir)
+
+def reference_merge(orders, deliveries, advanced):
+    """Прежняя квадратичная реализация объединения, используется как эталон"""
+    merged_data = []
+    
+    delivery_dict = {}
+    if advanced:
+        for delivery in deliveries:
+            key = (delivery.get('delivery_destination'), delivery.get('pallets_ordered'), delivery.get('collection_site'))
+            if key[0] and key[1]:
+                delivery_dict[key] = delivery
+    
+    for order in orders:
+        best_match = None
+        key = (order.get('Delivery_Name'), order.get('Pallets_Ordered'), None)
+        if advanced and key in delivery_dict:
+            best_match = delivery_dict[key]
+        else:
+            for delivery in deliveries:
+                if (order.get('Pallets_Ordered') == delivery.get('pallets_ordered') and
+                    order.get('Delivery_Name') == delivery.get('delivery_destination')):
+                    best_match = delivery
+                    break
+        
+        if best_match and advanced:
+            merged_record = {**order}
+            for k, v in best_match.items():
+                if k not in merged_record or pd.isna(merged_record[k]):
+                    merged_record[k] = v
+            merged_data.append(merged_record)
+        elif best_match:
+            merged_data.append({**order, **best_match})
+        else:
+            merged_data.append(order)
+    
+    for delivery in deliveries:
+        if not any(d.get('load_number') == delivery.get('load_number') for d in merged_data):
+            merged_data.append(delivery)
+    
+    return merged_data
+
+def test_indexed_merge_matches_reference():
+    """Тестирует, что индексное объединение дает тот же результат, что и прежний перебор"""
+    from dataset_builder import DatasetBuilder
+    from dataset_builder_advanced import AdvancedDatasetBuilder
+    
+    test_file_path, temp_dir = create_test_excel_file()
+    
+    # Дубликаты ключей, доставки без места сбора и без номера загрузки, NaN
+    orders = [
+        {'Delivery_Name': 'Delivery 1', 'Pallets_Ordered': 5.0, 'Client_Name': 'A'},
+        {'Delivery_Name': 'Delivery 1', 'Pallets_Ordered': 5.0, 'Client_Name': 'B'},
+        {'Delivery_Name': 'Delivery 2', 'Pallets_Ordered': 3.0, 'Client_Name': 'C'},
+        {'Delivery_Name': 'Delivery 9', 'Pallets_Ordered': 1.0, 'Client_Name': 'D'},
+        {'Delivery_Name': float('nan'), 'Pallets_Ordered': 2, 'Client_Name': 'E'},
+    ]
+    deliveries = [
+        {'load_number': 'L1', 'delivery_destination': 'Delivery 1', 'pallets_ordered': 5, 'collection_site': 'S'},
+        {'load_number': 'L2', 'delivery_destination': 'Delivery 1', 'pallets_ordered': 5},
+        {'load_number': 'L3', 'delivery_destination': 'Delivery 1', 'pallets_ordered': 5},
+        {'load_number': 'L1', 'delivery_destination': 'Delivery 2', 'pallets_ordered': 3},
+        {'delivery_destination': 'Delivery 3', 'pallets_ordered': 4},
+        {'load_number': float('nan'), 'delivery_destination': float('nan'), 'pallets_ordered': 2},
+        {'load_number': 'L4', 'delivery_destination': 'Delivery 4', 'pallets_ordered': 1},
+        {'load_number': 'L4', 'delivery_destination': 'Delivery 4', 'pallets_ordered': 1},
+    ]
+    
+    try:
+        for builder_class, advanced in ((DatasetBuilder, False), (AdvancedDatasetBuilder, True)):
+            builder = builder_class()
+            
+            assert repr(builder.merge_orders_and_deliveries(orders, deliveries)) == repr(reference_merge(orders, deliveries, advanced))
+            
+            # Тестовая книга
+            sheets = builder.read_excel_sheets(test_file_path, ['Pallet Order', 'Collection Plan'])
+            args = ('2024-01-01', os.path.basename(test_file_path)) if advanced else ('2024-01-01',)
+            sheet_orders = builder.process_pallet_order_sheet(sheets['Pallet Order'], *args)
+            sheet_deliveries = builder.process_collection_plan_sheet(sheets['Collection Plan'], *args)
+            if isinstance(sheet_orders, pd.DataFrame):
+                sheet_orders = sheet_orders.to_dict('records')
+            if isinstance(sheet_deliveries, pd.DataFrame):
+                sheet_deliveries = builder.records_without_na(sheet_deliveries) if advanced else sheet_deliveries.to_dict('records')
+            
+            merged = builder.merge_orders_and_deliveries(sheet_orders, sheet_deliveries)
+            assert repr(merged) == repr(reference_merge(sheet_orders, sheet_deliveries, advanced))
+        
+        print(f"\nТестирование индексного объединения: ✓")
+        
+    finally:
+        shutil.rmtree(temp_dir)
+
+def reference_pallet_orders(builder, df, file_date, filename, advanced):
+    """Прежний построчный разбор листа 'Pallet Order' (iterrows), используется как эталон"""
+    orders = []
+    
+    header_row = builder.find_header_row(df, 'Pallet Order') if advanced else -1
+    delivery_headers = []
+    for col_idx in range(1, min(26, len(df.columns))):
+        header_value = df.iloc[max(header_row, 0), col_idx]
+        if not advanced:
+            delivery_headers.append((col_idx, header_value))
+        elif pd.notna(header_value) and str(header_value).strip():
+            delivery_headers.append((col_idx, str(header_value).strip()))
+    
+    for idx, row in df.iterrows():
+        if idx <= header_row:
+            continue
+        
+        client_name = row.iloc[0]
+        if pd.isna(client_name) or not isinstance(client_name, str) or client_name.strip() == "":
+            continue
+        
+        for col_idx, delivery_name in delivery_headers:
+            pallet_count = row.iloc[col_idx]
+            if pd.isna(pallet_count) or pallet_count == 0:
+                continue
+            
+            order = {
+                'Date': file_date,
+                'Client_Name': client_name.strip() if advanced else client_name,
+                'Delivery_Name': delivery_name,
+                'Pallets_Ordered': float(pallet_count) if advanced else pallet_count,
+                'Temperature': builder.extract_temperature(client_name),
+                'Source_Sheet': 'Pallet Order'
+            }
+            if advanced:
+                order['Source_File'] = filename
+            orders.append(order)
+    
+    return orders
+
+def test_pallet_order_matches_reference():
+    """Тестирует, что векторный разбор листа 'Pallet Order' совпадает с прежним построчным"""
+    from dataset_builder import DatasetBuilder
+    from dataset_builder_advanced import AdvancedDatasetBuilder
+    
+    # Колонка A без строк: числа, даты, пустые и пробельные названия клиентов
+    sheets = {
+        'mixed': pd.DataFrame([
+            ['Client', 'Delivery 1', 'Delivery 2', 'Delivery 3'],
+            ['Client A (+10°C)', 5, 0, None],
+            [123, 4, 2, 1],
+            ['   ', 1, 1, 1],
+            [None, 3, 3, 3],
+            [datetime(2024, 1, 1), 2, 2, 2],
+            [' Client B (-18°C) ', None, 2.5, 0],
+        ], dtype=object),
+        'no strings': pd.DataFrame([
+            [None, 'Delivery 1', 'Delivery 2'],
+            [1, 5, 3],
+            [2.5, None, 4],
+            [None, 1, 1],
+        ], dtype=object),
+    }
+    
+    for builder_class, advanced in ((DatasetBuilder, False), (AdvancedDatasetBuilder, True)):
+        builder = builder_class()
+        args = ('2024-01-01', 'test.xlsx') if advanced else ('2024-01-01',)
+        for name, df in sheets.items():
+            orders = builder.process_pallet_order_sheet(df, *args).to_dict('records')
+            expected = reference_pallet_orders(builder, df, '2024-01-01', 'test.xlsx', advanced)
+            assert repr(orders) == repr(expected), name
+    
+    print(f"\nТестирование векторного разбора 'Pallet Order': ✓")
+
 def main():
     """Основная функция тестирования"""
     print("=== Тестирование Dataset Builder ===")
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Workbook reader for Dataset Builder
+Открытие книги Excel один раз и построчное чтение нужных листов выбранным движком
+"""
+
+import importlib.util
+import os
+from datetime import date, datetime
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+from openpyxl import load_workbook
+from openpyxl.cell.cell import ERROR_CODES
+from pandas.io.parsers import TextParser
+
+from credential_resolver import CredentialResolver
+
+# Движки чтения: calamine (python-calamine, быстрый нативный разбор) и openpyxl;
+# 'auto' выбирает calamine, если пакет установлен
+ENGINES = ('auto', 'calamine', 'openpyxl')
+
+
+def calamine_available() -> bool:
+    """Проверяет, установлен ли пакет python-calamine"""
+    return importlib.util.find_spec('python_calamine') is not None
+
+
+def resolve_engine(engine: str = 'auto') -> str:
+    """Возвращает движок, которым будут читаться книги"""
+    if engine not in ENGINES:
+        raise ValueError(f"Неизвестный движок чтения Excel: {engine}")
+    if engine == 'auto':
+        return 'calamine' if calamine_available() else 'openpyxl'
+    if engine == 'calamine' and not calamine_available():
+        raise RuntimeError("для движка calamine нужен пакет python-calamine")
+    return engine
+
+
+def _cell_value(value: Any) -> Any:
+    """Значение ячейки в том виде, в каком его возвращает pandas.read_excel"""
+    if value is None:
+        return ''
+    if isinstance(value, date) and not isinstance(value, datetime):
+        return datetime(value.year, value.month, value.day)
+    if isinstance(value, float):
+        # Целые числа Excel хранит как float, pandas возвращает их как int
+        return int(value) if value.is_integer() else value
+    if isinstance(value, str) and value in ERROR_CODES:
+        return np.nan
+    return value
+
+
+class WorkbookHandle:
+    """Открытая книга Excel: файл распаковывается один раз, листы читаются построчно
+
+    Книга открывается только для чтения и только со значениями (без стилей, формул и макросов),
+    поэтому оформление и пустые строки с форматированием не загружаются в память.
+    Значения ячеек любого движка приводятся к одному виду, поэтому результат от движка не зависит.
+    """
+
+    def __init__(self, file_path: str, password: Optional[str] = None, engine: str = 'auto',
+                 credentials: Optional[CredentialResolver] = None):
+        self.file_path = file_path
+        self.password = password
+        self.engine = resolve_engine(engine)
+
+        # Явно указанный пароль проверяется единственным; иначе пароль подбирает resolver
+        if password:
+            credentials = CredentialResolver([password])
+        source = (credentials or CredentialResolver()).open_source(file_path)
+        # Зашифрованная книга расшифровывается один раз в буфер, из которого читаются все листы
+        self.encrypted = not isinstance(source, str)
+
+        if self.engine == 'calamine':
+            from python_calamine import SheetTypeEnum, load_workbook as load_calamine_workbook
+            self._workbook = load_calamine_workbook(source)
+            self.sheet_names: List[str] = [sheet.name for sheet in self._workbook.sheets_metadata
+                                           if sheet.typ == SheetTypeEnum.WorkSheet]
+        else:
+            self._workbook = load_workbook(source, read_only=True, data_only=True, keep_links=False)
+            self.sheet_names = [sheet.title for sheet in self._workbook.worksheets]
+
+    def has_sheet(self, sheet_name: str) -> bool:
+        """Проверяет наличие листа без попытки его прочитать"""
+        return sheet_name in self.sheet_names
+
+    def _iter_raw_rows(self, sheet_name: str, max_col: Optional[int]) -> Iterator[Sequence[Any]]:
+        """Строки листа с исходными значениями ячеек движка, начиная с ячейки A1"""
+        if self.engine == 'calamine':
+            for row in self._workbook.get_sheet_by_name(sheet_name).to_python(skip_empty_area=False):
+                yield row[:max_col] if max_col else row
+            return
+
+        sheet = self._workbook[sheet_name]
+        # Размеры листа в файле могут быть неверными - читаем все строки
+        sheet.reset_dimensions()
+        yield from sheet.iter_rows(max_col=max_col, values_only=True)
+
+    def read_rows(self, sheet_name: str, max_col: Optional[int] = None) -> List[List[Any]]:
+        """Читает значения листа построчно до последней непустой строки
+
+        max_col ограничивает число читаемых колонок (например, 26 - колонки A-Z).
+        """
+        data: List[List[Any]] = []
+        empty_rows = 0
+        for row in self._iter_raw_rows(sheet_name, max_col):
+            values = [_cell_value(value) for value in row]
+            while values and values[-1] == '':
+                values.pop()
+
+            # Пустые строки добавляются, только если за ними есть данные
+            if not values:
+                empty_rows += 1
+                continue
+            data.extend([] for _ in range(empty_rows))
+            empty_rows = 0
+            data.append(values)
+
+        # Выравниваем строки по ширине самой длинной строки
+        width = max((len(values) for values in data), default=0)
+        for values in data:
+            values.extend([''] * (width - len(values)))
+        return data
+
+    def read_sheet(self, sheet_name: str, max_col: Optional[int] = None) -> Optional[pd.DataFrame]:
+        """Читает один лист (первая строка - заголовок, как в pandas.read_excel); для отсутствующего листа возвращает None"""
+        if not self.has_sheet(sheet_name):
+            return None
+
+        data = self.read_rows(sheet_name, max_col)
+        if not data:
+            return pd.DataFrame()
+        return TextParser(data, header=0, skip_blank_lines=False).read()
+
+    def read_sheets(self, sheet_names: Iterable[str], max_cols: Optional[Dict[str, int]] = None) -> Dict[str, Optional[pd.DataFrame]]:
+        """Читает несколько листов из одной загрузки книги"""
+        max_cols = max_cols or {}
+        return {sheet_name: self.read_sheet(sheet_name, max_cols.get(sheet_name)) for sheet_name in sheet_names}
+
+    def close(self):
+        """Освобождает ресурсы книги"""
+        self._workbook.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __repr__(self):
+        return f"WorkbookHandle({os.path.basename(self.file_path)!r}, engine={self.engine!r}, sheets={self.sheet_names})"